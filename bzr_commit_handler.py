@@ -30,6 +30,7 @@ from bzrlib.trace import (
     note,
     warning,
     )
+from bzrlib.static_tuple import StaticTuple
 from fastimport import (
     helpers,
     processor,
@@ -52,6 +53,78 @@ def copy_inventory(inv):
     return inv
 
 
+class CopyOnWriteInventory(inventory.Inventory):
+    """An Inventory sharing its unchanged entries with a basis inventory.
+
+    An entry is only copied when it is about to be modified, along with
+    the directories above it, so the cost of building the inventory for
+    a commit grows with the size of the change rather than the size of
+    the tree. The basis inventory must not be modified afterwards.
+    """
+
+    def __init__(self, basis):
+        super(CopyOnWriteInventory, self).__init__(None, basis.revision_id)
+        if not isinstance(basis, inventory.Inventory):
+            # Other inventories, e.g. CHKInventory, have no entries to share
+            basis = copy_inventory(basis)
+        self._byid = basis._byid.copy()
+        self.root = basis.root
+        # the file-ids of the entries that belong to this inventory alone
+        self._owned = set()
+
+    def get_mutable_entry(self, file_id):
+        """Get an entry of this inventory that is safe to modify."""
+        ie = self._byid[file_id]
+        if file_id in self._owned:
+            return ie
+        new_ie = ie.copy()
+        if ie.kind == 'directory':
+            new_ie.children = ie.children.copy()
+        self._byid[file_id] = new_ie
+        self._owned.add(file_id)
+        if ie.parent_id is None:
+            self.root = new_ie
+        else:
+            parent_ie = self.get_mutable_entry(ie.parent_id)
+            parent_ie.children[ie.name] = new_ie
+        return new_ie
+
+    def _add_child(self, entry):
+        self._owned.add(entry.file_id)
+        return super(CopyOnWriteInventory, self)._add_child(entry)
+
+    def add(self, entry):
+        if entry.parent_id in self._byid:
+            self.get_mutable_entry(entry.parent_id)
+        return super(CopyOnWriteInventory, self).add(entry)
+
+    def __delitem__(self, file_id):
+        self._get_mutable_parent(file_id)
+        super(CopyOnWriteInventory, self).__delitem__(file_id)
+
+    def remove_recursive_id(self, file_id):
+        self._get_mutable_parent(file_id)
+        super(CopyOnWriteInventory, self).remove_recursive_id(file_id)
+
+    def rename(self, file_id, new_parent_id, new_name):
+        self.get_mutable_entry(file_id)
+        self.get_mutable_entry(new_parent_id)
+        super(CopyOnWriteInventory, self).rename(file_id, new_parent_id,
+            new_name)
+
+    def replace_entry(self, ie):
+        """Replace the entry with the same file-id as ie by ie."""
+        parent_ie = self.get_mutable_entry(ie.parent_id)
+        self._byid[ie.file_id] = ie
+        self._owned.add(ie.file_id)
+        parent_ie.children[ie.name] = ie
+
+    def _get_mutable_parent(self, file_id):
+        parent_id = self._byid[file_id].parent_id
+        if parent_id is not None:
+            self.get_mutable_entry(parent_id)
+
+
 class GenericCommitHandler(processor.CommitHandler):
     """Base class for Bazaar CommitHandlers."""
 
@@ -118,9 +191,13 @@ class GenericCommitHandler(processor.CommitHandler):
         self.debug("%s id: %s, parents: %s", self.command.id,
             self.revision_id, str(self.parents))
 
+        # Keep the inventory of this revision for the commits merging it
+        self.cache_mgr.pin_merged_inventory(self.command.id, self.revision_id)
+
         # Tell the RevisionStore we're starting a new commit
         self.revision = self.build_revision()
-        self.parent_invs = [self.get_inventory(p) for p in self.parents]
+        self.parent_invs = self._get_parent_inventories(self.parents)
+        self.cache_mgr.release_merged_inventories(self.command.merges)
         self.rev_store.start_new_revision(self.revision, self.parents,
             self.parent_invs)
 
@@ -133,7 +210,7 @@ class GenericCommitHandler(processor.CommitHandler):
         if len(self.parents) == 0:
             self.basis_inventory = self._init_inventory()
         else:
-            self.basis_inventory = self.get_inventory(self.parents[0])
+            self.basis_inventory = self.parent_invs[0]
         if hasattr(self.basis_inventory, "root_id"):
             self.inventory_root_id = self.basis_inventory.root_id
         else:
@@ -142,6 +219,9 @@ class GenericCommitHandler(processor.CommitHandler):
         # directory-path -> inventory-entry for current inventory
         self.directory_entries = {}
 
+        # the paths in the basis inventory, if indexed
+        self._basis_paths = None
+
     def _init_inventory(self):
         return self.rev_store.init_inventory(self.revision_id)
 
@@ -157,14 +237,36 @@ class GenericCommitHandler(processor.CommitHandler):
             self.cache_mgr.inventories[revision_id] = inv
         return inv
 
+    def _get_parent_inventories(self, revision_ids):
+        """Get the inventories for the parents of this commit.
+
+        Any inventories not in the cache are reconstructed together.
+        """
+        fetched = {}
+        missing = []
+        for revision_id in revision_ids:
+            if (revision_id not in self.cache_mgr.inventories and
+                revision_id not in missing):
+                missing.append(revision_id)
+        if len(missing) > 1:
+            if self.verbose:
+                self.mutter("get_inventory cache misses for %s", missing)
+            fetched = dict(zip(missing,
+                self.rev_store.get_inventories(missing)))
+            for revision_id in missing:
+                self.cache_mgr.inventories[revision_id] = fetched[revision_id]
+        result = []
+        for revision_id in revision_ids:
+            inv = fetched.get(revision_id)
+            if inv is None:
+                inv = self.get_inventory(revision_id)
+            result.append(inv)
+        return result
+
     def _get_data(self, file_id):
         """Get the data bytes for a file-id."""
         return self.data_for_commit[file_id]
 
-    def _get_lines(self, file_id):
-        """Get the lines for a file-id."""
-        return osutils.split_lines(self._get_data(file_id))
-
     def _get_per_file_parents(self, file_id):
         """Get the lines for a file-id."""
         return self.per_file_parents_for_commit[file_id]
@@ -209,7 +311,7 @@ class GenericCommitHandler(processor.CommitHandler):
                 return id, False
 
             # Try the basis inventory
-            id = self.basis_inventory.path2id(path)
+            id = self._path2id(self.basis_inventory, path)
             if id is not None:
                 return id, False
             
@@ -232,6 +334,12 @@ class GenericCommitHandler(processor.CommitHandler):
         """Get a Bazaar file identifier for a path."""
         return self.bzr_file_id_and_new(path)[0]
 
+    def _path2id(self, inv, path):
+        """Get the file-id of a path in an inventory, or None."""
+        if inv is self.basis_inventory and self._basis_paths is not None:
+            return self._basis_paths.path2id(path)
+        return inv.path2id(path)
+
     def _utf8_decode(self, field, value):
         try:
             return value.decode('utf-8')
@@ -352,19 +460,18 @@ class GenericCommitHandler(processor.CommitHandler):
         ie.revision = self.revision_id
         if kind == 'file':
             ie.executable = is_executable
-            # lines = osutils.split_lines(data)
             ie.text_sha1 = osutils.sha_string(data)
             ie.text_size = len(data)
             self.data_for_commit[file_id] = data
         elif kind == 'directory':
             self.directory_entries[path] = ie
             # There are no lines stored for a directory so
-            # make sure the cache used by get_lines knows that
+            # make sure the cache used by _get_data knows that
             self.data_for_commit[file_id] = ''
         elif kind == 'symlink':
             ie.symlink_target = self._decode_path(data)
             # There are no lines stored for a symlink so
-            # make sure the cache used by get_lines knows that
+            # make sure the cache used by _get_data knows that
             self.data_for_commit[file_id] = ''
         else:
             self.warning("Cannot import items of kind '%s' yet - ignoring '%s'"
@@ -408,7 +515,7 @@ class GenericCommitHandler(processor.CommitHandler):
         ie.revision = self.revision_id
         self.directory_entries[dirname] = ie
         # There are no lines stored for a directory so
-        # make sure the cache used by get_lines knows that
+        # make sure the cache used by _get_data knows that
         self.data_for_commit[dir_file_id] = ''
 
         # It's possible that a file or symlink with that file-id
@@ -428,7 +535,7 @@ class GenericCommitHandler(processor.CommitHandler):
             if dirname in self._paths_deleted_this_commit:
                 raise KeyError
             try:
-                file_id = inv.path2id(dirname)
+                file_id = self._path2id(inv, dirname)
             except errors.NoSuchId:
                 # In a CHKInventory, this is raised if there's no root yet
                 raise KeyError
@@ -450,7 +557,7 @@ class GenericCommitHandler(processor.CommitHandler):
             # note: delta entries look like (old, new, file-id, ie)
             ie = self._delta_entries_by_fileid[file_id][3]
         else:
-            file_id = inv.path2id(path)
+            file_id = self._path2id(inv, path)
             if file_id is None:
                 self.mutter("ignoring delete of %s as not in inventory", path)
                 return
@@ -470,7 +577,7 @@ class GenericCommitHandler(processor.CommitHandler):
             # note: delta entries look like (old, new, file-id, ie)
             ie = self._delta_entries_by_fileid[file_id][3]
         else:
-            file_id = inv.path2id(src_path)
+            file_id = self._path2id(inv, src_path)
             if file_id is None:
                 self.warning("ignoring copy of %s to %s - source does not exist",
                     src_path, dest_path)
@@ -499,7 +606,7 @@ class GenericCommitHandler(processor.CommitHandler):
             self._rename_pending_change(old_path, new_path, existing)
             return
 
-        file_id = inv.path2id(old_path)
+        file_id = self._path2id(inv, old_path)
         if file_id is None:
             self.warning(
                 "ignoring rename of %s to %s - old path does not exist" %
@@ -507,7 +614,7 @@ class GenericCommitHandler(processor.CommitHandler):
             return
         ie = inv[file_id]
         rev_id = ie.revision
-        new_file_id = inv.path2id(new_path)
+        new_file_id = self._path2id(inv, new_path)
         if new_file_id is not None:
             self.record_delete(new_path, inv[new_file_id])
         self.record_rename(old_path, new_path, file_id, ie)
@@ -515,8 +622,8 @@ class GenericCommitHandler(processor.CommitHandler):
         # The revision-id for this entry will be/has been updated and
         # that means the loader then needs to know what the "new" text is.
         # We therefore must go back to the revision store to get it.
-        lines = self.rev_store.get_file_lines(rev_id, file_id)
-        self.data_for_commit[file_id] = ''.join(lines)
+        self.data_for_commit[file_id] = self.rev_store.get_file_bytes(rev_id,
+            file_id)
 
     def _delete_all_items(self, inv):
         if len(inv) == 0:
@@ -543,16 +650,9 @@ class InventoryCommitHandler(GenericCommitHandler):
         # Seed the inventory from the previous one. Note that
         # the parent class version of pre_process_files() has
         # already set the right basis_inventory for this branch
-        # but we need to copy it in order to mutate it safely
-        # without corrupting the cached inventory value.
-        if len(self.parents) == 0:
-            self.inventory = self.basis_inventory
-        else:
-            self.inventory = copy_inventory(self.basis_inventory)
-        self.inventory_root = self.inventory.root
-
-        # directory-path -> inventory-entry for current inventory
-        self.directory_entries = dict(self.inventory.directories())
+        # but we need a copy-on-write view of it in order to mutate
+        # it safely without corrupting the cached inventory value.
+        self.inventory = CopyOnWriteInventory(self.basis_inventory)
 
         # Initialise the inventory revision info as required
         if self.rev_store.expects_rich_root():
@@ -561,7 +661,9 @@ class InventoryCommitHandler(GenericCommitHandler):
             # In this revision store, root entries have no knit or weave.
             # When serializing out to disk and back in, root.revision is
             # always the new revision_id.
-            self.inventory.root.revision = self.revision_id
+            root_id = self.inventory.root.file_id
+            self.inventory.get_mutable_entry(root_id).revision = \
+                self.revision_id
 
     def post_process_files(self):
         """Save the revision."""
@@ -587,13 +689,10 @@ class InventoryCommitHandler(GenericCommitHandler):
             self.inventory.add(ie)
 
     def record_changed(self, path, ie, parent_id):
-        # HACK: no API for this (del+add does more than it needs to)
         per_file_parents, ie.revision = \
             self.rev_store.get_parents_and_revision_for_entry(ie)
         self.per_file_parents_for_commit[ie.file_id] = per_file_parents
-        self.inventory._byid[ie.file_id] = ie
-        parent_ie = self.inventory._byid[parent_id]
-        parent_ie.children[ie.name] = ie
+        self.inventory.replace_entry(ie)
 
     def record_delete(self, path, ie):
         self.inventory.remove_recursive_id(ie.file_id)
@@ -601,6 +700,7 @@ class InventoryCommitHandler(GenericCommitHandler):
     def record_rename(self, old_path, new_path, file_id, ie):
         # For a rename, the revision-id is always the new one so
         # no need to change/set it here
+        ie = self.inventory.get_mutable_entry(file_id)
         ie.revision = self.revision_id
         per_file_parents, _ = \
             self.rev_store.get_parents_and_revision_for_entry(ie)
@@ -645,6 +745,7 @@ class InventoryDeltaCommitHandler(GenericCommitHandler):
 
     def pre_process_files(self):
         super(InventoryDeltaCommitHandler, self).pre_process_files()
+        # the file-ids of the directories that might become empty
         self._dirs_that_might_become_empty = set()
 
         # A given file-id can only appear once so we accumulate
@@ -662,6 +763,15 @@ class InventoryDeltaCommitHandler(GenericCommitHandler):
             root_ie.revision = self.revision_id
             self._add_entry((old_path, '', root_id, root_ie))
 
+        # Look up paths in the basis inventory in an index carried over
+        # from the commit that built it, when there is one
+        if self.parents:
+            basis_revision_id = self.parents[0]
+        else:
+            basis_revision_id = None
+        self._basis_paths = self.cache_mgr.take_path_index(basis_revision_id,
+            self.basis_inventory)
+
     def post_process_files(self):
         """Save the revision."""
         delta = self._get_final_delta()
@@ -671,6 +781,8 @@ class InventoryDeltaCommitHandler(GenericCommitHandler):
             self._get_per_file_parents,
             self._get_inventories)
         self.cache_mgr.inventories[self.revision_id] = inv
+        self._basis_paths.apply_delta(delta, inv)
+        self.cache_mgr.keep_path_index(self.revision_id, self._basis_paths)
         #print "committed %s" % self.revision_id
 
     def _get_final_delta(self):
@@ -679,64 +791,81 @@ class InventoryDeltaCommitHandler(GenericCommitHandler):
         Smart post-processing of changes, e.g. pruning of directories
         that would become empty, goes here.
         """
-        delta = list(self._delta_entries_by_fileid.values())
+        entries = dict(self._delta_entries_by_fileid)
         if self.prune_empty_dirs and self._dirs_that_might_become_empty:
             candidates = self._dirs_that_might_become_empty
             while candidates:
-                never_born = set()
                 parent_dirs_that_might_become_empty = set()
-                for path, file_id in self._empty_after_delta(delta, candidates):
-                    newly_added = self._new_file_ids.get(path)
-                    if newly_added:
-                        never_born.add(newly_added)
+                for file_id, ie, basis_path in self._empty_after_delta(
+                    entries, candidates):
+                    if basis_path is None:
+                        # Never born, so just drop the add
+                        del entries[file_id]
                     else:
-                        delta.append((path, None, file_id, None))
-                    parent_dir = osutils.dirname(path)
-                    if parent_dir:
-                        parent_dirs_that_might_become_empty.add(parent_dir)
+                        entries[file_id] = (basis_path, None, file_id, None)
+                    if ie.parent_id != self.inventory_root_id:
+                        parent_dirs_that_might_become_empty.add(ie.parent_id)
                 candidates = parent_dirs_that_might_become_empty
-                # Clean up entries that got deleted before they were ever added
-                if never_born:
-                    delta = [de for de in delta if de[2] not in never_born]
-        return delta
-
-    def _empty_after_delta(self, delta, candidates):
-        #self.mutter("delta so far is:\n%s" % "\n".join([str(de) for de in delta]))
-        #self.mutter("candidates for deletion are:\n%s" % "\n".join([c for c in candidates]))
-        new_inv = self._get_proposed_inventory(delta)
+        return entries.values()
+
+    def _empty_after_delta(self, entries, candidates):
+        """Find the candidate directories that are empty after a delta.
+
+        Rather than building the inventory resulting from the delta, the
+        delta is laid over the basis inventory: the children of a
+        directory are those added or kept by the delta plus those in the
+        basis inventory the delta does not touch.
+
+        :param entries: the delta entries by file-id
+        :param candidates: the file-ids of the directories to check
+        :return: a list of (file_id, ie, basis_path) tuples, where ie is
+            the entry of the directory after the delta and basis_path is
+            its path in the basis inventory, or None if it is not there
+        """
+        new_child_counts = {}
+        for old_path, new_path, file_id, ie in entries.itervalues():
+            if new_path is not None:
+                new_child_counts[ie.parent_id] = (
+                    new_child_counts.get(ie.parent_id, 0) + 1)
         result = []
-        for dir in candidates:
-            file_id = new_inv.path2id(dir)
-            if file_id is None:
+        for file_id in candidates:
+            entry = entries.get(file_id)
+            if entry is not None:
+                basis_path, new_path, file_id, ie = entry
+            else:
+                basis_path = self._basis_paths.id2path(file_id)
+                if basis_path is None:
+                    continue
+                new_path = basis_path
+                ie = self.basis_inventory[file_id]
+            if ie is None or ie.kind != 'directory':
                 continue
-            ie = new_inv[file_id]
-            if ie.kind != 'directory':
+            if new_child_counts.get(file_id):
                 continue
-            if len(ie.children) == 0:
-                result.append((dir, file_id))
-                if self.verbose:
-                    self.note("pruning empty directory %s" % (dir,))
+            if (basis_path is not None and
+                self._has_basis_children(file_id, entries)):
+                continue
+            result.append((file_id, ie, basis_path))
+            if self.verbose:
+                self.note("pruning empty directory %s" % (new_path,))
         return result
 
-    def _get_proposed_inventory(self, delta):
-        if len(self.parents):
-            # new_inv = self.basis_inventory._get_mutable_inventory()
-            # Note that this will create unreferenced chk pages if we end up
-            # deleting entries, because this 'test' inventory won't end up
-            # used. However, it is cheaper than having to create a full copy of
-            # the inventory for every commit.
-            new_inv = self.basis_inventory.create_by_apply_delta(delta,
-                'not-a-valid-revision-id:')
+    def _has_basis_children(self, file_id, changed_ids):
+        """Does a directory keep any of its children in the basis?
+
+        :param changed_ids: the file-ids changed by the delta
+        """
+        inv = self.basis_inventory
+        parent_id_index = getattr(inv, 'parent_id_basename_to_file_id', None)
+        if parent_id_index is None:
+            child_ids = (ie.file_id for ie in inv[file_id].children.itervalues())
         else:
-            new_inv = inventory.Inventory(revision_id=self.revision_id)
-            # This is set in the delta so remove it to prevent a duplicate
-            del new_inv[inventory.ROOT_ID]
-            try:
-                new_inv.apply_delta(delta)
-            except errors.InconsistentDelta:
-                self.mutter("INCONSISTENT DELTA IS:\n%s" % "\n".join([str(de) for de in delta]))
-                raise
-        return new_inv
+            child_ids = (child_id for key, child_id in
+                parent_id_index.iteritems(key_filter=[StaticTuple(file_id,)]))
+        for child_id in child_ids:
+            if child_id not in changed_ids:
+                return True
+        return False
 
     def _add_entry(self, entry):
         # We need to combine the data if multiple entries have the same file-id.
@@ -764,30 +893,28 @@ class InventoryDeltaCommitHandler(GenericCommitHandler):
         if existing is not None:
             old_path = existing[0]
             entry = (old_path, new_path, file_id, ie)
+            # The directory holding the entry before this change
+            if existing[3] is None:
+                old_parent_id = None
+            else:
+                old_parent_id = existing[3].parent_id
+        elif old_path is not None:
+            old_parent_id = self.basis_inventory[file_id].parent_id
+        else:
+            old_parent_id = None
         if new_path is None and old_path is None:
             # This is a delete cancelling a previous add
             del self._delta_entries_by_fileid[file_id]
-            parent_dir = osutils.dirname(existing[1])
-            self.mutter("cancelling add of %s with parent %s" % (existing[1], parent_dir))
-            if parent_dir:
-                self._dirs_that_might_become_empty.add(parent_dir)
-            return
+            self.mutter("cancelling add of %s" % (existing[1],))
         else:
             self._delta_entries_by_fileid[file_id] = entry
 
         # Collect parent directories that might become empty
-        if new_path is None:
-            # delete
-            parent_dir = osutils.dirname(old_path)
-            # note: no need to check the root
-            if parent_dir:
-                self._dirs_that_might_become_empty.add(parent_dir)
-        elif old_path is not None and old_path != new_path:
-            # rename
-            old_parent_dir = osutils.dirname(old_path)
-            new_parent_dir = osutils.dirname(new_path)
-            if old_parent_dir and old_parent_dir != new_parent_dir:
-                self._dirs_that_might_become_empty.add(old_parent_dir)
+        # note: no need to check the root
+        if (old_parent_id is not None and
+            old_parent_id != self.inventory_root_id and
+            (new_path is None or ie.parent_id != old_parent_id)):
+            self._dirs_that_might_become_empty.add(old_parent_id)
 
         # Calculate the per-file parents, if not already done
         if file_id in self.per_file_parents_for_commit:
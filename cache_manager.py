@@ -15,13 +15,18 @@
 
 """A manager of caches."""
 
+import array
 import atexit
+import bisect
+import collections
+import mmap
+import operator
 import os
-import shutil
 import tempfile
 import weakref
+import zlib
 
-from bzrlib import lru_cache, trace
+from bzrlib import errors, lru_cache, osutils, trace
 from bzrlib.plugins.fastimport import (
     branch_mapper,
     )
@@ -39,38 +44,614 @@ class _Cleanup(object):
     We use a helper class to ensure that we are never in a refcycle.
     """
 
-    def __init__(self, disk_blobs):
-        self.disk_blobs = disk_blobs
-        self.tempdir = None
-        self.small_blobs = None
+    def __init__(self):
+        self.arena = None
 
     def __del__(self):
         self.finalize()
 
     def finalize(self):
-        if self.disk_blobs is not None:
-            for info in self.disk_blobs.itervalues():
-                if info[-1] is not None:
-                    os.unlink(info[-1])
-            self.disk_blobs = None
-        if self.small_blobs is not None:
-            self.small_blobs.close()
-            self.small_blobs = None
-        if self.tempdir is not None:
-            shutil.rmtree(self.tempdir)
+        if self.arena is not None:
+            self.arena.close()
+            self.arena = None
+
+
+class BlobArena(object):
+    """A memory-mapped temporary file holding blobs.
+
+    Blobs are located by their offset and length. The space used by
+    blobs that are freed is reused for later blobs, and the file only
+    grows when no free extent is big enough.
+    """
+
+    # The initial size of the file
+    _initial_size = 1024*1024
+
+    def __init__(self, dir=None):
+        self._file = tempfile.TemporaryFile(prefix='fastimport-blobs-',
+            dir=dir)
+        self._map = None
+        self._capacity = 0
+        # the end of the space used so far
+        self._end = 0
+        # offsets and lengths of the free extents before _end,
+        # sorted by offset
+        self._free_offsets = []
+        self._free_lengths = []
+
+    def _reserve(self, size):
+        """Make sure the file can hold size bytes."""
+        if size <= self._capacity:
+            return
+        capacity = max(self._capacity * 2, self._initial_size)
+        while capacity < size:
+            capacity *= 2
+        if self._map is not None:
+            self._map.close()
+        os.ftruncate(self._file.fileno(), capacity)
+        self._map = mmap.mmap(self._file.fileno(), capacity)
+        self._capacity = capacity
+
+    def _allocate(self, length):
+        """Find the offset to store length bytes at."""
+        lengths = self._free_lengths
+        for i in xrange(len(lengths)):
+            if lengths[i] >= length:
+                offset = self._free_offsets[i]
+                if lengths[i] == length:
+                    del self._free_offsets[i]
+                    del lengths[i]
+                else:
+                    self._free_offsets[i] += length
+                    lengths[i] -= length
+                return offset
+        offset = self._end
+        self._end += length
+        self._reserve(self._end)
+        return offset
+
+    def add(self, data):
+        """Store a blob.
+
+        :return: the offset of the blob
+        """
+        offset = self._allocate(len(data))
+        self._map[offset:offset + len(data)] = data
+        return offset
+
+    def get(self, offset, length):
+        """Get the blob stored at an offset."""
+        return self._map[offset:offset + length]
+
+    def free(self, offset, length):
+        """Release the space used by a blob."""
+        if not length:
+            return
+        offsets = self._free_offsets
+        lengths = self._free_lengths
+        i = bisect.bisect(offsets, offset)
+        # Merge with the following and preceding extents
+        if i < len(offsets) and offset + length == offsets[i]:
+            length += lengths[i]
+            del offsets[i]
+            del lengths[i]
+        if i > 0 and offsets[i - 1] + lengths[i - 1] == offset:
+            lengths[i - 1] += length
+        else:
+            offsets.insert(i, offset)
+            lengths.insert(i, length)
+        # Give back an extent at the end of the used space
+        if offsets[-1] + lengths[-1] == self._end:
+            self._end = offsets.pop()
+            lengths.pop()
+
+    def size(self):
+        """Get the number of bytes of the file in use."""
+        return self._end - sum(self._free_lengths)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+
+class MarkTable(object):
+    """A mapping of marks to revision-ids.
+
+    Marks are usually consecutive integers, so the revision-ids for
+    those are stored end to end in a single buffer, located through
+    arrays indexed by mark. Other marks are kept in a dictionary.
+
+    Each distinct revision-id is stored in the buffer once, found
+    through a hash table of offsets. The bytes of revision-ids replaced
+    by reassigning marks are reclaimed by compacting the buffer once
+    they make up half of it.
+    """
+
+    # How far past the end of the arrays a mark may be and still be
+    # stored in them, rather than in the dictionary
+    _max_gap = 1024
+
+    # The bytes of replaced revision-ids there must be before compacting
+    _min_compact_bytes = 64*1024
+
+    # The initial number of slots in the hash table of revision-ids
+    _min_table_size = 8
+
+    def __init__(self, marks=None):
+        """Create a mark table.
+
+        :param marks: a dictionary of marks to revision-ids to add
+        """
+        # mark -> offset of the revision-id in _data, or -1 if unset
+        self._offsets = array.array('l')
+        # mark -> length of the revision-id
+        self._lengths = array.array('i')
+        self._data = bytearray()
+        self._init_table()
+        # the bytes in _data no longer used, at most
+        self._dead_bytes = 0
+        # the number of marks stored in the arrays
+        self._count = 0
+        self._other = {}
+        if marks is not None:
+            self.update(marks)
+
+    def _init_table(self):
+        # open addressing hash table of the revision-ids in _data:
+        # the offset, or -1 for an empty slot, and the length of each
+        self._table_offsets = array.array('l')
+        self._table_lengths = array.array('i')
+        self._table_count = 0
+
+    def _store(self, revision_id):
+        """Store a revision-id in _data, unless it is there already.
+
+        :return: the offset of the revision-id in _data
+        """
+        if (self._table_count + 1) * 2 > len(self._table_offsets):
+            self._grow_table()
+        length = len(revision_id)
+        mask = len(self._table_offsets) - 1
+        slot = hash(revision_id) & mask
+        while True:
+            offset = self._table_offsets[slot]
+            if offset == -1:
+                break
+            if (self._table_lengths[slot] == length and
+                self._data[offset:offset + length] == revision_id):
+                return offset
+            slot = (slot + 1) & mask
+        offset = len(self._data)
+        self._data.extend(revision_id)
+        self._table_offsets[slot] = offset
+        self._table_lengths[slot] = length
+        self._table_count += 1
+        return offset
+
+    def _grow_table(self):
+        old_offsets = self._table_offsets
+        old_lengths = self._table_lengths
+        size = max(len(old_offsets) * 2, self._min_table_size)
+        mask = size - 1
+        self._table_offsets = array.array('l', [-1] * size)
+        self._table_lengths = array.array('i', [0] * size)
+        for offset, length in zip(old_offsets, old_lengths):
+            if offset == -1:
+                continue
+            slot = hash(str(self._data[offset:offset + length])) & mask
+            while self._table_offsets[slot] != -1:
+                slot = (slot + 1) & mask
+            self._table_offsets[slot] = offset
+            self._table_lengths[slot] = length
+
+    def _compact(self):
+        """Drop the revision-ids no longer used from _data."""
+        old_data = self._data
+        self._data = bytearray()
+        self._init_table()
+        self._dead_bytes = 0
+        for index, offset in enumerate(self._offsets):
+            if offset != -1:
+                length = self._lengths[index]
+                self._offsets[index] = self._store(
+                    str(old_data[offset:offset + length]))
+
+    def _index(self, mark):
+        """Get the array index for a mark.
+
+        :return: the index or None if the mark is not a plain integer
+        """
+        if mark.isdigit() and (mark[0] != '0' or mark == '0'):
+            return int(mark)
+        return None
+
+    def _revision_id(self, index):
+        offset = self._offsets[index]
+        return str(self._data[offset:offset + self._lengths[index]])
+
+    def __len__(self):
+        return self._count + len(self._other)
+
+    def __getitem__(self, mark):
+        index = self._index(mark)
+        if (index is not None and index < len(self._offsets) and
+            self._offsets[index] != -1):
+            return self._revision_id(index)
+        return self._other[mark]
+
+    def get(self, mark, default=None):
+        try:
+            return self[mark]
+        except KeyError:
+            return default
+
+    def __contains__(self, mark):
+        index = self._index(mark)
+        if (index is not None and index < len(self._offsets) and
+            self._offsets[index] != -1):
+            return True
+        return mark in self._other
+
+    has_key = __contains__
+
+    def __setitem__(self, mark, revision_id):
+        index = self._index(mark)
+        size = len(self._offsets)
+        if index is None or index >= size + self._max_gap:
+            self._other[mark] = revision_id
+            return
+        if index >= size:
+            self._offsets.extend([-1] * (index + 1 - size))
+            self._lengths.extend([0] * (index + 1 - size))
+        if self._offsets[index] == -1:
+            self._count += 1
+            if self._other:
+                self._other.pop(mark, None)
+        elif self._revision_id(index) == revision_id:
+            return
+        else:
+            # The old revision-id may still be used by other marks, so
+            # this overestimates the bytes freed
+            self._dead_bytes += self._lengths[index]
+        self._offsets[index] = self._store(revision_id)
+        self._lengths[index] = len(revision_id)
+        if (self._dead_bytes >= self._min_compact_bytes and
+            self._dead_bytes * 2 >= len(self._data)):
+            self._compact()
+
+    def update(self, marks):
+        for mark, revision_id in marks.iteritems():
+            self[mark] = revision_id
+
+    def iteritems(self):
+        for index, offset in enumerate(self._offsets):
+            if offset != -1:
+                yield str(index), self._revision_id(index)
+        for item in self._other.iteritems():
+            yield item
+
+    def items(self):
+        return list(self.iteritems())
+
+    def __iter__(self):
+        for mark, revision_id in self.iteritems():
+            yield mark
+
+    iterkeys = __iter__
+
+    def keys(self):
+        return list(self)
+
+    def itervalues(self):
+        for mark, revision_id in self.iteritems():
+            yield revision_id
+
+    def values(self):
+        return list(self.itervalues())
+
+    def clear(self):
+        self._offsets = array.array('l')
+        self._lengths = array.array('i')
+        self._data = bytearray()
+        self._init_table()
+        self._dead_bytes = 0
+        self._count = 0
+        self._other.clear()
+
+    def memory_footprint(self):
+        """Estimate the number of bytes used by the table."""
+        size = (len(self._offsets) * self._offsets.itemsize +
+            len(self._lengths) * self._lengths.itemsize + len(self._data) +
+            len(self._table_offsets) * self._table_offsets.itemsize +
+            len(self._table_lengths) * self._table_lengths.itemsize)
+        for mark, revision_id in self._other.iteritems():
+            size += len(mark) + len(revision_id)
+        return size
+
+
+# Estimated bytes of memory used by an inventory and each entry in it
+_INVENTORY_OVERHEAD = 4096
+_INVENTORY_ENTRY_SIZE = 300
+
+
+def _inventory_size(inv):
+    """Estimate the number of bytes of memory used by an inventory."""
+    entries = getattr(inv, '_byid', None)
+    if entries is None:
+        # A CHKInventory only holds the entries loaded so far
+        entries = getattr(inv, '_fileid_to_entry_cache', ())
+    return _INVENTORY_OVERHEAD + len(entries) * _INVENTORY_ENTRY_SIZE
+
+
+class InventoryCache(object):
+    """A cache of inventories by revision-id.
+
+    The cache is bounded by the estimated size of the inventories, or
+    by their number if max_count is given. The size of an inventory is
+    estimated when it is added. The most recently added inventory is
+    always kept, even if it is too big for the cache by itself.
+
+    Inventories can also be pinned so they are kept regardless of the
+    bounds until they have been fetched a given number of times.
+    """
+
+    def __init__(self, max_size, max_count=None):
+        """Create an inventory cache.
+
+        :param max_size: the number of bytes of inventories to cache
+        :param max_count: if not None, the number of inventories to cache
+            instead
+        """
+        if max_count is None:
+            self._cache = lru_cache.LRUSizeCache(max_size,
+                compute_size=operator.itemgetter(1))
+        else:
+            self._cache = lru_cache.LRUCache(max_count)
+        self._last = None
+        # revision-id -> number of fetches to keep the inventory for
+        self._pin_counts = {}
+        # revision-id -> Inventory for pinned inventories
+        self._pinned = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __contains__(self, revision_id):
+        return (revision_id in self._pinned or revision_id in self._cache or
+            (self._last is not None and self._last[0] == revision_id))
+
+    def __getitem__(self, revision_id):
+        inv = self._pinned.get(revision_id)
+        if inv is None:
+            try:
+                inv = self._cache[revision_id][0]
+            except KeyError:
+                if self._last is None or self._last[0] != revision_id:
+                    self.misses += 1
+                    raise
+                inv = self._last[1]
+        self.hits += 1
+        return inv
+
+    def __setitem__(self, revision_id, inv):
+        cache = self._cache
+        count = len(cache)
+        if revision_id not in cache:
+            count += 1
+        cache[revision_id] = (inv, _inventory_size(inv))
+        self.evictions += count - len(cache)
+        self._last = (revision_id, inv)
+        if revision_id in self._pin_counts:
+            self._pinned[revision_id] = inv
+
+    def pin(self, revision_id, count):
+        """Keep the inventory for a revision until it is unpinned.
+
+        :param count: the number of times unpin must be called before
+            the inventory is no longer kept
+        """
+        self._pin_counts[revision_id] = (
+            self._pin_counts.get(revision_id, 0) + count)
+        try:
+            self._pinned[revision_id] = self._cache[revision_id][0]
+        except KeyError:
+            pass
+
+    def unpin(self, revision_id):
+        """Release a pin on the inventory for a revision."""
+        count = self._pin_counts.get(revision_id)
+        if count is None:
+            return
+        if count > 1:
+            self._pin_counts[revision_id] = count - 1
+        else:
+            del self._pin_counts[revision_id]
+            self._pinned.pop(revision_id, None)
+
+    def pinned_count(self):
+        """Get the number of pinned inventories being kept."""
+        return len(self._pinned)
+
+    def size(self):
+        """Get the estimated number of bytes used by the cache."""
+        return sum([size for inv, size in self._cache.as_dict().itervalues()])
+
+    def clear(self):
+        self._cache.clear()
+        self._last = None
+        self._pin_counts.clear()
+        self._pinned.clear()
+
+
+# Estimated bytes of memory used by each path in a PathIndex, besides
+# the path and file-id themselves
+_PATH_INDEX_ENTRY_SIZE = 200
+
+
+class PathIndex(object):
+    """A mapping of the paths in a tree to file-ids, and back.
+
+    Paths are looked up in an inventory the first time and remembered.
+    The index is then kept up to date by applying the inventory deltas
+    of later commits, so looking up a path again does not need to walk
+    the inventory.
+    """
+
+    def __init__(self, inv=None):
+        """Create an index of the paths in an inventory.
+
+        :param inv: the inventory or None for an empty tree
+        """
+        self._inv = inv
+        self._ids = {}
+        self._paths = {}
+        self._size = 0
+
+    def __len__(self):
+        return len(self._ids)
+
+    def copy(self):
+        """Get a copy of the index, to update without changing this one."""
+        result = PathIndex(self._inv)
+        result._ids = self._ids.copy()
+        result._paths = self._paths.copy()
+        result._size = self._size
+        return result
+
+    def memory_footprint(self):
+        """Estimate the number of bytes used by the index."""
+        return self._size
+
+    def clear(self):
+        """Forget the paths looked up so far."""
+        self._ids = {}
+        self._paths = {}
+        self._size = 0
+
+    def _add(self, path, file_id):
+        self._ids[path] = file_id
+        self._paths[file_id] = path
+        self._size += len(path) + len(file_id) + _PATH_INDEX_ENTRY_SIZE
+
+    def _remove(self, file_id):
+        path = self._paths.pop(file_id, None)
+        if path is not None:
+            if self._ids.get(path) == file_id:
+                del self._ids[path]
+            self._size -= len(path) + len(file_id) + _PATH_INDEX_ENTRY_SIZE
+
+    def path2id(self, path):
+        """Get the file-id at a path or None if there is none."""
+        file_id = self._ids.get(path)
+        if file_id is None and self._inv is not None:
+            file_id = self._inv.path2id(path)
+            if file_id is not None:
+                self._add(path, file_id)
+        return file_id
+
+    def id2path(self, file_id):
+        """Get the path of a file-id or None if it is not in the tree."""
+        path = self._paths.get(file_id)
+        if path is None and self._inv is not None:
+            try:
+                path = self._inv.id2path(file_id)
+            except errors.NoSuchId:
+                return None
+            self._add(path, file_id)
+        return path
+
+    def apply_delta(self, delta, inv):
+        """Update the index for an inventory delta.
+
+        The new paths are worked out from the parent and name of the
+        entries, so the children of a renamed directory move with it.
+        Only the paths looked up so far are updated; others are looked up
+        in the new inventory when needed.
+
+        :param delta: the inventory delta
+        :param inv: the inventory the delta gives
+        """
+        new_entries = {}
+        # the file-ids in the delta, including those deleted
+        changed = set()
+        # old path -> file-id of directories that may have been renamed
+        dirs = {}
+        for old_path, new_path, file_id, ie in delta:
+            changed.add(file_id)
+            if ie is not None:
+                new_entries[file_id] = ie
+                if old_path is not None and ie.kind == 'directory':
+                    dirs[old_path] = file_id
+        new_paths = {}
+        def path_of(file_id):
+            path = new_paths.get(file_id)
+            if path is not None:
+                return path
+            ie = new_entries.get(file_id)
+            if ie is not None:
+                if ie.parent_id is None:
+                    path = ''
+                else:
+                    path = osutils.pathjoin(path_of(ie.parent_id), ie.name)
+            else:
+                # An unchanged entry moves with a renamed directory above it
+                path = old_path = self.id2path(file_id)
+                dir = osutils.dirname(old_path)
+                while dir:
+                    if dir in dirs:
+                        path = path_of(dirs[dir]) + old_path[len(dir):]
+                        break
+                    dir = osutils.dirname(dir)
+            new_paths[file_id] = path
+            return path
+        for file_id in new_entries:
+            path_of(file_id)
+        renamed = [path for path, file_id in dirs.iteritems()
+            if new_paths[file_id] != path]
+        if renamed:
+            prefixes = tuple([path + '/' for path in renamed])
+            for path, file_id in self._ids.items():
+                if path.startswith(prefixes) and file_id not in changed:
+                    path_of(file_id)
+        # Remove the old paths then add the new ones
+        for file_id in changed:
+            self._remove(file_id)
+        for file_id in new_paths:
+            self._remove(file_id)
+        for file_id, path in new_paths.iteritems():
+            self._add(path, file_id)
+        self._inv = inv
 
 
 class CacheManager(object):
 
-    _small_blob_threshold = 25*1024
     _sticky_cache_size = 300*1024*1024
     _sticky_flushed_size = 100*1024*1024
-
-    def __init__(self, info=None, verbose=False, inventory_cache_size=10):
+    # The number of path indexes to keep, usually one per branch
+    _path_index_count = 8
+    # The estimated bytes of path indexes to keep
+    _path_index_size = 64*1024*1024
+
+    def __init__(self, info=None, verbose=False, inventory_cache_size=None,
+        inventory_cache_bytes=128*1024*1024, blob_compression_level=0,
+        compressed_blob_cache_bytes=100*1024*1024):
         """Create a manager of caches.
 
         :param info: a ConfigObj holding the output from
             the --info processor, or None if no hints are available
+        :param inventory_cache_size: if not None, the number of
+            inventories to cache
+        :param inventory_cache_bytes: the estimated number of bytes of
+            inventories to cache, used if inventory_cache_size is None
+        :param blob_compression_level: the zlib compression level of
+            sticky blobs flushed from memory, or 0 to write them to disk
+        :param compressed_blob_cache_bytes: the number of bytes of
+            compressed blobs to keep in memory before writing to disk
         """
         self.verbose = verbose
 
@@ -80,26 +661,49 @@ class CacheManager(object):
         self._blobs = {}
         self._sticky_blobs = {}
         self._sticky_memory_bytes = 0
-        # if we overflow our memory cache, then we will dump large blobs to
-        # disk in this directory
-        self._tempdir = None
-        # id => (offset, n_bytes, fname)
-        #   if fname is None, then the content is stored in the small file
+        # if we overflow our memory cache, then we will compress blobs
+        # and keep them in memory, while there is room
+        self._blob_compression_level = blob_compression_level
+        self._compressed_cache_size = compressed_blob_cache_bytes
+        self._compressed_blobs = {}
+        self._compressed_memory_bytes = 0
+        # otherwise we will dump blobs to a file mapped into memory
+        self._arena = None
+        # id => (offset, n_bytes) in the arena
         self._disk_blobs = {}
-        self._cleanup = _Cleanup(self._disk_blobs)
+        self._cleanup = _Cleanup()
+        # the ids of the blobs held at the last checkpoint
+        self._checkpoint_blob_ids = set()
 
         # revision-id -> Inventory cache
         # these are large and we probably don't need too many as
         # most parents are recent in history
-        self.inventories = lru_cache.LRUCache(inventory_cache_size)
+        self.inventories = InventoryCache(inventory_cache_bytes,
+            inventory_cache_size)
+
+        # revision-id -> PathIndex for the latest revisions, oldest first.
+        # A revision built on another starts from a copy of its index.
+        self._path_indexes = collections.OrderedDict()
 
         # import commmit-ids -> revision-id lookup table
-        # we need to keep all of these but they are small
-        self.marks = {}
+        # we need to keep all of these so they are stored compactly
+        self.marks = MarkTable()
 
         # (path, branch_ref) -> file-ids - as generated.
         # (Use store_file_id/fetch_fileid methods rather than direct access.)
 
+        # Work out the inventories to keep for later merges
+        self._merge_counts = {}
+        if info is not None:
+            try:
+                merges = info['Merges']
+            except KeyError:
+                # info not in file - possible when there are no merges
+                pass
+            else:
+                for committish, count in merges.items():
+                    self._merge_counts[committish] = int(count)
+
         # Work out the blobs to make sticky - None means all
         self._blob_ref_counts = {}
         if info is not None:
@@ -124,6 +728,62 @@ class CacheManager(object):
         assert mark[0] != ':'
         self.marks[mark] = commit_id
 
+    def pin_merged_inventory(self, commit_id, revision_id):
+        """Keep the inventory of a commit for the commits that merge it.
+
+        :param commit_id: the commit-id of the commit
+        :param revision_id: the revision-id the commit is imported as
+        """
+        count = self._merge_counts.pop(commit_id, None)
+        if count:
+            self.inventories.pin(revision_id, count)
+
+    def release_merged_inventories(self, committishes):
+        """Release the inventories kept for the commits merged by a commit.
+
+        :param committishes: the commits merged, as "committish" strings
+        """
+        for committish in committishes:
+            revision_id = self.marks.get(committish[1:])
+            if revision_id is not None:
+                self.inventories.unpin(revision_id)
+
+    def take_path_index(self, revision_id, inv):
+        """Take a copy of the index of the paths in a revision.
+
+        The copy is expected to be updated for a new revision and kept
+        for that with keep_path_index. The index kept for the revision
+        is left alone, for other revisions built on it.
+
+        :param revision_id: the revision-id or None for an empty tree
+        :param inv: the inventory of the revision, to look paths up in
+            if there is no index kept for the revision
+        """
+        index = self._path_indexes.get(revision_id)
+        if index is not None:
+            return index.copy()
+        if revision_id is None:
+            return PathIndex()
+        return PathIndex(inv)
+
+    def keep_path_index(self, revision_id, index):
+        """Keep the index of the paths in a revision.
+
+        The indexes of the oldest revisions are dropped to keep within
+        the bounds of the count and estimated size of the indexes. If the
+        index is too big on its own, the paths in it are forgotten.
+        """
+        if index.memory_footprint() > self._path_index_size:
+            index.clear()
+        self._path_indexes.pop(revision_id, None)
+        self._path_indexes[revision_id] = index
+        size = sum([i.memory_footprint()
+            for i in self._path_indexes.itervalues()])
+        while (len(self._path_indexes) > self._path_index_count or
+            size > self._path_index_size):
+            revision_id, index = self._path_indexes.popitem(last=False)
+            size -= index.memory_footprint()
+
     def lookup_committish(self, committish):
         """Resolve a 'committish' to a revision id.
 
@@ -131,14 +791,26 @@ class CacheManager(object):
         :return: Bazaar revision id
         """
         assert committish[0] == ':'
-        return self.marks[committish.lstrip(':')]
+        return self.marks[committish[1:]]
 
     def dump_stats(self, note=trace.note):
         """Dump some statistics about what we cached."""
-        # TODO: add in inventory stastistics
         note("Cache statistics:")
         self._show_stats_for(self._sticky_blobs, "sticky blobs", note=note)
-        self._show_stats_for(self.marks, "revision-ids", note=note)
+        if self._blob_compression_level:
+            self._show_stats_for(self._compressed_blobs, "compressed",
+                note=note)
+        if isinstance(self.marks, MarkTable):
+            self._show_size("revision-ids", self.marks.memory_footprint(),
+                len(self.marks), note=note)
+        else:
+            self._show_stats_for(self.marks, "revision-ids", note=note)
+        inventories = self.inventories
+        self._show_size("inventories", inventories.size(), len(inventories),
+            note=note)
+        note("    %-12s: %d hits, %d misses, %d evictions, %d pinned" % ("",
+            inventories.hits, inventories.misses, inventories.evictions,
+            inventories.pinned_count()))
         # These aren't interesting so omit from the output, at least for now
         #self._show_stats_for(self._blobs, "other blobs", note=note)
         #self.reftracker.dump_stats(note=note)
@@ -154,6 +826,10 @@ class CacheManager(object):
         else:
             size = sum(map(len, dict.keys()))
         size += sum(map(len, dict.values()))
+        self._show_size(label, size, count, note=note)
+
+    def _show_size(self, label, size, count, note=trace.note):
+        """Dump the size in bytes and number of items of a cache."""
         size = size * 1.0 / 1024
         unit = 'K'
         if size > 1024:
@@ -169,60 +845,95 @@ class CacheManager(object):
         """Free up any memory used by the caches."""
         self._blobs.clear()
         self._sticky_blobs.clear()
+        self._compressed_blobs.clear()
+        self._checkpoint_blob_ids.clear()
         self.marks.clear()
         self.reftracker.clear()
         self.inventories.clear()
+        self._path_indexes.clear()
 
     def _flush_blobs_to_disk(self):
         blobs = self._sticky_blobs.keys()
         sticky_blobs = self._sticky_blobs
         total_blobs = len(sticky_blobs)
         blobs.sort(key=lambda k:len(sticky_blobs[k]))
-        if self._tempdir is None:
-            tempdir = tempfile.mkdtemp(prefix='fastimport_blobs-')
-            self._tempdir = tempdir
-            self._cleanup.tempdir = self._tempdir
-            self._cleanup.small_blobs = tempfile.TemporaryFile(
-                prefix='small-blobs-', dir=self._tempdir)
-            small_blob_ref = weakref.ref(self._cleanup.small_blobs)
-            # Even though we add it to _Cleanup it seems that the object can be
-            # destroyed 'too late' for cleanup to actually occur. Probably a
-            # combination of bzr's "die directly, don't clean up" and how
-            # exceptions close the running stack.
-            def exit_cleanup():
-                small_blob = small_blob_ref()
-                if small_blob is not None:
-                    small_blob.close()
-                shutil.rmtree(tempdir, ignore_errors=True)
-            atexit.register(exit_cleanup)
         count = 0
         bytes = 0
-        n_small_bytes = 0
+        compressed_count = 0
+        compressed_bytes = 0
         while self._sticky_memory_bytes > self._sticky_flushed_size:
             id = blobs.pop()
             blob = self._sticky_blobs.pop(id)
             n_bytes = len(blob)
             self._sticky_memory_bytes -= n_bytes
-            if n_bytes < self._small_blob_threshold:
-                f = self._cleanup.small_blobs
-                f.seek(0, os.SEEK_END)
-                self._disk_blobs[id] = (f.tell(), n_bytes, None)
-                f.write(blob)
-                n_small_bytes += n_bytes
-            else:
-                fd, name = tempfile.mkstemp(prefix='blob-', dir=self._tempdir)
-                os.write(fd, blob)
-                os.close(fd)
-                self._disk_blobs[id] = (0, n_bytes, name)
+            if (self._blob_compression_level and self._compressed_memory_bytes
+                < self._compressed_cache_size):
+                compressed = zlib.compress(blob, self._blob_compression_level)
+                if (len(compressed) < n_bytes and
+                    self._compressed_memory_bytes + len(compressed)
+                    <= self._compressed_cache_size):
+                    self._compressed_blobs[id] = compressed
+                    self._compressed_memory_bytes += len(compressed)
+                    compressed_bytes += n_bytes
+                    compressed_count += 1
+                    continue
+            self._disk_blobs[id] = (self._get_arena().add(blob), n_bytes)
             bytes += n_bytes
             del blob
             count += 1
-        trace.note('flushed %d/%d blobs w/ %.1fMB (%.1fMB small) to disk'
+        if compressed_count:
+            trace.note('compressed %d/%d blobs w/ %.1fMB to %.1fMB in memory'
+                   % (compressed_count, total_blobs,
+                      compressed_bytes / 1024. / 1024,
+                      self._compressed_memory_bytes / 1024. / 1024))
+        if count:
+            trace.note('flushed %d/%d blobs w/ %.1fMB to disk (%.1fMB in use)'
                    % (count, total_blobs, bytes / 1024. / 1024,
-                      n_small_bytes / 1024. / 1024))
+                      self._arena.size() / 1024. / 1024))
+
+    def _get_arena(self):
+        """Get the arena for blobs written to disk, creating it if needed."""
+        if self._arena is None:
+            self._arena = BlobArena()
+            self._cleanup.arena = self._arena
+            arena_ref = weakref.ref(self._arena)
+            # Even though we add it to _Cleanup it seems that the object can be
+            # destroyed 'too late' for cleanup to actually occur. Probably a
+            # combination of bzr's "die directly, don't clean up" and how
+            # exceptions close the running stack.
+            def exit_cleanup():
+                arena = arena_ref()
+                if arena is not None:
+                    arena.close()
+            atexit.register(exit_cleanup)
+        return self._arena
+
+    def checkpoint_blobs(self):
+        """Find the changes to the blobs held since the last checkpoint.
+
+        :return: an iterator over the (id, data) of the blobs stored since
+            the last checkpoint and a list of the ids of those dropped
+        """
+        held = set(self._blobs)
+        held.update(self._sticky_blobs, self._compressed_blobs,
+            self._disk_blobs)
+        added = held.difference(self._checkpoint_blob_ids)
+        removed = list(self._checkpoint_blob_ids.difference(held))
+        self._checkpoint_blob_ids = held
+        return ((id, self._get_blob(id)) for id in added), removed
+
+    def restore_blobs(self, blobs):
+        """Store the blobs held at a checkpoint.
+
+        :param blobs: an iterable of (id, data) pairs
+        """
+        for id, data in blobs:
+            self.store_blob(id, data)
+            self._checkpoint_blob_ids.add(id)
 
     def store_blob(self, id, data):
         """Store a blob of data."""
+        self._checkpoint_blob_ids.discard(id)
         # Note: If we're not reference counting, everything has to be sticky
         if not self._blob_ref_counts or id in self._blob_ref_counts:
             self._sticky_blobs[id] = data
@@ -235,7 +946,7 @@ class CacheManager(object):
         else:
             self._blobs[id] = data
 
-    def _decref(self, id, cache, fn):
+    def _decref(self, id, cache):
         if not self._blob_ref_counts:
             return False
         count = self._blob_ref_counts.get(id, None)
@@ -243,34 +954,40 @@ class CacheManager(object):
             count -= 1
             if count <= 0:
                 del cache[id]
-                if fn is not None:
-                    os.unlink(fn)
                 del self._blob_ref_counts[id]
                 return True
             else:
                 self._blob_ref_counts[id] = count
         return False
 
+    def _get_blob(self, id):
+        """Get a blob of data without counting it as used."""
+        if id in self._blobs:
+            return self._blobs[id]
+        if id in self._disk_blobs:
+            (offset, n_bytes) = self._disk_blobs[id]
+            return self._arena.get(offset, n_bytes)
+        if id in self._compressed_blobs:
+            return zlib.decompress(self._compressed_blobs[id])
+        return self._sticky_blobs[id]
+
     def fetch_blob(self, id):
         """Fetch a blob of data."""
         if id in self._blobs:
             return self._blobs.pop(id)
         if id in self._disk_blobs:
-            (offset, n_bytes, fn) = self._disk_blobs[id]
-            if fn is None:
-                f = self._cleanup.small_blobs
-                f.seek(offset)
-                content = f.read(n_bytes)
-            else:
-                fp = open(fn, 'rb')
-                try:
-                    content = fp.read()
-                finally:
-                    fp.close()
-            self._decref(id, self._disk_blobs, fn)
+            (offset, n_bytes) = self._disk_blobs[id]
+            content = self._arena.get(offset, n_bytes)
+            if self._decref(id, self._disk_blobs):
+                self._arena.free(offset, n_bytes)
             return content
+        if id in self._compressed_blobs:
+            compressed = self._compressed_blobs[id]
+            if self._decref(id, self._compressed_blobs):
+                self._compressed_memory_bytes -= len(compressed)
+            return zlib.decompress(compressed)
         content = self._sticky_blobs[id]
-        if self._decref(id, self._sticky_blobs, None):
+        if self._decref(id, self._sticky_blobs):
             self._sticky_memory_bytes -= len(content)
         return content
 
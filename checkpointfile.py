@@ -0,0 +1,235 @@
+# Copyright (C) 2008 Canonical Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Routines for saving and loading the checkpoint file.
+
+The checkpoint file records the state of the import at the last
+checkpoint, so a restarted import can continue from there without
+replaying the commands before it, and where in the import stream the
+checkpoint was taken, so those commands need not even be read again.
+
+The blobs held for later commits at a checkpoint are recorded in a
+second file, named after the checkpoint file with '-blobs' appended.
+At each checkpoint the blobs stored and dropped since the previous one
+are appended to it, as records of the form:
+
+ * 'add <id length> <data length>\n' followed by the id and the data
+ * 'drop <id length>\n' followed by the id
+"""
+
+import os
+
+from bzrlib import bencode, osutils
+
+
+def save_checkpoint(filename, state):
+    """Save the state at a checkpoint to a file.
+
+    The state is written to a temporary file which is synced to disk and
+    then renamed over filename.
+
+    :param filename: name of the file to save the data to
+    :param state: a dictionary with the keys:
+      * revisions - the number of commits imported so far
+      * last_ref, last_ids and heads - the state of the RefTracker
+      * tags - a dictionary of tag names to revision-ids
+      * blobs - the length of the blobs file saved by save_blobs()
+      * position - None if the stream cannot be repositioned, or a
+        dictionary with the keys:
+        * source - the (size, mtime) of the stream being imported
+        * offset - the offset in the stream of the next command
+        * lineno - the line number of the next command
+        * features - a dictionary of the features declared by the stream
+    """
+    tmp_filename = filename + '.tmp'
+    f = open(tmp_filename, 'wb')
+    try:
+        f.write(bencode.bencode(_encode_state(state)))
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    osutils.rename(tmp_filename, filename)
+
+
+def load_checkpoint(filename):
+    """Load the state at a checkpoint from a file.
+
+    :param filename: name of the file to load the data from
+    :return: the state passed to save_checkpoint or None if the file
+      does not exist or cannot be decoded
+    """
+    if not os.path.exists(filename):
+        return None
+    f = open(filename, 'rb')
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    try:
+        return _decode_state(bencode.bdecode(data))
+    except (ValueError, TypeError, KeyError):
+        return None
+
+
+def remove_checkpoint(filename):
+    """Remove the checkpoint file and its blobs file, if any."""
+    for name in [filename, _blobs_filename(filename)]:
+        try:
+            os.remove(name)
+        except OSError:
+            pass
+
+
+def save_blobs(filename, length, added, removed):
+    """Record the changes to the blobs held since the previous checkpoint.
+
+    :param filename: name of the checkpoint file
+    :param length: the length of the blobs file at the previous
+      checkpoint. Anything after that is left over from an interrupted
+      import and is discarded.
+    :param added: an iterable of the (id, data) of the blobs stored
+    :param removed: an iterable of the ids of the blobs dropped
+    :return: the new length of the blobs file
+    """
+    if length:
+        f = open(_blobs_filename(filename), 'r+b')
+    else:
+        f = open(_blobs_filename(filename), 'wb')
+    try:
+        f.truncate(length)
+        f.seek(length)
+        for id in removed:
+            f.write('drop %d\n' % (len(id),))
+            f.write(id)
+        for id, data in added:
+            f.write('add %d %d\n' % (len(id), len(data)))
+            f.write(id)
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+        return f.tell()
+    finally:
+        f.close()
+
+
+def load_blobs(filename, length):
+    """Load the blobs held at a checkpoint.
+
+    :param filename: name of the checkpoint file
+    :param length: the length of the blobs file saved with the checkpoint
+    :return: None if the blobs file does not match the checkpoint or an
+      iterator over the (id, data) of the blobs
+    """
+    try:
+        f = open(_blobs_filename(filename), 'rb')
+    except IOError:
+        if length:
+            return None
+        return iter([])
+    # Find where the latest text of each blob still held is, so only
+    # those are read in
+    offsets = {}
+    try:
+        while f.tell() < length:
+            header = f.readline().split(' ')
+            id = f.read(int(header[1]))
+            if header[0] == 'add':
+                offsets[id] = (f.tell(), int(header[2]))
+                f.seek(int(header[2]), 1)
+            elif header[0] == 'drop':
+                offsets.pop(id, None)
+            else:
+                raise ValueError(header[0])
+    except (ValueError, IndexError):
+        f.close()
+        return None
+    if f.tell() != length:
+        f.close()
+        return None
+    return _iter_blobs(f, offsets)
+
+
+def _iter_blobs(f, offsets):
+    try:
+        for id, (offset, length) in sorted(offsets.iteritems(),
+            key=lambda item: item[1]):
+            f.seek(offset)
+            yield id, f.read(length)
+    finally:
+        f.close()
+
+
+def _blobs_filename(filename):
+    return filename + '-blobs'
+
+
+def _optional(value):
+    # bencode has no None, so optional values are stored as lists
+    if value is None:
+        return []
+    return [value]
+
+
+def _from_optional(value):
+    if value:
+        return value[0]
+    return None
+
+
+def _encode_state(state):
+    position = state['position']
+    if position is not None:
+        position = {
+            'source': list(position['source']),
+            'offset': position['offset'],
+            'lineno': position['lineno'],
+            'features': dict((name, _optional(value))
+                for name, value in position['features'].iteritems()),
+            }
+    return {
+        'revisions': state['revisions'],
+        'last_ref': _optional(state['last_ref']),
+        'last_ids': state['last_ids'],
+        'heads': dict((cmd_id, sorted(refs))
+            for cmd_id, refs in state['heads'].iteritems()),
+        'tags': dict((name.encode('utf-8'), revid)
+            for name, revid in state['tags'].iteritems()),
+        'blobs': state['blobs'],
+        'position': _optional(position),
+        }
+
+
+def _decode_state(data):
+    position = _from_optional(data['position'])
+    if position is not None:
+        position = {
+            'source': tuple(position['source']),
+            'offset': position['offset'],
+            'lineno': position['lineno'],
+            'features': dict((name, _from_optional(value))
+                for name, value in position['features'].iteritems()),
+            }
+    return {
+        'revisions': data['revisions'],
+        'last_ref': _from_optional(data['last_ref']),
+        'last_ids': data['last_ids'],
+        'heads': dict((cmd_id, set(refs))
+            for cmd_id, refs in data['heads'].iteritems()),
+        'tags': dict((name.decode('utf-8'), revid)
+            for name, revid in data['tags'].iteritems()),
+        'blobs': data['blobs'],
+        'position': position,
+        }
@@ -38,6 +38,9 @@ def _run(source, processor_factory, verbose=False, user_map=None, **kwargs):
     user_mapper = _get_user_mapper(user_map)
     proc = processor_factory(verbose=verbose, **kwargs)
     p = parser.ImportParser(stream, verbose=verbose, user_mapper=user_mapper)
+    set_parser = getattr(proc, 'set_parser', None)
+    if set_parser is not None:
+        set_parser(p)
     try:
         return proc.process(p.iter_commands)
     except ParsingError, e:
@@ -200,6 +203,14 @@ class cmd_fast_import(Command):
      If and when Bazaar is used to manage the repository, this file
      can be safely deleted.
 
+     The state of the import (the heads of each branch and the tags)
+     is also saved at checkpoints, to a file called
+     'fastimport-checkpoint', so the revisions already loaded are
+     skipped without being processed again. When the source is a file,
+     the position in the file is saved too and, if the import is
+     restarted with the same file, it seeks straight to the last
+     checkpoint instead of reading through the commands before it.
+
     :Examples:
 
      Import a Subversion repository into Bazaar::
@@ -256,6 +267,18 @@ class cmd_fast_import(Command):
                     Option('inv-cache', type=int,
                         help="Number of inventories to cache.",
                         ),
+                    Option('inv-cache-size', type=int,
+                        help="Megabytes of inventories to cache."
+                             " The default is 128.",
+                        ),
+                    Option('blob-compression', type=int,
+                        help="Compress blobs kept in memory at this zlib"
+                             " level (1-9) before writing them to disk.",
+                        ),
+                    Option('compressed-blob-cache', type=int,
+                        help="Megabytes of compressed blobs to keep in"
+                             " memory. The default is 100.",
+                        ),
                     RegistryOption.from_kwargs('mode',
                         'The import algorithm to use.',
                         title='Import Algorithm',
@@ -270,6 +293,9 @@ class cmd_fast_import(Command):
                     Option('export-marks', type=str,
                         help="Export marks to file."
                         ),
+                    Option('binary-marks',
+                        help="Export marks in the binary format."
+                        ),
                     RegistryOption('format',
                             help='Specify a format for the created repository. See'
                                  ' "bzr help formats" for details.',
@@ -280,7 +306,8 @@ class cmd_fast_import(Command):
     def run(self, source, destination='.', verbose=False, info=None,
         trees=False, count=-1, checkpoint=10000, autopack=4, inv_cache=-1,
         mode=None, import_marks=None, export_marks=None, format=None,
-        user_map=None):
+        user_map=None, binary_marks=False, inv_cache_size=None,
+        blob_compression=None, compressed_blob_cache=None):
         load_fastimport()
         from bzrlib.plugins.fastimport.processors import generic_processor
         from bzrlib.plugins.fastimport.helpers import (
@@ -303,9 +330,13 @@ class cmd_fast_import(Command):
             'checkpoint': checkpoint,
             'autopack': autopack,
             'inv-cache': inv_cache,
+            'inv-cache-size': inv_cache_size,
+            'blob-compression': blob_compression,
+            'compressed-blob-cache': compressed_blob_cache,
             'mode': mode,
             'import-marks': import_marks,
             'export-marks': export_marks,
+            'binary-marks': binary_marks,
             }
         return _run(source, generic_processor.GenericProcessor,
                 bzrdir=control, params=params, verbose=verbose,
@@ -573,7 +604,8 @@ class cmd_fast_export(Command):
     If no destination is given or the destination is '-', standard output
     is used. Otherwise, the destination is the name of a file. If the
     destination ends in '.gz', the output will be compressed into gzip
-    format.
+    format, using a thread per CPU. If it ends in '.bz2', the output
+    will be compressed into bzip2 format on a background thread.
 
     :Round-tripping:
 
@@ -628,6 +660,35 @@ class cmd_fast_export(Command):
      the first requested revision.  This allows a user to produce a tree
      identical to the original without munging multiple exports.
 
+    :Blob deduplication:
+
+     By default, the full text of every changed file is included in each
+     commit, even when the same text was exported earlier (e.g. after a
+     revert or a merge). With --dedupe-blobs, each distinct text is
+     output once as a marked blob and later commits refer to that mark.
+     When exporting marks, the blob marks are saved to a file with the
+     same name plus a '.blobs' suffix and reloaded by --import-marks.
+
+    :Parallel export:
+
+     Most of the time taken by fast-export goes on working out what
+     changed in each revision. With --jobs=N, the revisions are split
+     into contiguous ranges and the changes are calculated by N worker
+     processes, each with its own read lock on the repository. The
+     output is identical to that of a single process export. This
+     option cannot be combined with --dedupe-blobs.
+
+    :Binary marks:
+
+     Marks files normally hold one ':mark revision-id' line per mark and
+     are read into memory in full. With --binary-marks, the exported
+     marks are written in a compact binary format instead, which is
+     memory-mapped and searched in place when it is next imported. The
+     format of a marks file is detected automatically, so an existing
+     text marks file can be converted by exporting with --marks and
+     --binary-marks. Binary marks files are only understood by the
+     Bazaar fast-import and fast-export commands.
+
     :Examples:
 
      To produce data destined for import into Bazaar::
@@ -648,6 +709,14 @@ class cmd_fast_export(Command):
        bzr fast-export --import-marks=marks.bzr -b other project.other |
               GIT_DIR=project/.git git-fast-import --import-marks=marks.git
 
+     To keep a mirror up to date, export just the revisions added since
+     the last run. With --incremental, only the history not reachable
+     from already marked revisions is examined::
+
+       bzr fast-export --marks=marks.bzr --incremental project.dev |
+              GIT_DIR=project/.git git-fast-import --export-marks=marks.git \\
+              --import-marks-if-exists=marks.git
+
      If you get a "Missing space after source" error from git-fast-import,
      see the top of the commands.py module for a work-around.
     """
@@ -682,12 +751,33 @@ class cmd_fast_export(Command):
                         help="Export an 'absolute' baseline commit prior to"
                              "the first relative commit",
                         ),
+                    Option('dedupe-blobs',
+                        help="Output file texts as blobs and refer back to"
+                             " them when the same text is seen again.",
+                        ),
+                    Option('jobs', type=int, argname='N',
+                        help="Calculate file changes in N worker processes"
+                             " (default=1).",
+                        ),
+                    Option('tree-cache', type=int, argname='N',
+                        help="Number of revision trees to cache"
+                             " (default=10).",
+                        ),
+                    Option('incremental',
+                        help="Only walk the history not covered by the"
+                             " imported marks.",
+                        ),
+                    Option('binary-marks',
+                        help="Export marks in the binary format.",
+                        ),
                      ]
     encoding_type = 'exact'
     def run(self, source=None, destination=None, verbose=False,
         git_branch="master", checkpoint=10000, marks=None,
         import_marks=None, export_marks=None, revision=None,
-        plain=True, rewrite_tag_names=False, baseline=False):
+        plain=True, rewrite_tag_names=False, baseline=False,
+        dedupe_blobs=False, jobs=1, tree_cache=10, incremental=False,
+        binary_marks=False):
         load_fastimport()
         from bzrlib.branch import Branch
         from bzrlib.plugins.fastimport import exporter
@@ -704,5 +794,11 @@ class cmd_fast_export(Command):
             outf=outf, ref="refs/heads/%s" % git_branch, checkpoint=checkpoint,
             import_marks_file=import_marks, export_marks_file=export_marks,
             revision=revision, verbose=verbose, plain_format=plain,
-            rewrite_tags=rewrite_tag_names, baseline=baseline)
-        return exporter.run()
+            rewrite_tags=rewrite_tag_names, baseline=baseline,
+            dedupe_blobs=dedupe_blobs, jobs=jobs, tree_cache_size=tree_cache,
+            incremental=incremental, binary_marks=binary_marks)
+        try:
+            return exporter.run()
+        finally:
+            if destination is not None and destination != '-':
+                outf.close()
@@ -45,17 +45,22 @@
 # is not updated (because the parent of commit is already merged, so we don't
 # set new_git_branch to the previously used name)
 
+from collections import deque
 from email.Utils import parseaddr
-import sys, time, re
+import os, struct, sys, tempfile, time, re, zlib
 
 import bzrlib.branch
 import bzrlib.revision
 from bzrlib import (
     builtins,
+    delta,
     errors as bazErrors,
+    inventory,
+    lru_cache,
     osutils,
     progress,
     trace,
+    tsort,
     )
 
 from bzrlib.plugins.fastimport import (
@@ -70,15 +75,257 @@ from fastimport.helpers import (
     )
 
 
+# How many revisions to look ahead when bulk loading file texts
+_DEFAULT_PREFETCH_WINDOW = 100
+
+# The most text (in bytes) to hold in the prefetch buffer at once
+_PREFETCH_BUDGET = 64*1024*1024
+
+# How many revision trees to cache
+_DEFAULT_TREE_CACHE_SIZE = 10
+
+# How many (revision-id, path) -> is-empty-directory answers to cache
+_EMPTY_DIR_CACHE_SIZE = 1000
+
+# How many revisions a worker process handles at a time when exporting
+# with several jobs
+_SHARD_SIZE = 250
+
+# How many shards per job may be handed out ahead of the one being output
+_SHARDS_PER_JOB = 2
+
+
+# How much output to gather before writing it out
+_DEFAULT_BUFFER_SIZE = 1024*1024
+
+# Compressed output is produced in blocks of this many bytes
+_COMPRESS_BLOCK_SIZE = 1024*1024
+
+# gzip member header: magic, deflate, no flags, no mtime, max compression,
+# unknown OS
+_GZIP_HEADER = '\037\213\010\000\000\000\000\000\002\377'
+
+
 def _get_output_stream(destination):
     if destination is None or destination == '-':
         return binary_stream(sys.stdout)
     elif destination.endswith('gz'):
-        import gzip
-        return gzip.open(destination, 'wb')
+        return _PipelinedWriter(open(destination, 'wb'), _gzip_member,
+            threads=osutils.local_concurrency())
+    elif destination.endswith('.bz2'):
+        import bz2
+        compressor = bz2.BZ2Compressor(9)
+        # A single compressor has to see the blocks in order
+        return _PipelinedWriter(open(destination, 'wb'), compressor.compress,
+            finish=compressor.flush, threads=1)
     else:
         return open(destination, 'wb')
 
+
+def _gzip_member(data):
+    """Compress data into a complete gzip member.
+
+    A gzip file may consist of several members one after the other, so
+    blocks compressed independently can simply be concatenated.
+    """
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return ''.join([_GZIP_HEADER, compressor.compress(data),
+        compressor.flush(),
+        struct.pack('<LL', zlib.crc32(data) & 0xffffffffL,
+            len(data) & 0xffffffffL)])
+
+
+class _PipelinedWriter(object):
+    """A file-like object compressing its output on background threads.
+
+    Written data is gathered into blocks which are passed to a pool of
+    threads to compress while the caller carries on generating output.
+    Compressed blocks are written out in order. The number of blocks
+    in flight is bounded so memory use stays constant.
+    """
+
+    def __init__(self, outf, compress, finish=None, threads=1):
+        """Create a writer.
+
+        :param outf: the file to write compressed data to
+        :param compress: a callable compressing a block of data
+        :param finish: if not None, a callable returning any data still
+            to be written once all blocks are compressed
+        :param threads: the number of compression threads
+        """
+        from multiprocessing.pool import ThreadPool
+        self._outf = outf
+        self._compress = compress
+        self._finish = finish
+        self._pool = ThreadPool(threads)
+        self._max_pending = 2 * threads
+        self._pending = deque()
+        self._buffer = []
+        self._buffered = 0
+        self._submitted = False
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= _COMPRESS_BLOCK_SIZE:
+            self._submit()
+
+    def _submit(self):
+        block = ''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        self._submitted = True
+        self._pending.append(self._pool.apply_async(self._compress, (block,)))
+        while len(self._pending) > self._max_pending:
+            self._outf.write(self._pending.popleft().get())
+
+    def _write_pending(self, wait):
+        while self._pending and (wait or self._pending[0].ready()):
+            self._outf.write(self._pending.popleft().get())
+
+    def flush(self):
+        """Write out the blocks compressed so far.
+
+        Data still gathering into a block is kept back, so flushing
+        neither waits for the threads nor starts a small block.
+        """
+        self._write_pending(False)
+        self._outf.flush()
+
+    def close(self):
+        if self._outf is None:
+            return
+        try:
+            # An empty output still needs to be a valid compressed file
+            if self._buffered or not self._submitted:
+                self._submit()
+            self._write_pending(True)
+            if self._finish is not None:
+                self._outf.write(self._finish())
+        finally:
+            self._pool.close()
+            self._pool.join()
+            self._outf.close()
+            self._outf = None
+
+
+class _OutputBuffer(object):
+    """Gather small writes into larger ones.
+
+    Strings smaller than the buffer are held until the buffer fills up
+    and are then written with a single call. Larger strings, typically
+    file texts, are written straight through (after flushing whatever is
+    buffered) so they are never copied.
+    """
+
+    def __init__(self, outf, buffer_size):
+        self._outf = outf
+        self._buffer_size = buffer_size
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, data):
+        if len(data) >= self._buffer_size:
+            self._write_buffer()
+            self._outf.write(data)
+            return
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self._buffer_size:
+            self._write_buffer()
+
+    def _write_buffer(self):
+        if self._buffer:
+            self._outf.write(''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+
+    def flush(self):
+        self._write_buffer()
+        self._outf.flush()
+
+
+def _blob_marks_filename(marks_filename):
+    """Name of the file holding the blob marks for a marks file."""
+    return marks_filename + '.blobs'
+
+
+def _get_inventory(tree):
+    """Get the inventory of a revision tree."""
+    try:
+        return tree.root_inventory
+    except AttributeError:
+        # bzr < 2.6
+        return tree.inventory
+
+
+def _export_shard(args):
+    """Write the file commands for a range of revisions to a temporary file.
+
+    This runs in a worker process when exporting with several jobs.
+
+    :param args: a tuple of (branch location, revision-ids, plain_format,
+        temporary filename)
+    :return: a dictionary mapping each revision-id to a list of
+        (offset, length) pairs, one per file command. Ghosts are omitted.
+    """
+    location, revision_ids, plain_format, filename = args
+    branch = bzrlib.branch.Branch.open(location)
+    outf = open(filename, 'wb')
+    # Offsets are taken from outf so the exporter mustn't buffer
+    exporter = BzrFastExporter(branch, outf, plain_format=plain_format,
+        buffer_size=0)
+    offsets = {}
+    branch.repository.lock_read()
+    try:
+        for revid in exporter._iter_prefetched(revision_ids):
+            try:
+                revobj = exporter._get_revision(revid)
+            except bazErrors.NoSuchRevision:
+                continue
+            if revobj.parent_ids:
+                parent = revobj.parent_ids[0]
+            else:
+                parent = bzrlib.revision.NULL_REVISION
+            cmd_offsets = []
+            for file_cmd in exporter._get_filecommands(parent, revid):
+                start = outf.tell()
+                exporter._write_cmd(file_cmd)
+                cmd_offsets.append((start, outf.tell() - start))
+            offsets[revid] = cmd_offsets
+    finally:
+        branch.repository.unlock()
+        outf.close()
+    return offsets
+
+
+class _SerializedCommand(object):
+    """A command that was already serialized by a worker process."""
+
+    def __init__(self, text):
+        self.text = text
+
+    def __repr__(self):
+        return self.text
+
+
+class _ShardReader(object):
+    """Read back the file commands written by _export_shard()."""
+
+    def __init__(self, filename, offsets):
+        self.filename = filename
+        self.offsets = offsets
+        self._f = open(filename, 'rb')
+
+    def iter_file_cmds(self, revision_id):
+        for offset, length in self.offsets[revision_id]:
+            self._f.seek(offset)
+            yield _SerializedCommand(self._f.read(length))
+
+    def close(self):
+        self._f.close()
+        os.unlink(self.filename)
+
 # from dulwich.repo:
 def check_ref_format(refname):
     """Check if a refname is correctly formatted.
@@ -149,7 +396,10 @@ class BzrFastExporter(object):
     def __init__(self, source, outf, ref=None, checkpoint=-1,
         import_marks_file=None, export_marks_file=None, revision=None,
         verbose=False, plain_format=False, rewrite_tags=False,
-        baseline=False):
+        baseline=False, prefetch_window=_DEFAULT_PREFETCH_WINDOW,
+        dedupe_blobs=False, jobs=1, tree_cache_size=_DEFAULT_TREE_CACHE_SIZE,
+        buffer_size=_DEFAULT_BUFFER_SIZE, incremental=False,
+        binary_marks=False):
         """Export branch data in fast import format.
 
         :param plain_format: if True, 'classic' fast-import format is
@@ -160,9 +410,31 @@ class BzrFastExporter(object):
             will be rewritten to be git-compatible.
             Otherwise tags which aren't valid for git will be skipped if
             plain_format is set.
+        :param prefetch_window: the number of upcoming revisions whose
+            file texts are loaded with a single repository request.
+            If 0, texts are read one file at a time.
+        :param dedupe_blobs: if True, file texts are output as marked
+            blobs and later files with the same text (by SHA-1) refer
+            to the existing blob instead of repeating its content.
+        :param jobs: the number of worker processes used to calculate
+            file changes. If 1, everything is done in this process.
+        :param tree_cache_size: the number of revision trees to cache.
+            With linear history, the tree of one commit is the parent
+            tree of the next one so even a small cache saves rebuilding
+            most trees.
+        :param buffer_size: the number of bytes of output to gather
+            before writing it to outf. If 0, output is not buffered.
+        :param incremental: if True and marks were imported, only the
+            history not reachable from the marked revisions is walked,
+            instead of filtering the full history of the branch.
+        :param binary_marks: if True, the exported marks are written in
+            the binary marks format.
         """
         self.branch = source
-        self.outf = outf
+        if buffer_size > 0:
+            self.outf = _OutputBuffer(outf, buffer_size)
+        else:
+            self.outf = outf
         self.ref = ref
         self.checkpoint = checkpoint
         self.import_marks_file = import_marks_file
@@ -172,6 +444,11 @@ class BzrFastExporter(object):
         self.plain_format = plain_format
         self.rewrite_tags = rewrite_tags
         self.baseline = baseline
+        self.prefetch_window = prefetch_window
+        self.dedupe_blobs = dedupe_blobs
+        self.jobs = jobs
+        self.incremental = incremental
+        self.binary_marks = binary_marks
         self._multi_author_api_available = hasattr(bzrlib.revision.Revision,
             'get_apparent_authors')
         self.properties_to_exclude = ['authors', 'author']
@@ -185,18 +462,48 @@ class BzrFastExporter(object):
         self._start_time = time.time()
         self._commit_total = 0
 
+        # revision-id -> Revision, filled by _prefetch()
+        self._revisions = {}
+        # (file_id, revision_id) -> text, filled by _prefetch_texts()
+        self._texts = {}
+        # The file commands precalculated by a worker process, if any
+        self._shard_reader = None
+
+        # revision-id -> RevisionTree cache
+        if tree_cache_size > 0:
+            self._trees = lru_cache.LRUCache(tree_cache_size)
+        else:
+            self._trees = None
+        self._tree_cache_hits = 0
+        self._tree_cache_misses = 0
+        # (revision-id, path) -> whether path is an empty directory
+        self._empty_dirs = lru_cache.LRUCache(_EMPTY_DIR_CACHE_SIZE)
+
         # Load the marks and initialise things accordingly
         self.revid_to_mark = {}
+        self.sha1_to_mark = {}
         self.branch_names = {}
         if self.import_marks_file:
-            marks_info = marks_file.import_marks(self.import_marks_file)
+            marks_info = marks_file.import_marks(self.import_marks_file,
+                by_revision=True)
             if marks_info is not None:
-                self.revid_to_mark = dict((r, m) for m, r in
-                    marks_info.items())
+                self.revid_to_mark = marks_info
                 # These are no longer included in the marks file
                 #self.branch_names = marks_info[1]
+            # Blob marks are loaded even when not deduplicating blobs
+            # so new marks don't clash with them
+            blob_marks_file = _blob_marks_filename(self.import_marks_file)
+            if os.path.exists(blob_marks_file):
+                blob_marks = marks_file.import_marks(blob_marks_file,
+                    by_revision=True)
+                if blob_marks is not None:
+                    self.sha1_to_mark = blob_marks
+        # The mark to allocate next, after the highest one already used
+        self._mark_counter = self._max_mark() + 1
 
     def interesting_history(self):
+        if self.incremental and self.revid_to_mark and not self.revision:
+            return self._unmarked_history()
         if self.revision:
             rev1, rev2 = builtins._get_revision_range(self.revision,
                 self.branch, "fast-export")
@@ -222,6 +529,46 @@ class BzrFastExporter(object):
                 view_revisions.insert(0, start_rev_id)
         return list(view_revisions)
 
+    def _unmarked_history(self):
+        """Find the revisions not reachable from already marked ones.
+
+        The graph is walked back from the branch tip, stopping at marked
+        revisions, so the cost depends on the amount of new history
+        rather than the size of the whole branch.
+
+        :return: the unmarked revision-ids, in merge sorted order with
+            the oldest first
+        """
+        tip = self.branch.last_revision()
+        if tip == bzrlib.revision.NULL_REVISION or tip in self.revid_to_mark:
+            return []
+        self.note("Calculating the revisions not yet exported ...")
+        graph = self.branch.repository.get_graph()
+        parent_map = {}
+        pending = set([tip])
+        while pending:
+            found = graph.get_parent_map(pending)
+            next_pending = set()
+            for revid in pending:
+                parents = found.get(revid)
+                if parents is None:
+                    # A ghost
+                    continue
+                parents = [p for p in parents
+                    if p != bzrlib.revision.NULL_REVISION]
+                parent_map[revid] = parents
+                next_pending.update(p for p in parents
+                    if p not in self.revid_to_mark)
+            next_pending.difference_update(parent_map)
+            pending = next_pending
+        # Only sort the new part of the graph
+        unmarked_graph = dict((revid, [p for p in parents if p in parent_map])
+            for revid, parents in parent_map.iteritems())
+        view_revisions = [revid for _, revid, _, _ in
+            tsort.merge_sort(unmarked_graph, tip)]
+        view_revisions.reverse()
+        return view_revisions
+
     def run(self):
         # Export the data
         self.branch.repository.lock_read()
@@ -234,10 +581,18 @@ class BzrFastExporter(object):
                 self.emit_features()
             if self.baseline:
                 self.emit_baseline(interesting.pop(0), self.ref)
-            for revid in interesting:
-                self.emit_commit(revid, self.ref)
+            if self.jobs > 1 and self.dedupe_blobs:
+                self.warning("blobs cannot be deduplicated by parallel jobs"
+                    " - exporting in a single process")
+                self.jobs = 1
+            if self.jobs > 1:
+                self._emit_commits_in_parallel(interesting)
+            else:
+                for revid in self._iter_prefetched(interesting):
+                    self.emit_commit(revid, self.ref)
             if self.branch.supports_tags():
                 self.emit_tags()
+            self.outf.flush()
         finally:
             self.branch.repository.unlock()
 
@@ -280,32 +635,221 @@ class BzrFastExporter(object):
         self.note("Exported %d %s in %s",
             rc, single_plural(rc, "revision", "revisions"),
             time_required)
+        if self._trees is not None:
+            self.note("Revision tree cache: %d hits, %d misses",
+                self._tree_cache_hits, self._tree_cache_misses)
 
     def print_cmd(self, cmd):
-        self.outf.write("%r\n" % cmd)
+        self._write_cmd(cmd)
+        self.outf.write("\n")
+
+    def _write_cmd(self, cmd):
+        """Write a command without a trailing newline.
+
+        File texts in blob and file-modify commands are written as
+        separate strings instead of being formatted into the command.
+        """
+        if isinstance(cmd, commands.FileModifyCommand) and cmd.data is not None:
+            self.outf.write(str(cmd))
+            self.outf.write("\ndata %d\n" % len(cmd.data))
+            self.outf.write(cmd.data)
+        elif isinstance(cmd, commands.BlobCommand):
+            if cmd.mark is None:
+                self.outf.write("blob\ndata %d\n" % len(cmd.data))
+            else:
+                self.outf.write("blob\nmark :%s\ndata %d\n" %
+                    (cmd.mark, len(cmd.data)))
+            self.outf.write(cmd.data)
+        else:
+            self.outf.write("%r" % cmd)
+
+    def print_commit(self, cmd):
+        """Output a CommitCommand, streaming its file commands.
+
+        Unlike print_cmd(), the file commands (and the file texts they
+        carry) are written one at a time as they are generated rather
+        than being joined into a single string first.
+        """
+        file_cmds = cmd.iter_files()
+        cmd.file_iter = None
+        self._write_cmd(cmd)
+        for file_cmd in file_cmds:
+            self.outf.write("\n")
+            self._write_cmd(file_cmd)
+        self.outf.write("\n")
 
     def _save_marks(self):
         if self.export_marks_file:
-            revision_ids = dict((m, r) for r, m in self.revid_to_mark.items())
-            marks_file.export_marks(self.export_marks_file, revision_ids)
+            marks_file.export_marks(self.export_marks_file,
+                self.revid_to_mark, binary=self.binary_marks,
+                by_revision=True)
+            if self.sha1_to_mark:
+                marks_file.export_marks(
+                    _blob_marks_filename(self.export_marks_file),
+                    self.sha1_to_mark, binary=self.binary_marks,
+                    by_revision=True)
+
+    def _max_mark(self):
+        """Find the highest of the imported marks, or 0 if there are none."""
+        return max(
+            marks_file.max_mark(self.revid_to_mark, by_revision=True),
+            marks_file.max_mark(self.sha1_to_mark, by_revision=True))
+
+    def _next_mark(self):
+        """Allocate the next mark, shared by commits and blobs."""
+        mark = self._mark_counter
+        self._mark_counter += 1
+        return mark
+
+    def _get_blob_mark(self, tree, file_id):
+        """Get the mark of the blob holding a file's text.
+
+        The blob is output first if no blob with the same text has been
+        output before.
+        """
+        sha1 = tree.get_file_sha1(file_id)
+        mark = self.sha1_to_mark.get(sha1)
+        if mark is None:
+            mark = self._next_mark()
+            self.sha1_to_mark[sha1] = mark
+            self.print_cmd(commands.BlobCommand(str(mark),
+                self._get_file_text(tree, file_id)))
+        return ":%s" % mark
  
+    def _emit_commits_in_parallel(self, revision_ids):
+        """Emit commits, calculating their file commands in worker processes.
+
+        The revisions are split into contiguous shards. Each worker opens
+        the branch itself and writes the file commands for a shard to a
+        temporary file. The shards are consumed in order here, so marks,
+        parents and refs are assigned exactly as in a sequential export.
+        Only a few shards per job are handed out ahead of the one being
+        consumed so the temporary files don't pile up when the output
+        is slow.
+        """
+        import multiprocessing
+        todo = [r for r in revision_ids
+            if r not in self.revid_to_mark and r not in self.excluded_revisions]
+        shards = deque([todo[i:i + _SHARD_SIZE]
+            for i in range(0, len(todo), _SHARD_SIZE)])
+        pool = multiprocessing.Pool(self.jobs)
+        # (shard, temporary filename, result) for the shards handed out
+        # but not yet consumed. The files are created here so they can
+        # be removed even if a worker is terminated while writing one.
+        pending = deque()
+        try:
+            while shards and len(pending) < self.jobs * _SHARDS_PER_JOB:
+                self._submit_shard(pool, shards.popleft(), pending)
+            while pending:
+                shard, filename, result = pending[0]
+                offsets = result.get()
+                pending.popleft()
+                self._shard_reader = _ShardReader(filename, offsets)
+                if shards:
+                    self._submit_shard(pool, shards.popleft(), pending)
+                try:
+                    for revid in shard:
+                        self.emit_commit(revid, self.ref)
+                finally:
+                    self._shard_reader.close()
+                    self._shard_reader = None
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+            for shard, filename, result in pending:
+                os.unlink(filename)
+
+    def _submit_shard(self, pool, shard, pending):
+        """Hand a shard of revisions to a worker process."""
+        fd, filename = tempfile.mkstemp(prefix='fast-export-')
+        os.close(fd)
+        result = pool.apply_async(_export_shard,
+            [(self.branch.base, shard, self.plain_format, filename)])
+        pending.append((shard, filename, result))
+
+    def _iter_prefetched(self, revision_ids):
+        """Iterate over revision_ids, prefetching data for each window."""
+        for i, revid in enumerate(revision_ids):
+            if self.prefetch_window > 0 and i % self.prefetch_window == 0:
+                self._prefetch(revision_ids[i:i + self.prefetch_window])
+            yield revid
+
+    def _prefetch(self, revision_ids):
+        """Load the revisions and texts needed by some upcoming commits."""
+        repo = self.branch.repository
+        revision_ids = [r for r in revision_ids
+            if r not in self.revid_to_mark and r not in self.excluded_revisions]
+        # get_revisions() fails outright on ghosts so leave those
+        # for emit_commit() to detect
+        present = repo.has_revisions(revision_ids)
+        revision_ids = [r for r in revision_ids if r in present]
+        self._revisions = dict((rev.revision_id, rev)
+            for rev in repo.get_revisions(revision_ids))
+        self._prefetch_texts(revision_ids)
+
+    def _get_revision(self, revision_id):
+        """Get a Revision object, preferably from the prefetched ones."""
+        try:
+            return self._revisions.pop(revision_id)
+        except KeyError:
+            return self.branch.repository.get_revision(revision_id)
+
+    def _prefetch_texts(self, revision_ids):
+        """Load the texts introduced by some revisions in one request.
+
+        Reading texts one file at a time means one index lookup and
+        pack read per file. Instead, we ask the repository for all the
+        text keys altered by the next window of revisions at once and
+        keep the results until _get_file_text() asks for them. Texts not
+        found here (e.g. those brought in by merges, or those that didn't
+        fit in _PREFETCH_BUDGET) are read on demand.
+        """
+        self._texts = {}
+        if not revision_ids:
+            return
+        repo = self.branch.repository
+        keys = []
+        for file_id, revs in repo.fileids_altered_by_revision_ids(
+                revision_ids).iteritems():
+            for rev in revs:
+                keys.append((file_id, rev))
+        n_bytes = 0
+        for record in repo.texts.get_record_stream(keys, 'unordered', True):
+            if record.storage_kind == 'absent':
+                continue
+            text = record.get_bytes_as('fulltext')
+            n_bytes += len(text)
+            if n_bytes > _PREFETCH_BUDGET:
+                break
+            self._texts[record.key] = text
+
+    def _get_file_text(self, tree, file_id):
+        """Get the text of a file, preferably from the prefetched texts."""
+        key = (file_id, tree.get_file_revision(file_id))
+        try:
+            return self._texts.pop(key)
+        except KeyError:
+            return tree.get_file_text(file_id)
+
     def is_empty_dir(self, tree, path):
+        key = (tree.get_revision_id(), path)
+        result = self._empty_dirs.get(key)
+        if result is not None:
+            return result
+
         path_id = tree.path2id(path)
         if path_id is None:
             self.warning("Skipping empty_dir detection - no file_id for %s" %
                 (path,))
             return False
 
-        # Continue if path is not a directory
-        if tree.kind(path_id) != 'directory':
-            return False
-
-        # Use treewalk to find the contents of our directory
-        contents = list(tree.walkdirs(prefix=path))[0]
-        if len(contents[1]) == 0:
-            return True
-        else:
-            return False
+        # A directory is empty if its inventory entry has no children.
+        # This only looks at the directory itself, not the whole subtree.
+        ie = _get_inventory(tree)[path_id]
+        result = ie.kind == 'directory' and not ie.children
+        self._empty_dirs[key] = result
+        return result
 
     def emit_features(self):
         for feature in sorted(commands.FEATURE_NAMES):
@@ -314,10 +858,13 @@ class BzrFastExporter(object):
     def emit_baseline(self, revid, ref):
         # Emit a full source tree of the first commit's parent
         revobj = self.branch.repository.get_revision(revid)
-        mark = 1
-        self.revid_to_mark[revid] = mark
         file_cmds = self._get_filecommands(bzrlib.revision.NULL_REVISION, revid)
-        self.print_cmd(self._get_commit_command(ref, mark, revobj, file_cmds))
+        if self.dedupe_blobs:
+            # Output the blobs before the commit that refers to them
+            file_cmds = list(file_cmds)
+        mark = self._next_mark()
+        self.revid_to_mark[revid] = mark
+        self.print_commit(self._get_commit_command(ref, mark, revobj, file_cmds))
 
     def emit_commit(self, revid, ref):
         if revid in self.revid_to_mark or revid in self.excluded_revisions:
@@ -325,7 +872,7 @@ class BzrFastExporter(object):
 
         # Get the Revision object
         try:
-            revobj = self.branch.repository.get_revision(revid)
+            revobj = self._get_revision(revid)
         except bazErrors.NoSuchRevision:
             # This is a ghost revision. Mark it as not found and next!
             self.revid_to_mark[revid] = -1
@@ -350,10 +897,16 @@ class BzrFastExporter(object):
             parent = revobj.parent_ids[0]
 
         # Print the commit
-        mark = ncommits + 1
+        if self._shard_reader is not None:
+            file_cmds = self._shard_reader.iter_file_cmds(revid)
+        else:
+            file_cmds = self._get_filecommands(parent, revid)
+        if self.dedupe_blobs:
+            # Output the blobs before the commit that refers to them
+            file_cmds = list(file_cmds)
+        mark = self._next_mark()
         self.revid_to_mark[revid] = mark
-        file_cmds = self._get_filecommands(parent, revid)
-        self.print_cmd(self._get_commit_command(ref, mark, revobj, file_cmds))
+        self.print_commit(self._get_commit_command(ref, mark, revobj, file_cmds))
 
         # Report progress and checkpoint if it's time for that
         self.report_progress(ncommits)
@@ -363,6 +916,7 @@ class BzrFastExporter(object):
                 % ncommits)
             self._save_marks()
             self.print_cmd(commands.CheckpointCommand())
+            self.outf.flush()
 
     def _get_name_email(self, user):
         if user.find('<') == -1:
@@ -438,30 +992,47 @@ class BzrFastExporter(object):
             committer_info, revobj.message.encode("utf-8"), from_, merges, iter(file_cmds),
             more_authors=more_author_info, properties=properties)
 
+    def _get_revision_tree(self, revision_id):
+        """Get a revision tree, reusing a cached one if possible."""
+        if self._trees is None:
+            return self.branch.repository.revision_tree(revision_id)
+        tree = self._trees.get(revision_id)
+        if tree is None:
+            self._tree_cache_misses += 1
+            tree = self.branch.repository.revision_tree(revision_id)
+            self._trees[revision_id] = tree
+        else:
+            self._tree_cache_hits += 1
+        return tree
+
     def _get_revision_trees(self, parent, revision_id):
         try:
-            tree_old = self.branch.repository.revision_tree(parent)
+            tree_old = self._get_revision_tree(parent)
         except bazErrors.UnexpectedInventoryFormat:
             self.warning("Parent is malformed - diffing against previous parent")
             # We can't find the old parent. Let's diff against his parent
             pp = self.branch.repository.get_revision(parent)
-            tree_old = self.branch.repository.revision_tree(pp.parent_ids[0])
+            tree_old = self._get_revision_tree(pp.parent_ids[0])
         tree_new = None
         try:
-            tree_new = self.branch.repository.revision_tree(revision_id)
+            tree_new = self._get_revision_tree(revision_id)
         except bazErrors.UnexpectedInventoryFormat:
             # We can't really do anything anymore
             self.warning("Revision %s is malformed - skipping" % revision_id)
         return tree_old, tree_new
 
     def _get_filecommands(self, parent, revision_id):
-        """Get the list of FileCommands for the changes between two revisions."""
+        """Iterate over the FileCommands for the changes between two revisions.
+
+        Commands are generated lazily so that only one file text needs
+        to be held in memory at a time.
+        """
         tree_old, tree_new = self._get_revision_trees(parent, revision_id)
         if not(tree_old and tree_new):
             # Something is wrong with this revision - ignore the filecommands
-            return []
+            return
 
-        changes = tree_new.changes_from(tree_old)
+        changes = self._get_changes(tree_old, tree_new)
 
         # Make "modified" have 3-tuples, as added does
         my_modified = [ x[0:3] for x in changes.modified ]
@@ -470,6 +1041,8 @@ class BzrFastExporter(object):
         # Handle it here ...
         file_cmds, rd_modifies, renamed = self._process_renames_and_deletes(
             changes.renamed, changes.removed, revision_id, tree_old)
+        for file_cmd in file_cmds:
+            yield file_cmd
 
         # Map kind changes to a delete followed by an add
         for path, id_, kind1, kind2 in changes.kind_changed:
@@ -477,29 +1050,72 @@ class BzrFastExporter(object):
             # IGC: I don't understand why a delete is needed here.
             # In fact, it seems harmful? If you uncomment this line,
             # please file a bug explaining why you needed to.
-            #file_cmds.append(commands.FileDeleteCommand(path))
+            #yield commands.FileDeleteCommand(path)
             my_modified.append((path, id_, kind2))
 
         # Record modifications
         for path, id_, kind in changes.added + my_modified + rd_modifies:
             if kind == 'file':
-                text = tree_new.get_file_text(id_)
-                file_cmds.append(commands.FileModifyCommand(path.encode("utf-8"),
-                    helpers.kind_to_mode('file', tree_new.is_executable(id_)),
-                    None, text))
+                mode = helpers.kind_to_mode('file', tree_new.is_executable(id_))
+                if self.dedupe_blobs:
+                    yield commands.FileModifyCommand(path.encode("utf-8"),
+                        mode, self._get_blob_mark(tree_new, id_), None)
+                else:
+                    text = self._get_file_text(tree_new, id_)
+                    yield commands.FileModifyCommand(path.encode("utf-8"),
+                        mode, None, text)
             elif kind == 'symlink':
-                file_cmds.append(commands.FileModifyCommand(path.encode("utf-8"),
+                yield commands.FileModifyCommand(path.encode("utf-8"),
                     helpers.kind_to_mode('symlink', False),
-                    None, tree_new.get_symlink_target(id_)))
+                    None, tree_new.get_symlink_target(id_))
             elif kind == 'directory':
                 if not self.plain_format:
-                    file_cmds.append(commands.FileModifyCommand(path.encode("utf-8"),
+                    yield commands.FileModifyCommand(path.encode("utf-8"),
                         helpers.kind_to_mode('directory', False),
-                        None, None))
+                        None, None)
             else:
                 self.warning("cannot export '%s' of kind %s yet - ignoring" %
                     (path, kind))
-        return file_cmds
+
+    def _get_changes(self, tree_old, tree_new):
+        """Get the TreeDelta between two revision trees.
+
+        When both trees have CHK inventories, the delta is built straight
+        from CHKInventory.iter_changes(), which only visits the pages
+        that differ between the two. Otherwise changes_from() is used.
+        """
+        inv_old = _get_inventory(tree_old)
+        inv_new = _get_inventory(tree_new)
+        if not (isinstance(inv_old, inventory.CHKInventory) and
+                isinstance(inv_new, inventory.CHKInventory)):
+            return tree_new.changes_from(tree_old)
+        changes = delta.TreeDelta()
+        for (file_id, paths, text_modified, versioned, parent_id, name, kind,
+                executable) in inv_new.iter_changes(inv_old):
+            if parent_id == (None, None):
+                # The root
+                continue
+            meta_modified = executable[0] != executable[1]
+            if versioned[0] != versioned[1]:
+                if versioned[1]:
+                    changes.added.append((paths[1], file_id, kind[1]))
+                else:
+                    changes.removed.append((paths[0], file_id, kind[0]))
+            elif name[0] != name[1] or parent_id[0] != parent_id[1]:
+                changes.renamed.append((paths[0], paths[1], file_id, kind[1],
+                    text_modified, meta_modified))
+            elif kind[0] != kind[1]:
+                changes.kind_changed.append((paths[1], file_id, kind[0],
+                    kind[1]))
+            elif text_modified or meta_modified:
+                changes.modified.append((paths[1], file_id, kind[1],
+                    text_modified, meta_modified))
+        # Keep the same order as changes_from()
+        changes.added.sort()
+        changes.removed.sort()
+        changes.renamed.sort()
+        changes.modified.sort()
+        return changes
 
     def _process_renames_and_deletes(self, renames, deletes,
         revision_id, tree_old):
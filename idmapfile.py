@@ -13,25 +13,58 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-"""Routines for saving and loading the id-map file."""
+"""Routines for saving and loading the id-map file.
+
+The id-map is a journal: each line maps a commit id to a revision id and
+later lines override earlier ones. New entries are appended at each
+checkpoint and the file is rewritten without the overridden entries
+when they start to dominate it.
+"""
 
 import os
 
+from bzrlib import osutils
+
 
 def save_id_map(filename, revision_ids):
     """Save the mapping of commit ids to revision ids to a file.
 
+    The map is written to a temporary file which is synced to disk and
+    then renamed over filename, so a crash leaves either the old or the
+    new map in place.
+
     Throws the usual exceptions if the file cannot be opened,
     written to or closed.
 
     :param filename: name of the file to save the data to
     :param revision_ids: a dictionary of commit ids to revision ids.
     """
-    f = open(filename, 'wb')
+    tmp_filename = filename + '.tmp'
+    f = open(tmp_filename, 'wb')
     try:
         for commit_id, rev_id in revision_ids.iteritems():
             f.write("%s %s\n" % (commit_id, rev_id))
         f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    osutils.rename(tmp_filename, filename)
+
+
+def append_id_map(filename, entries):
+    """Append entries to the id-map file and sync them to disk.
+
+    Throws the usual exceptions if the file cannot be opened,
+    written to or closed.
+
+    :param filename: name of the file to append the data to
+    :param entries: a sequence of (commit id, revision id) tuples.
+    """
+    f = open(filename, 'ab')
+    try:
+        f.write(''.join(["%s %s\n" % entry for entry in entries]))
+        f.flush()
+        os.fsync(f.fileno())
     finally:
         f.close()
 
@@ -50,15 +83,38 @@ def load_id_map(filename):
       map = a dictionary of commit ids to revision ids;
       count = the number of keys in map
     """
-    result = {}
-    count = 0
+    result, lines = load_id_map_journal(filename)
+    return result, len(result)
+
+
+def load_id_map_journal(filename, result=None):
+    """Load the id-map file, also counting the entries in it.
+
+    A final line without a newline was not completely appended
+    before a crash and is ignored.
+
+    :param filename: name of the file to load the data from
+    :param result: the dictionary-like object to add the entries to.
+      If None, a new dictionary is used.
+    :result: map, lines where:
+      map = the dictionary of commit ids to revision ids;
+      lines = the number of entries in the file, including those
+        overridden by later entries, or None if the file ends with
+        an incomplete entry and must be rewritten before appending
+    """
+    if result is None:
+        result = {}
+    lines = 0
     if os.path.exists(filename):
-        f = open(filename)
+        f = open(filename, 'rb')
         try:
             for line in f:
+                if not line.endswith('\n'):
+                    lines = None
+                    break
                 parts = line[:-1].split(' ', 1)
                 result[parts[0]] = parts[1]
-                count += 1
+                lines += 1
         finally:
             f.close()
-    return result, count
+    return result, lines
@@ -13,31 +13,68 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-"""Routines for reading/writing a marks file."""
+"""Routines for reading/writing a marks file.
 
+Two formats are supported. The text format has one ':mark revision-id'
+line per mark. The binary format starts with BINARY_MARKS_HEADER and is
+laid out so it can be memory-mapped and searched without loading it:
 
+ * the number of marks, as a 64-bit big-endian integer
+ * a record of (mark, offset, length) per mark, sorted by mark
+ * the index of each record, sorted by revision-id
+ * the revision-ids, at the given offsets from the start of this section
+
+Marks must be integers to be stored in the binary format.
+"""
+
+import bisect
+import mmap
+import struct
+
+from bzrlib import osutils
 from bzrlib.trace import warning
 
 
-def import_marks(filename):
+BINARY_MARKS_HEADER = 'bzr-fastimport binary marks 1\n'
+
+_COUNT = struct.Struct('>Q')
+_RECORD = struct.Struct('>qQL')
+_INDEX = struct.Struct('>L')
+
+# The number of bytes of revision-ids copied from a mapped file at a time
+_COPY_SIZE = 1024 * 1024
+
+
+def import_marks(filename, by_revision=False):
     """Read the mapping of marks to revision-ids from a file.
 
+    Binary marks files are memory-mapped rather than read in. Lookups
+    search the file and only marks added afterwards are held in memory.
+
     :param filename: the file to read from
-    :return: None if an error is encountered or a dictionary with marks
-        as keys and revision-ids as values
+    :param by_revision: if True, map revision-ids to marks instead
+    :return: None if an error is encountered or a dictionary-like object
+        with marks as keys and revision-ids as values
     """
     # Check that the file is readable and in the right format
     try:
-        f = file(filename)
+        f = file(filename, 'rb')
     except IOError:
         warning("Could not import marks file %s - not importing marks",
             filename)
         return None
 
+    line = f.readline()
+    if line == BINARY_MARKS_HEADER:
+        marks = BinaryMarks(f)
+        f.close()
+        if by_revision:
+            marks = _RevisionMarks(marks)
+        return LayeredMarks(marks)
+
     # Read the revision info
     revision_ids = {}
 
-    line = f.readline()
     if line == 'format=1\n':
         # Cope with old-style marks files
         # Read the branch info
@@ -56,23 +93,396 @@ def import_marks(filename):
         revision_ids[mark] = revid
         line = f.readline()
     f.close()
+    if by_revision:
+        return dict((r, m) for m, r in revision_ids.iteritems())
     return revision_ids
 
 
-def export_marks(filename, revision_ids):
+def export_marks(filename, revision_ids, binary=False, by_revision=False):
     """Save marks to a file.
 
+    The file is written under a temporary name and renamed into place,
+    so a binary marks file mapped from the same name remains valid.
+
+    When writing the binary format from marks imported by revision from
+    a binary file, only the marks added since are loaded; the rest are
+    copied from the mapped file.
+
     :param filename: filename to save data to
     :param revision_ids: dictionary mapping marks -> bzr revision-ids
+    :param binary: if True, use the binary format
+    :param by_revision: if True, revision_ids maps revision-ids to marks
+        instead
     """
+    base = None
+    if binary and by_revision:
+        base = _binary_base(revision_ids)
+    if base is not None:
+        items = _mark_items(revision_ids._new, by_revision)
+    else:
+        items = _mark_items(revision_ids, by_revision)
+    if binary:
+        try:
+            items = [(int(mark), revid) for mark, revid in items]
+        except ValueError:
+            warning("Marks in %s are not all numbers - "
+                "using the text format", filename)
+            binary = False
+            if base is not None:
+                items = _mark_items(revision_ids, by_revision)
+                base = None
+
+    tmp_filename = filename + '.tmp'
     try:
-        f = file(filename, 'w')
+        f = file(tmp_filename, 'wb')
     except IOError:
         warning("Could not open export-marks file %s - not exporting marks",
             filename)
         return
 
     # Write the revision info
-    for mark, revid in revision_ids.iteritems():
-        f.write(':%s %s\n' % (str(mark).lstrip(':'), revid))
-    f.close()
+    try:
+        if base is not None:
+            _merge_binary_marks(f, base, revision_ids._replaced, items)
+        elif binary:
+            _write_binary_marks(f, items)
+        else:
+            for mark, revid in items:
+                f.write(':%s %s\n' % (mark, revid))
+    finally:
+        f.close()
+    osutils.rename(tmp_filename, filename)
+
+
+def max_mark(marks, by_revision=False):
+    """Find the highest of the numeric marks in a mapping, or 0 if none.
+
+    Only the last record of a binary marks file is read, as the records
+    are sorted by mark. Marks that have been replaced in memory may still
+    be counted.
+
+    :param marks: the mapping of marks to revision-ids
+    :param by_revision: if True, marks maps revision-ids to marks instead
+    """
+    result = 0
+    if isinstance(marks, LayeredMarks):
+        base = marks._base
+        if isinstance(base, _RevisionMarks):
+            base = base._marks
+        if isinstance(base, BinaryMarks):
+            result = max(result, base.max_mark())
+            marks = marks._new
+    if by_revision:
+        found = marks.itervalues()
+    else:
+        found = marks.iterkeys()
+    for mark in found:
+        try:
+            result = max(result, int(mark))
+        except ValueError:
+            # Marks imported from elsewhere needn't be numbers
+            pass
+    return result
+
+
+def _mark_items(revision_ids, by_revision):
+    if by_revision:
+        # Keep the marks in order, as they were when the mapping was
+        # inverted into a dictionary keyed by integer marks
+        return sorted([(str(mark).lstrip(':'), revid)
+            for revid, mark in revision_ids.iteritems()], key=_mark_order)
+    return [(str(mark).lstrip(':'), revid)
+        for mark, revid in revision_ids.iteritems()]
+
+
+def _mark_order(item):
+    mark = item[0]
+    try:
+        return (0, int(mark))
+    except ValueError:
+        return (1, mark)
+
+
+def _binary_base(revision_ids):
+    """Get the binary marks a mapping of revision-ids to marks is over.
+
+    :return: the BinaryMarks, or None if revision_ids isn't layered over
+        a binary marks file
+    """
+    if (isinstance(revision_ids, LayeredMarks) and
+        isinstance(revision_ids._base, _RevisionMarks)):
+        return revision_ids._base._marks
+    return None
+
+
+def _merge_binary_marks(f, base, replaced, items):
+    """Write the marks in a binary marks file plus some new ones.
+
+    The records, index and revision-ids of base are copied across
+    without loading them. The revision-ids of left out records stay in
+    the data section, unreferenced.
+
+    :param base: the BinaryMarks to copy
+    :param replaced: the revision-ids in base to leave out
+    :param items: a list of the (mark, revision-id) pairs to add
+    """
+    dropped = []
+    for revid in replaced:
+        i = base._find_revision(revid)
+        if i is not None:
+            dropped.append(i)
+    dropped.sort()
+    dropped_set = set(dropped)
+    items.sort()
+    new_marks = [mark for mark, revid in items]
+
+    def position(i):
+        # The position of record i of base in the file written. New
+        # records with the same mark come after it.
+        mark = base._record(i)[0]
+        return (i - bisect.bisect_left(dropped, i) +
+            bisect.bisect_left(new_marks, mark))
+
+    f.write(BINARY_MARKS_HEADER)
+    f.write(_COUNT.pack(len(base) - len(dropped) + len(items)))
+
+    # The records, with the new revision-ids after those of base
+    new_positions = []
+    offset = base._data_length()
+    count = 0
+    j = 0
+    for i in xrange(len(base)):
+        record = base._record(i)
+        while j < len(items) and items[j][0] < record[0]:
+            mark, revid = items[j]
+            f.write(_RECORD.pack(mark, offset, len(revid)))
+            offset += len(revid)
+            new_positions.append(count)
+            count += 1
+            j += 1
+        if i in dropped_set:
+            continue
+        f.write(_RECORD.pack(*record))
+        count += 1
+    for mark, revid in items[j:]:
+        f.write(_RECORD.pack(mark, offset, len(revid)))
+        offset += len(revid)
+        new_positions.append(count)
+        count += 1
+
+    # The index, merging that of base with the new revision-ids
+    by_revid = sorted(range(len(items)), key=lambda j: items[j][1])
+    k = 0
+    for n in xrange(len(base)):
+        i = base._index(n)
+        if i in dropped_set:
+            continue
+        revid = base._revision_id(i)
+        while k < len(by_revid) and items[by_revid[k]][1] < revid:
+            f.write(_INDEX.pack(new_positions[by_revid[k]]))
+            k += 1
+        f.write(_INDEX.pack(position(i)))
+    for j in by_revid[k:]:
+        f.write(_INDEX.pack(new_positions[j]))
+
+    base._copy_data(f)
+    for mark, revid in items:
+        f.write(revid)
+
+
+def _write_binary_marks(f, items):
+    items.sort()
+    records = []
+    offset = 0
+    for mark, revid in items:
+        records.append(_RECORD.pack(mark, offset, len(revid)))
+        offset += len(revid)
+    by_revid = sorted(range(len(items)), key=lambda i: items[i][1])
+    f.write(BINARY_MARKS_HEADER)
+    f.write(_COUNT.pack(len(items)))
+    f.write(''.join(records))
+    f.write(''.join([_INDEX.pack(i) for i in by_revid]))
+    f.write(''.join([revid for mark, revid in items]))
+
+
+class BinaryMarks(object):
+    """A read-only mapping of marks to revision-ids in a binary marks file."""
+
+    def __init__(self, f):
+        """Map a binary marks file.
+
+        :param f: the open file, positioned just after the header
+        """
+        self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        start = f.tell()
+        self._count = _COUNT.unpack_from(self._map, start)[0]
+        self._records_start = start + _COUNT.size
+        self._index_start = self._records_start + self._count * _RECORD.size
+        self._data_start = self._index_start + self._count * _INDEX.size
+
+    def __len__(self):
+        return self._count
+
+    def _record(self, i):
+        return _RECORD.unpack_from(self._map,
+            self._records_start + i * _RECORD.size)
+
+    def _revision_id(self, i):
+        mark, offset, length = self._record(i)
+        offset += self._data_start
+        return self._map[offset:offset + length]
+
+    def _find_mark(self, mark):
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._record(mid)[0] < mark:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._count and self._record(lo)[0] == mark:
+            return lo
+        return None
+
+    def get(self, mark, default=None):
+        try:
+            i = self._find_mark(int(mark))
+        except ValueError:
+            return default
+        if i is None:
+            return default
+        return self._revision_id(i)
+
+    def _find_revision(self, revision_id):
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._revision_id(self._index(mid)) < revision_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._count:
+            i = self._index(lo)
+            if self._revision_id(i) == revision_id:
+                return i
+        return None
+
+    def get_mark(self, revision_id, default=None):
+        """Find the mark of a revision-id."""
+        i = self._find_revision(revision_id)
+        if i is None:
+            return default
+        return str(self._record(i)[0])
+
+    def _index(self, n):
+        return _INDEX.unpack_from(self._map,
+            self._index_start + n * _INDEX.size)[0]
+
+    def max_mark(self):
+        """Get the highest mark, or 0 if there are none."""
+        if self._count == 0:
+            return 0
+        return self._record(self._count - 1)[0]
+
+    def _data_length(self):
+        return len(self._map) - self._data_start
+
+    def _copy_data(self, f):
+        """Write the revision-ids section to a file."""
+        for start in xrange(self._data_start, len(self._map), _COPY_SIZE):
+            f.write(self._map[start:start + _COPY_SIZE])
+
+    def iteritems(self):
+        for i in xrange(self._count):
+            yield str(self._record(i)[0]), self._revision_id(i)
+
+
+class _RevisionMarks(object):
+    """A read-only mapping of revision-ids to marks in a binary marks file."""
+
+    def __init__(self, marks):
+        self._marks = marks
+
+    def __len__(self):
+        return len(self._marks)
+
+    def get(self, revision_id, default=None):
+        return self._marks.get_mark(revision_id, default)
+
+    def iteritems(self):
+        for mark, revid in self._marks.iteritems():
+            yield revid, mark
+
+
+class LayeredMarks(object):
+    """A dictionary-like object layered over a read-only mapping.
+
+    Lookups fall through to the read-only mapping. Additions are kept
+    in memory.
+    """
+
+    def __init__(self, base):
+        self._base = base
+        self._new = {}
+        # keys of base that have been replaced in _new
+        self._replaced = set()
+
+    def __len__(self):
+        return len(self._base) + len(self._new) - len(self._replaced)
+
+    def __getitem__(self, key):
+        try:
+            return self._new[key]
+        except KeyError:
+            pass
+        value = self._base.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in self._new or self._base.get(key) is not None
+
+    has_key = __contains__
+
+    def __setitem__(self, key, value):
+        if key not in self._new and self._base.get(key) is not None:
+            self._replaced.add(key)
+        self._new[key] = value
+
+    def iteritems(self):
+        for key, value in self._base.iteritems():
+            if key not in self._replaced:
+                yield key, value
+        for item in self._new.iteritems():
+            yield item
+
+    def items(self):
+        return list(self.iteritems())
+
+    def __iter__(self):
+        for key, value in self.iteritems():
+            yield key
+
+    iterkeys = __iter__
+
+    def keys(self):
+        return list(self)
+
+    def itervalues(self):
+        for key, value in self.iteritems():
+            yield value
+
+    def values(self):
+        return list(self.itervalues())
+
+    def clear(self):
+        self._base = {}
+        self._new.clear()
+        self._replaced.clear()
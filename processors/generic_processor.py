@@ -16,6 +16,8 @@
 """Import processor that supports all Bazaar repository formats."""
 
 
+import os
+import stat
 import time
 from bzrlib import (
     debug,
@@ -40,6 +42,7 @@ except ImportError:
 from bzrlib.plugins.fastimport import (
     branch_updater,
     cache_manager,
+    checkpointfile,
     idmapfile,
     marks_file,
     revision_store,
@@ -65,6 +68,12 @@ _DEFAULT_AUTO_PACK = 4
 _DEFAULT_INV_CACHE_SIZE = 1
 _DEFAULT_CHK_INV_CACHE_SIZE = 1
 
+# How many megabytes of inventories to cache
+_DEFAULT_INV_CACHE_MB = 128
+
+# How many megabytes of compressed blobs to keep in memory
+_DEFAULT_COMPRESSED_BLOB_CACHE_MB = 100
+
 
 class GenericProcessor(processor.ImportProcessor):
     """An import processor that handles basic imports.
@@ -83,6 +92,19 @@ class GenericProcessor(processor.ImportProcessor):
     or is interrupted, it can be started again and this file will be
     used to skip over already loaded revisions. The format of each line
     is "commit-id revision-id" so commit-ids cannot include spaces.
+    Only the entries added since the previous checkpoint are appended
+    to the file, with later lines overriding earlier ones.
+
+    The state of the import (the heads of each ref and the tags) is
+    also saved at checkpoints, to a file called 'fastimport-checkpoint'.
+    On restart, it is loaded so the commands before the checkpoint are
+    skipped without being processed again. When importing from a
+    regular file, the position in the stream is saved too and, if the
+    import is started again with the same file, it seeks straight to
+    the last checkpoint rather than reading through the commands before
+    it. The blobs still to be used by later commits are saved at each
+    checkpoint too, to 'fastimport-checkpoint-blobs', and loaded again
+    when seeking past the commands that defined them.
 
     Here are the supported parameters:
 
@@ -105,14 +127,27 @@ class GenericProcessor(processor.ImportProcessor):
 
     * autopack - pack every n checkpoints. The default is 4.
 
-    * inv-cache - number of inventories to cache.
-      If not set, the default is 1.
+    * inv-cache - number of inventories to cache. If not set, the
+      inventory cache is bounded by inv-cache-size instead.
+
+    * inv-cache-size - estimated size in megabytes of the inventories
+      to cache. The default is 128.
+
+    * blob-compression - zlib compression level (1-9) of blobs kept for
+      later commits when they no longer fit in memory uncompressed.
+      If not set or 0, these blobs are written to disk instead.
+
+    * compressed-blob-cache - size in megabytes of the compressed blobs
+      to keep in memory before writing blobs to disk. The default is 100.
 
     * mode - import algorithm to use: default, experimental or classic.
 
     * import-marks - name of file to read to load mark information from
 
     * export-marks - name of file to write to save mark information to
+
+    * binary-marks - write the export-marks file in the binary format.
+      Marks files in either format are accepted by import-marks.
     """
 
     known_params = [
@@ -122,9 +157,13 @@ class GenericProcessor(processor.ImportProcessor):
         'checkpoint',
         'autopack',
         'inv-cache',
+        'inv-cache-size',
+        'blob-compression',
+        'compressed-blob-cache',
         'mode',
         'import-marks',
         'export-marks',
+        'binary-marks',
         ]
 
     def __init__(self, bzrdir, params=None, verbose=False, outf=None,
@@ -141,6 +180,15 @@ class GenericProcessor(processor.ImportProcessor):
             self.working_tree = None
             self.branch = None
             self.repo = bzrdir.open_repository()
+        self._parser = None
+
+    def set_parser(self, parser):
+        """Set the parser producing the commands.
+
+        This allows the parser to be repositioned when restarting from
+        a checkpoint.
+        """
+        self._parser = parser
 
     def pre_process(self):
         self._start_time = time.time()
@@ -151,11 +199,19 @@ class GenericProcessor(processor.ImportProcessor):
         else:
             self.note("Starting import ...")
         self.cache_mgr = cache_manager.CacheManager(self.info, self.verbose,
-            self.inventory_cache_size)
+            self.inventory_cache_count, self.inventory_cache_bytes,
+            self.blob_compression_level, self.compressed_blob_cache_bytes)
 
+        # Entries added to the id-map since it was last saved, and the
+        # number of entries in the file or None if it must be rewritten
+        self._id_map_pending = []
+        self._id_map_lines = None
         if self.params.get("import-marks") is not None:
             mark_info = marks_file.import_marks(self.params.get("import-marks"))
-            if mark_info is not None:
+            if isinstance(mark_info, dict):
+                self.cache_mgr.marks.update(mark_info)
+            elif mark_info is not None:
+                # Binary marks files are searched in place
                 self.cache_mgr.marks = mark_info
             self.skip_total = False
             self.first_incremental_commit = True
@@ -166,9 +222,16 @@ class GenericProcessor(processor.ImportProcessor):
                 self.note("Found %d commits already loaded - "
                     "skipping over these ...", self.skip_total)
         self._revision_count = 0
+        # Number of commits to skip over because they were imported
+        # before the restored checkpoint
+        self._skip_commit_count = 0
 
         # mapping of tag name to revision_id
         self.tags = {}
+        # the length of the blobs file saved with the last checkpoint
+        self._checkpoint_blobs_length = 0
+        if self.skip_total:
+            self._load_checkpoint()
 
         # Create the revision store to use for committing, if any
         self.rev_store = self._revision_store_factory()
@@ -207,6 +270,8 @@ class GenericProcessor(processor.ImportProcessor):
         # parameters one day if that's needed
         repo_transport = self.repo.control_files._transport
         self.id_map_path = repo_transport.local_abspath("fastimport-id-map")
+        self.checkpoint_path = repo_transport.local_abspath(
+            "fastimport-checkpoint")
 
         # Load the info file, if any
         info_path = self.params.get('info')
@@ -246,11 +311,26 @@ class GenericProcessor(processor.ImportProcessor):
         # Decide how big to make the inventory cache
         cache_size = int(self.params.get('inv-cache', -1))
         if cache_size == -1:
+            self.inventory_cache_count = None
             if self.supports_chk:
                 cache_size = _DEFAULT_CHK_INV_CACHE_SIZE
             else:
                 cache_size = _DEFAULT_INV_CACHE_SIZE
+        else:
+            self.inventory_cache_count = cache_size
         self.inventory_cache_size = cache_size
+        cache_mb = self.params.get('inv-cache-size')
+        if cache_mb is None:
+            cache_mb = _DEFAULT_INV_CACHE_MB
+        self.inventory_cache_bytes = int(cache_mb) * 1024 * 1024
+
+        # Decide whether to compress blobs rather than writing them to disk
+        self.blob_compression_level = int(self.params.get('blob-compression')
+            or 0)
+        cache_mb = self.params.get('compressed-blob-cache')
+        if cache_mb is None:
+            cache_mb = _DEFAULT_COMPRESSED_BLOB_CACHE_MB
+        self.compressed_blob_cache_bytes = int(cache_mb) * 1024 * 1024
 
         # Find the maximum number of commits to import (None means all)
         # and prepare progress reporting. Just in case the info file
@@ -307,7 +387,8 @@ class GenericProcessor(processor.ImportProcessor):
         elif self.repo is not None:
             self.repo.lock_write()
         try:
-            super(GenericProcessor, self)._process(command_iter)
+            super(GenericProcessor, self)._process(
+                lambda: self._iter_unprocessed_commands(command_iter))
         finally:
             # If an unhandled exception occurred, abort the write group
             if self.repo is not None and self.repo.is_in_write_group():
@@ -331,15 +412,18 @@ class GenericProcessor(processor.ImportProcessor):
 
     def post_process(self):
         # Commit the current write group and checkpoint the id map
+        self.rev_store.flush_texts()
         self.repo.commit_write_group()
         self._save_id_map()
 
         if self.params.get("export-marks") is not None:
             marks_file.export_marks(self.params.get("export-marks"),
-                self.cache_mgr.marks)
+                self.cache_mgr.marks,
+                binary=bool(self.params.get("binary-marks")))
 
         if self.cache_mgr.reftracker.last_ref == None:
             """Nothing to refresh"""
+            self._remove_checkpoint()
             return
 
         # Update the branches
@@ -394,6 +478,7 @@ class GenericProcessor(processor.ImportProcessor):
             # how data is stored.
             self.cache_mgr.clear_all()
             self._pack_repository()
+        self._remove_checkpoint()
 
         # Finish up by dumping stats & telling the user what to do next.
         self.dump_stats()
@@ -476,18 +561,172 @@ class GenericProcessor(processor.ImportProcessor):
         # Currently, we just check the size. In the future, we might
         # decide to be more paranoid and check that the revision-ids
         # are identical as well.
-        self.cache_mgr.marks, known = idmapfile.load_id_map(
-            self.id_map_path)
+        self.cache_mgr.marks, self._id_map_lines = \
+            idmapfile.load_id_map_journal(self.id_map_path,
+                self.cache_mgr.marks)
+        known = len(self.cache_mgr.marks)
         existing_count = len(self.repo.all_revision_ids())
         if existing_count < known:
             raise plugin_errors.BadRepositorySize(known, existing_count)
         return known
 
     def _save_id_map(self):
-        """Save the id-map."""
-        # Save the whole lot every time. If this proves a problem, we can
-        # change to 'append just the new ones' at a later time.
-        idmapfile.save_id_map(self.id_map_path, self.cache_mgr.marks)
+        """Save the id-map.
+
+        This must be called after the write group holding the new
+        revisions is committed, so the id-map never refers to revisions
+        that are not in the repository.
+        """
+        marks = self.cache_mgr.marks
+        pending = self._id_map_pending
+        lines = self._id_map_lines
+        # Only append the entries added since the last save, unless most
+        # of the file would be entries for reused commit-ids
+        if lines is None or lines + len(pending) > 2 * len(marks):
+            idmapfile.save_id_map(self.id_map_path, marks)
+            self._id_map_lines = len(marks)
+        elif pending:
+            idmapfile.append_id_map(self.id_map_path, pending)
+            self._id_map_lines = lines + len(pending)
+        self._id_map_pending = []
+
+    def _source_identity(self):
+        """Identify the file being imported.
+
+        :return: the (size, mtime) of the file or None if the stream is
+            not a regular file, e.g. standard input
+        """
+        try:
+            st = os.fstat(self._parser.input.fileno())
+        except (AttributeError, IOError, OSError):
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        return (st.st_size, int(st.st_mtime))
+
+    def _save_checkpoint(self):
+        """Save the state of the import.
+
+        This must be called after the id-map is saved.
+        """
+        reftracker = self.cache_mgr.reftracker
+        position = self._get_stream_position()
+        if position is not None:
+            # Blobs defined before this point are needed to resume here
+            added, removed = self.cache_mgr.checkpoint_blobs()
+            self._checkpoint_blobs_length = checkpointfile.save_blobs(
+                self.checkpoint_path, self._checkpoint_blobs_length,
+                added, removed)
+        checkpointfile.save_checkpoint(self.checkpoint_path, {
+            'revisions': self._revision_count,
+            'last_ref': reftracker.last_ref,
+            'last_ids': reftracker.last_ids,
+            'heads': reftracker.heads,
+            'tags': self.tags,
+            'blobs': self._checkpoint_blobs_length,
+            'position': position,
+            })
+
+    def _remove_checkpoint(self):
+        """Remove the checkpoint once the import has finished.
+
+        A later import of the same source then reads it from the start,
+        skipping the commits already loaded, rather than seeking to a
+        checkpoint that is no longer the last one.
+        """
+        checkpointfile.remove_checkpoint(self.checkpoint_path)
+
+    def _get_stream_position(self):
+        """Get the position to resume the import from after this point.
+
+        :return: the position or None if resuming here is not possible
+        """
+        if self._parser is None:
+            return None
+        source = self._source_identity()
+        if source is None:
+            return None
+        parser = self._parser
+        try:
+            offset = parser.input.tell()
+        except (AttributeError, IOError):
+            return None
+        # Lines pushed back onto the parser have not been processed yet
+        offset -= sum(map(len, parser._buffer))
+        return {
+            'source': source,
+            'offset': offset,
+            'lineno': parser.lineno,
+            'features': parser.features,
+            }
+
+    def _load_checkpoint(self):
+        """Restore the state of the import at the last checkpoint."""
+        state = checkpointfile.load_checkpoint(self.checkpoint_path)
+        if state is None or state['revisions'] != self.skip_total:
+            return
+        reftracker = self.cache_mgr.reftracker
+        reftracker.last_ref = state['last_ref']
+        reftracker.last_ids = state['last_ids']
+        reftracker.heads = state['heads']
+        self.tags = state['tags']
+        self._revision_count = state['revisions']
+        if self._seek_to(state['position'], state['blobs']):
+            self.note("Resuming from the checkpoint after %d commits ...",
+                self._revision_count)
+        else:
+            self._skip_commit_count = self._revision_count
+            # The blobs will be stored again from the stream so the
+            # blobs file is started afresh. Until the next checkpoint,
+            # a restart must read the stream from the start too.
+            checkpointfile.remove_checkpoint(self.checkpoint_path)
+
+    def _seek_to(self, position, blobs_length):
+        """Reposition the parser at a checkpoint, if possible.
+
+        The blobs held at the checkpoint are restored too.
+
+        :return: True if the parser was repositioned
+        """
+        if (position is None or self._parser is None or
+            position['source'] != self._source_identity()):
+            return False
+        blobs = checkpointfile.load_blobs(self.checkpoint_path, blobs_length)
+        if blobs is None:
+            return False
+        parser = self._parser
+        try:
+            parser.input.seek(position['offset'])
+        except (AttributeError, IOError):
+            return False
+        parser.lineno = position['lineno']
+        parser.features.update(position['features'])
+        self.cache_mgr.restore_blobs(blobs)
+        self._checkpoint_blobs_length = blobs_length
+        return True
+
+    def _iter_unprocessed_commands(self, command_iter):
+        """Iterate over the commands, skipping those already processed.
+
+        The commands up to the last commit imported before the restored
+        checkpoint have no effect on the state of the import, except for
+        blobs which may be used by later commits. Commands after that
+        commit may have been processed too but are processed again, as
+        doing so does not change the state.
+        """
+        skipped = 0
+        for cmd in command_iter():
+            if skipped == self._skip_commit_count:
+                yield cmd
+            elif cmd.name == 'commit':
+                # Check that we really do know about this commit-id
+                mark = cmd.id.lstrip(':')
+                if not self.cache_mgr.marks.has_key(mark):
+                    raise plugin_errors.BadRestart(mark)
+                self.cache_mgr._blobs = {}
+                skipped += 1
+            elif cmd.name == 'blob':
+                yield cmd
 
     def blob_handler(self, cmd):
         """Process a BlobCommand."""
@@ -500,8 +739,10 @@ class GenericProcessor(processor.ImportProcessor):
     def checkpoint_handler(self, cmd):
         """Process a CheckpointCommand."""
         # Commit the current write group and start a new one
+        self.rev_store.flush_texts()
         self.repo.commit_write_group()
         self._save_id_map()
+        self._save_checkpoint()
         # track the number of automatic checkpoints done
         if cmd is None:
             self.checkpoint_count += 1
@@ -537,6 +778,7 @@ class GenericProcessor(processor.ImportProcessor):
             print "ABORT: exception occurred processing commit %s" % (cmd.id)
             raise
         self.cache_mgr.add_mark(mark, handler.revision_id)
+        self._id_map_pending.append((mark, handler.revision_id))
         self._revision_count += 1
         self.report_progress("(%s)" % cmd.id.lstrip(':'))
 
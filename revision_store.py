@@ -26,6 +26,7 @@ from bzrlib import (
     osutils,
     revision as _mod_revision,
     trace,
+    versionedfile,
     )
 
 
@@ -215,6 +216,13 @@ class AbstractRevisionStore(object):
         """Get a stored inventory."""
         return self.repo.get_inventory(revision_id)
 
+    def get_inventories(self, revision_ids):
+        """Get several stored inventories with a single request.
+
+        :return: the inventories in the order of revision_ids
+        """
+        return list(self.repo.iter_inventories(revision_ids))
+
     def get_file_text(self, revision_id, file_id):
         """Get the text stored for a file in a given revision."""
         revtree = self.repo.revision_tree(revision_id)
@@ -225,6 +233,21 @@ class AbstractRevisionStore(object):
         revtree = self.repo.revision_tree(revision_id)
         return osutils.split_lines(revtree.get_file_text(file_id))
 
+    def get_file_bytes(self, revision_id, file_id):
+        """Get the text stored for a file in a given revision as a string.
+
+        Unlike get_file_text(), the text must have been changed in that
+        revision.
+        """
+        return ''.join(self.get_file_lines(revision_id, file_id))
+
+    def flush_texts(self):
+        """Add any texts loaded but not yet stored to the repository.
+
+        This must be called before the write group is committed. By
+        default, texts are stored as they are loaded.
+        """
+
     def start_new_revision(self, revision, parents, parent_invs):
         """Init the metadata needed for get_parents_and_revision_for_entry().
 
@@ -362,6 +385,8 @@ class AbstractRevisionStore(object):
                 including an empty inventory for the missing revisions
             If None, a default implementation is provided.
         """
+        # The commit builder reads and stores texts directly
+        self.flush_texts()
         # TODO: set revision_id = rev.revision_id
         builder = self.repo._commit_builder_class(self.repo,
             parents=rev.parent_ids, config=None, timestamp=rev.timestamp,
@@ -552,7 +577,7 @@ class RevisionStore1(AbstractRevisionStore):
                 continue
             file_id = ie.file_id
             text_parents = [(file_id, p) for p in parents_provider(file_id)]
-            lines = text_provider(file_id)
+            lines = osutils.split_lines(text_provider(file_id))
             vfile = self.repo.weave_store.get_weave_or_empty(file_id,  tx)
             vfile.add_lines(revision_id, text_parents, lines)
 
@@ -570,13 +595,37 @@ class RevisionStore1(AbstractRevisionStore):
 
 
 class RevisionStore2(AbstractRevisionStore):
-    """A RevisionStore that uses the new bzrlib Repository API."""
+    """A RevisionStore that uses the new bzrlib Repository API.
+
+    Texts are collected as fulltext records and added to the repository
+    with a single stream when enough have been collected or the write
+    group is committed.
+    """
+
+    # The number of bytes of texts to collect before storing them
+    _text_batch_size = 16*1024*1024
+
+    def __init__(self, repo):
+        """See AbstractRevisionStore.__init__."""
+        AbstractRevisionStore.__init__(self, repo)
+        # text key -> fulltext record, in the order they were loaded
+        self._pending_texts = {}
+        self._pending_text_records = []
+        self._pending_text_bytes = 0
 
     def _load_texts(self, revision_id, entries, text_provider, parents_provider):
         """See RevisionStore._load_texts()."""
+        # Entries last changed in an earlier revision have had their
+        # texts loaded already so only the new ones are looked for
         text_keys = {}
         for ie in entries:
-            text_keys[(ie.file_id, ie.revision)] = ie
+            if ie.revision != revision_id:
+                continue
+            text_key = (ie.file_id, ie.revision)
+            if text_key not in self._pending_texts:
+                text_keys[text_key] = ie
+        if not text_keys:
+            return
         text_parent_map = self.repo.texts.get_parent_map(text_keys)
         missing_texts = set(text_keys) - set(text_parent_map)
         self._load_texts_for_file_rev_ids(missing_texts, text_provider,
@@ -594,17 +643,43 @@ class RevisionStore2(AbstractRevisionStore):
         """
         for file_id, revision_id in file_rev_ids:
             text_key = (file_id, revision_id)
-            text_parents = [(file_id, p) for p in parents_provider(file_id)]
-            lines = text_provider(file_id)
+            text_parents = tuple([(file_id, p)
+                for p in parents_provider(file_id)])
+            text = text_provider(file_id)
             #print "adding text for %s\n\tparents:%s" % (text_key,text_parents)
-            self.repo.texts.add_lines(text_key, text_parents, lines)
+            record = versionedfile.FulltextContentFactory(text_key,
+                text_parents, osutils.sha_string(text), text)
+            self._pending_texts[text_key] = record
+            self._pending_text_records.append(record)
+            self._pending_text_bytes += len(text)
+        if self._pending_text_bytes >= self._text_batch_size:
+            self.flush_texts()
+
+    def flush_texts(self):
+        """See AbstractRevisionStore.flush_texts()."""
+        if not self._pending_text_records:
+            return
+        self.repo.texts.insert_record_stream(self._pending_text_records)
+        self._pending_texts = {}
+        self._pending_text_records = []
+        self._pending_text_bytes = 0
+
+    def get_file_text(self, revision_id, file_id):
+        """See AbstractRevisionStore.get_file_text()."""
+        self.flush_texts()
+        return AbstractRevisionStore.get_file_text(self, revision_id, file_id)
 
     def get_file_lines(self, revision_id, file_id):
+        return osutils.split_lines(self.get_file_bytes(revision_id, file_id))
+
+    def get_file_bytes(self, revision_id, file_id):
+        """See AbstractRevisionStore.get_file_bytes()."""
+        self.flush_texts()
         record = self.repo.texts.get_record_stream([(file_id, revision_id)],
             'unordered', True).next()
         if record.storage_kind == 'absent':
             raise errors.RevisionNotPresent(record.key, self.repo)
-        return osutils.split_lines(record.get_bytes_as('fulltext'))
+        return record.get_bytes_as('fulltext')
 
     # This is breaking imports into brisbane-core currently
     #def _add_revision(self, rev, inv):
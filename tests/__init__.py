@@ -47,7 +47,12 @@ def test_suite():
     module_names = [__name__ + '.' + x for x in [
         'test_commands',
         'test_exporter',
+        'test_idmapfile',
+        'test_marks_file',
         'test_branch_mapper',
+        'test_bzr_commit_handler',
+        'test_cache_manager',
+        'test_checkpointfile',
         'test_generic_processor',
         'test_revision_store',
         ]]
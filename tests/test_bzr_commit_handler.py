@@ -0,0 +1,116 @@
+# Copyright (C) 2008, 2009 Canonical Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Direct tests of the bzr_commit_handler classes."""
+
+from bzrlib import (
+    inventory,
+    osutils,
+    tests,
+    )
+
+from bzrlib.plugins.fastimport.tests import (
+    FastimportFeature,
+    )
+
+
+class TestCopyOnWriteInventory(tests.TestCase):
+
+    _test_needs_features = [FastimportFeature]
+
+    def invAddEntry(self, inv, path, file_id=None):
+        if path.endswith('/'):
+            path = path[:-1]
+            kind = 'directory'
+        else:
+            kind = 'file'
+        parent_path, basename = osutils.split(path)
+        parent_id = inv.path2id(parent_path)
+        inv.add(inventory.make_entry(kind, basename, parent_id, file_id))
+
+    def make_basis_inv(self):
+        basis_inv = inventory.Inventory('TREE_ROOT', 'rev-1')
+        self.invAddEntry(basis_inv, 'foo', 'foo-id')
+        self.invAddEntry(basis_inv, 'bar/', 'bar-id')
+        self.invAddEntry(basis_inv, 'bar/baz', 'baz-id')
+        self.invAddEntry(basis_inv, 'qux/', 'qux-id')
+        self.invAddEntry(basis_inv, 'qux/quux', 'quux-id')
+        return basis_inv
+
+    def make_cow_inv(self):
+        from bzrlib.plugins.fastimport.bzr_commit_handler import (
+            CopyOnWriteInventory,
+            )
+        basis_inv = self.make_basis_inv()
+        # The basis must come through every change unaltered
+        self.addCleanup(lambda: self.assertEqual(self.make_basis_inv(),
+            basis_inv))
+        return basis_inv, CopyOnWriteInventory(basis_inv)
+
+    def test_shares_entries(self):
+        basis_inv, inv = self.make_cow_inv()
+        self.assertEqual(basis_inv, inv)
+        self.assertEqual('rev-1', inv.revision_id)
+        for file_id in basis_inv:
+            self.assertIs(basis_inv[file_id], inv[file_id])
+
+    def test_add(self):
+        basis_inv, inv = self.make_cow_inv()
+        self.invAddEntry(inv, 'bar/new', 'new-id')
+        self.assertEqual('bar/new', inv.id2path('new-id'))
+        self.assertFalse(basis_inv.has_id('new-id'))
+        # Only the directories above the new entry are copied
+        self.assertIsNot(basis_inv['bar-id'], inv['bar-id'])
+        self.assertIsNot(basis_inv.root, inv.root)
+        self.assertIs(basis_inv['baz-id'], inv['baz-id'])
+        self.assertIs(basis_inv['qux-id'], inv['qux-id'])
+
+    def test_remove_recursive_id(self):
+        basis_inv, inv = self.make_cow_inv()
+        inv.remove_recursive_id('bar-id')
+        self.assertFalse(inv.has_id('bar-id'))
+        self.assertFalse(inv.has_id('baz-id'))
+        self.assertEqual(None, inv.path2id('bar'))
+        self.assertIs(basis_inv['qux-id'], inv['qux-id'])
+
+    def test_delitem(self):
+        basis_inv, inv = self.make_cow_inv()
+        del inv['quux-id']
+        self.assertEqual(None, inv.path2id('qux/quux'))
+        self.assertEqual({}, inv['qux-id'].children)
+
+    def test_rename(self):
+        basis_inv, inv = self.make_cow_inv()
+        inv.rename('baz-id', 'qux-id', 'renamed')
+        self.assertEqual('qux/renamed', inv.id2path('baz-id'))
+        self.assertEqual(None, inv.path2id('bar/baz'))
+        self.assertIs(basis_inv['foo-id'], inv['foo-id'])
+
+    def test_replace_entry(self):
+        basis_inv, inv = self.make_cow_inv()
+        ie = inventory.make_entry('file', 'baz', 'bar-id', 'baz-id')
+        ie.text_sha1 = 'sha1'
+        inv.replace_entry(ie)
+        self.assertIs(ie, inv['baz-id'])
+        self.assertIs(ie, inv.get_child('bar-id', 'baz'))
+
+    def test_get_mutable_entry(self):
+        basis_inv, inv = self.make_cow_inv()
+        ie = inv.get_mutable_entry('baz-id')
+        ie.revision = 'rev-2'
+        self.assertIs(ie, inv.get_mutable_entry('baz-id'))
+        self.assertIs(ie, inv.get_child('bar-id', 'baz'))
+        inv.get_mutable_entry(inv.root.file_id).revision = 'rev-2'
+        self.assertEqual('rev-2', inv.root.revision)
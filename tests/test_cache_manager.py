@@ -0,0 +1,565 @@
+# Copyright (C) 2010 Canonical Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the cache manager."""
+
+import zlib
+
+from bzrlib import inventory, osutils, tests
+
+from bzrlib.plugins.fastimport.cache_manager import (
+    BlobArena,
+    CacheManager,
+    InventoryCache,
+    MarkTable,
+    PathIndex,
+    _PATH_INDEX_ENTRY_SIZE,
+    )
+from bzrlib.plugins.fastimport.tests import (
+    FastimportFeature,
+    )
+
+
+class TestMarkTable(tests.TestCase):
+
+    def test_integer_marks(self):
+        marks = MarkTable()
+        marks['1'] = 'rev-a'
+        marks['3'] = 'rev-c'
+        self.assertEqual(2, len(marks))
+        self.assertEqual('rev-a', marks['1'])
+        self.assertEqual('rev-c', marks['3'])
+        self.assertRaises(KeyError, marks.__getitem__, '2')
+        self.assertRaises(KeyError, marks.__getitem__, '4')
+        self.assertTrue('1' in marks)
+        self.assertFalse(marks.has_key('2'))
+        self.assertEqual(None, marks.get('2'))
+        self.assertEqual([('1', 'rev-a'), ('3', 'rev-c')], marks.items())
+
+    def test_other_marks(self):
+        marks = MarkTable()
+        marks['abc'] = 'rev-a'
+        marks['01'] = 'rev-b'
+        marks['100000'] = 'rev-c'
+        self.assertEqual(3, len(marks))
+        self.assertEqual({'abc': 'rev-a', '01': 'rev-b', '100000': 'rev-c'},
+            dict(marks.iteritems()))
+        self.assertEqual(0, len(marks._offsets))
+        self.assertRaises(KeyError, marks.__getitem__, '1')
+
+    def test_replace(self):
+        marks = MarkTable({'1': 'rev-a', '2': 'rev-b'})
+        marks['1'] = 'rev-c'
+        marks['2'] = 'rev-b'
+        self.assertEqual(2, len(marks))
+        self.assertEqual({'1': 'rev-c', '2': 'rev-b'}, dict(marks.items()))
+        self.assertEqual(len('rev-a' 'rev-b' 'rev-c'), len(marks._data))
+
+    def test_reassign_compacts(self):
+        marks = MarkTable()
+        marks._min_compact_bytes = 64
+        for i in range(1, 11):
+            marks[str(i)] = 'rev-%02d' % i
+        for n in range(100):
+            marks['1'] = 'other-rev-%03d' % n
+        self.assertEqual(10, len(marks))
+        self.assertEqual('other-rev-099', marks['1'])
+        self.assertEqual('rev-10', marks['10'])
+        self.assertTrue(len(marks._data) <= 2 * (
+            len('other-rev-099') + 9 * len('rev-10')) + 64)
+
+    def test_reassign_keeps_shared_revision_id(self):
+        marks = MarkTable()
+        marks._min_compact_bytes = 1
+        marks['1'] = 'rev-a'
+        marks['2'] = 'rev-a'
+        marks['1'] = 'rev-b'
+        self.assertEqual({'1': 'rev-b', '2': 'rev-a'}, dict(marks.items()))
+        self.assertEqual(len('rev-a' 'rev-b'), len(marks._data))
+
+    def test_repeated_revision_ids_stored_once(self):
+        marks = MarkTable()
+        for i in range(1, 201):
+            marks[str(i)] = 'rev-%d' % (i % 3)
+        self.assertEqual(200, len(marks))
+        self.assertEqual('rev-2', marks['200'])
+        self.assertEqual(len('rev-0' 'rev-1' 'rev-2'), len(marks._data))
+
+    def test_mark_moves_into_arrays(self):
+        marks = MarkTable()
+        marks['2000'] = 'rev-a'
+        for i in range(1, 1500):
+            marks[str(i)] = 'rev-%d' % i
+        marks['2000'] = 'rev-b'
+        self.assertEqual(1500, len(marks))
+        self.assertEqual('rev-b', marks['2000'])
+        self.assertEqual({}, marks._other)
+
+    def test_clear(self):
+        marks = MarkTable({'1': 'rev-a', 'x': 'rev-b'})
+        marks.clear()
+        self.assertEqual(0, len(marks))
+        self.assertEqual([], marks.keys())
+
+    def test_memory_footprint(self):
+        marks = MarkTable({'1': 'rev-a', 'x': 'rev-b'})
+        self.assertEqual(2 * marks._offsets.itemsize +
+            2 * marks._lengths.itemsize + len('rev-a') + len('xrev-b') +
+            len(marks._table_offsets) * marks._table_offsets.itemsize +
+            len(marks._table_lengths) * marks._table_lengths.itemsize,
+            marks.memory_footprint())
+
+
+class _Inventory(object):
+
+    def __init__(self, count):
+        self._byid = dict.fromkeys(range(count))
+
+
+class TestInventoryCache(tests.TestCase):
+
+    def test_hits_and_misses(self):
+        cache = InventoryCache(1024 * 1024)
+        inv = _Inventory(10)
+        cache['rev-a'] = inv
+        self.assertIs(inv, cache['rev-a'])
+        self.assertRaises(KeyError, cache.__getitem__, 'rev-b')
+        self.assertTrue('rev-a' in cache)
+        self.assertFalse('rev-b' in cache)
+        self.assertEqual((1, 1, 0),
+            (cache.hits, cache.misses, cache.evictions))
+
+    def test_bounded_by_size(self):
+        # Each inventory is estimated at 4096 + 300 * 20 = 10096 bytes
+        cache = InventoryCache(30000)
+        for revid in ['rev-a', 'rev-b', 'rev-c', 'rev-d']:
+            cache[revid] = _Inventory(20)
+        self.assertFalse('rev-a' in cache)
+        self.assertTrue('rev-d' in cache)
+        self.assertTrue(cache.size() <= 30000)
+        self.assertEqual(len(cache) + cache.evictions, 4)
+
+    def test_bounded_by_count(self):
+        cache = InventoryCache(1, max_count=2)
+        for revid in ['rev-a', 'rev-b', 'rev-c']:
+            cache[revid] = _Inventory(20)
+        self.assertTrue(len(cache) <= 2)
+        self.assertEqual(3, len(cache) + cache.evictions)
+        self.assertFalse('rev-a' in cache)
+        self.assertTrue('rev-c' in cache)
+
+    def test_keeps_last_inventory(self):
+        cache = InventoryCache(1000)
+        inv = _Inventory(100)
+        cache['rev-a'] = inv
+        self.assertIs(inv, cache['rev-a'])
+        cache['rev-b'] = _Inventory(100)
+        self.assertRaises(KeyError, cache.__getitem__, 'rev-a')
+
+    def test_pinned(self):
+        cache = InventoryCache(1000)
+        inv = _Inventory(100)
+        cache.pin('rev-a', 2)
+        cache['rev-a'] = inv
+        cache['rev-b'] = _Inventory(100)
+        self.assertEqual(1, cache.pinned_count())
+        self.assertIs(inv, cache['rev-a'])
+        cache.unpin('rev-a')
+        self.assertIs(inv, cache['rev-a'])
+        cache.unpin('rev-a')
+        self.assertEqual(0, cache.pinned_count())
+        self.assertRaises(KeyError, cache.__getitem__, 'rev-a')
+
+    def test_pin_cached(self):
+        cache = InventoryCache(1024 * 1024)
+        inv = _Inventory(1)
+        cache['rev-a'] = inv
+        cache.pin('rev-a', 1)
+        self.assertEqual(1, cache.pinned_count())
+        cache.unpin('rev-b')
+        cache.unpin('rev-a')
+        self.assertEqual(0, cache.pinned_count())
+
+    def test_clear(self):
+        cache = InventoryCache(1024 * 1024)
+        cache['rev-a'] = _Inventory(1)
+        cache.clear()
+        self.assertEqual(0, len(cache))
+        self.assertFalse('rev-a' in cache)
+
+
+class TestPathIndex(tests.TestCase):
+
+    def make_inventory(self, paths):
+        inv = inventory.Inventory(root_id='root-id')
+        for path in paths:
+            if path.endswith('/'):
+                kind = 'directory'
+                path = path[:-1]
+            else:
+                kind = 'file'
+            parent_id = inv.path2id(osutils.dirname(path))
+            inv.add(inventory.make_entry(kind, osutils.basename(path),
+                parent_id, path + '-id'))
+        return inv
+
+    def assertIndexes(self, inv, index):
+        # The paths looked up already are those in the inventory
+        for path, file_id in index._ids.items():
+            self.assertEqual(file_id, inv.path2id(path))
+            self.assertEqual(path, index._paths[file_id])
+        self.assertEqual(len(index._ids), len(index._paths))
+        # and the others are looked up in the inventory
+        index = index.copy()
+        for path, ie in inv.iter_entries_by_dir():
+            self.assertEqual(ie.file_id, index.path2id(path))
+            self.assertEqual(path, index.id2path(ie.file_id))
+
+    def apply_delta(self, inv, delta, paths=None):
+        """Apply a delta to an index of the given paths, or all of them."""
+        index = PathIndex(inv)
+        if paths is None:
+            paths = [path for path, ie in inv.iter_entries_by_dir()]
+        for path in paths:
+            index.path2id(path)
+        new_inv = inv.create_by_apply_delta(delta, 'rev-2')
+        index.apply_delta(delta, new_inv)
+        self.assertIndexes(new_inv, index)
+        return index
+
+    def test_index(self):
+        inv = self.make_inventory(['a/', 'a/b', 'c'])
+        index = PathIndex(inv)
+        self.assertEqual(0, len(index))
+        self.assertEqual('a/b-id', index.path2id('a/b'))
+        self.assertEqual(None, index.path2id('a/c'))
+        self.assertEqual('c', index.id2path('c-id'))
+        self.assertEqual(None, index.id2path('d-id'))
+        self.assertEqual(2, len(index))
+        self.assertIndexes(inv, index)
+        self.assertEqual(0, len(PathIndex()))
+        self.assertEqual(None, PathIndex().path2id('a'))
+
+    def test_copy(self):
+        inv = self.make_inventory(['a', 'b'])
+        index = PathIndex(inv)
+        index.path2id('a')
+        copy = index.copy()
+        copy.apply_delta([('a', None, 'a-id', None)],
+            inv.create_by_apply_delta([('a', None, 'a-id', None)], 'rev-2'))
+        self.assertEqual(None, copy.path2id('a'))
+        self.assertEqual('a-id', index.path2id('a'))
+        self.assertEqual(index.memory_footprint() - copy.memory_footprint(),
+            len('a') + len('a-id') + _PATH_INDEX_ENTRY_SIZE)
+
+    def test_clear(self):
+        inv = self.make_inventory(['a'])
+        index = PathIndex(inv)
+        index.path2id('a')
+        index.clear()
+        self.assertEqual(0, len(index))
+        self.assertEqual(0, index.memory_footprint())
+        self.assertEqual('a-id', index.path2id('a'))
+
+    def test_add_and_delete(self):
+        inv = self.make_inventory(['a/', 'a/b', 'c'])
+        self.apply_delta(inv, [
+            (None, 'a/d', 'a/d-id',
+                inventory.make_entry('file', 'd', 'a-id', 'a/d-id')),
+            ('c', None, 'c-id', None),
+            ])
+
+    def test_rename_directory(self):
+        inv = self.make_inventory(['a/', 'a/b/', 'a/b/c', 'a/d', 'e/'])
+        ie = inv['a-id'].copy()
+        ie.name = 'f'
+        ie.parent_id = 'e-id'
+        index = self.apply_delta(inv, [('a', 'e/f', 'a-id', ie)])
+        self.assertEqual('a/b/c-id', index.path2id('e/f/b/c'))
+
+    def test_rename_nested_directories(self):
+        inv = self.make_inventory(['a/', 'a/b/', 'a/b/c', 'a/d'])
+        a_ie = inv['a-id'].copy()
+        a_ie.name = 'x'
+        b_ie = inv['a/b-id'].copy()
+        b_ie.name = 'y'
+        b_ie.parent_id = 'root-id'
+        d_ie = inv['a/d-id'].copy()
+        d_ie.parent_id = 'a/b-id'
+        self.apply_delta(inv, [
+            ('a', 'x', 'a-id', a_ie),
+            ('a/b', 'y', 'a/b-id', b_ie),
+            ('a/d', 'y/d', 'a/d-id', d_ie),
+            ])
+
+    def test_rename_directory_and_delete_child(self):
+        inv = self.make_inventory(['a/', 'a/x', 'a/y'])
+        ie = inv['a-id'].copy()
+        ie.name = 'b'
+        index = self.apply_delta(inv, [
+            ('a/x', None, 'a/x-id', None),
+            ('a', 'b', 'a-id', ie),
+            ])
+        self.assertEqual(None, index.path2id('b/x'))
+        self.assertEqual(None, index.id2path('a/x-id'))
+        self.assertEqual('a/y-id', index.path2id('b/y'))
+
+    def test_delete_child_and_rename_directory(self):
+        inv = self.make_inventory(['a/', 'a/b/', 'a/b/x', 'a/y'])
+        ie = inv['a-id'].copy()
+        ie.name = 'c'
+        index = self.apply_delta(inv, [
+            ('a', 'c', 'a-id', ie),
+            ('a/b/x', None, 'a/b/x-id', None),
+            ])
+        self.assertEqual(None, index.path2id('c/b/x'))
+        self.assertEqual('a/b-id', index.path2id('c/b'))
+
+    def test_rename_directory_not_looked_up(self):
+        # Only a child of the renamed directory has been looked up
+        inv = self.make_inventory(['a/', 'a/b/', 'a/b/c', 'a/d'])
+        ie = inv['a-id'].copy()
+        ie.name = 'e'
+        index = self.apply_delta(inv, [('a', 'e', 'a-id', ie)], ['a/b/c'])
+        self.assertEqual(['', 'e', 'e/b/c'], sorted(index._ids))
+
+    def test_add_under_directory_not_looked_up(self):
+        inv = self.make_inventory(['a/', 'a/b/'])
+        index = self.apply_delta(inv, [
+            (None, 'a/b/c', 'a/b/c-id',
+                inventory.make_entry('file', 'c', 'a/b-id', 'a/b/c-id')),
+            ], [])
+        self.assertEqual({'a/b/c': 'a/b/c-id', 'a/b': 'a/b-id'},
+            index._ids)
+
+    def test_swap_files(self):
+        inv = self.make_inventory(['a', 'b'])
+        a_ie = inv['a-id'].copy()
+        a_ie.name = 'b'
+        b_ie = inv['b-id'].copy()
+        b_ie.name = 'a'
+        self.apply_delta(inv, [
+            ('a', 'b', 'a-id', a_ie),
+            ('b', 'a', 'b-id', b_ie),
+            ])
+
+
+class TestBlobArena(tests.TestCase):
+
+    def setUp(self):
+        super(TestBlobArena, self).setUp()
+        self.arena = BlobArena()
+        self.addCleanup(self.arena.close)
+
+    def test_add_and_get(self):
+        a = self.arena.add('aaa')
+        b = self.arena.add('bbbb')
+        self.assertEqual('aaa', self.arena.get(a, 3))
+        self.assertEqual('bbbb', self.arena.get(b, 4))
+        self.assertEqual(7, self.arena.size())
+
+    def test_grows(self):
+        data = 'x' * (BlobArena._initial_size + 1)
+        a = self.arena.add('aaa')
+        b = self.arena.add(data)
+        self.assertEqual('aaa', self.arena.get(a, 3))
+        self.assertEqual(data, self.arena.get(b, len(data)))
+
+    def test_free_space_reused(self):
+        a = self.arena.add('aaa')
+        b = self.arena.add('bbb')
+        c = self.arena.add('ccc')
+        self.arena.free(a, 3)
+        self.arena.free(b, 3)
+        # The freed extents are merged and reused
+        self.assertEqual(a, self.arena.add('dddd'))
+        self.assertEqual(a + 4, self.arena.add('ee'))
+        self.assertEqual('ccc', self.arena.get(c, 3))
+        self.assertEqual(9, self.arena.size())
+
+    def test_free_at_end(self):
+        a = self.arena.add('aaa')
+        b = self.arena.add('bbb')
+        self.arena.free(b, 3)
+        self.arena.free(a, 3)
+        self.assertEqual(0, self.arena.size())
+        self.assertEqual(0, self.arena.add('ccc'))
+
+
+class TestCacheManager(tests.TestCase):
+
+    _test_needs_features = [FastimportFeature]
+
+    def test_lookup_committish(self):
+        cache_mgr = CacheManager()
+        cache_mgr.add_mark('1', 'rev-a')
+        cache_mgr.add_mark('a', 'rev-b')
+        self.assertEqual('rev-a', cache_mgr.lookup_committish(':1'))
+        self.assertEqual('rev-b', cache_mgr.lookup_committish(':a'))
+
+    def test_merged_inventories_pinned(self):
+        cache_mgr = CacheManager(info={'Merges': {':1': '2'}},
+            inventory_cache_size=1)
+        cache_mgr.add_mark('1', 'rev-a')
+        cache_mgr.add_mark('2', 'rev-b')
+        inv = _Inventory(1)
+        cache_mgr.pin_merged_inventory(':1', 'rev-a')
+        cache_mgr.pin_merged_inventory(':2', 'rev-b')
+        cache_mgr.inventories['rev-a'] = inv
+        cache_mgr.inventories['rev-b'] = _Inventory(1)
+        self.assertEqual(1, cache_mgr.inventories.pinned_count())
+        self.assertIs(inv, cache_mgr.inventories['rev-a'])
+        cache_mgr.release_merged_inventories([':1', ':2'])
+        self.assertIs(inv, cache_mgr.inventories['rev-a'])
+        cache_mgr.release_merged_inventories([':1'])
+        self.assertEqual(0, cache_mgr.inventories.pinned_count())
+
+    def test_blobs_flushed_to_disk(self):
+        cache_mgr = CacheManager(info={'Blob reference counts':
+            {'2': [':1', ':2']}})
+        cache_mgr._sticky_cache_size = 10
+        cache_mgr._sticky_flushed_size = 0
+        cache_mgr.store_blob(':1', 'blob 1')
+        cache_mgr.store_blob(':2', 'blob 2')
+        self.assertEqual({}, cache_mgr._sticky_blobs)
+        self.assertEqual(12, cache_mgr._arena.size())
+        self.assertEqual('blob 1', cache_mgr.fetch_blob(':1'))
+        self.assertEqual('blob 1', cache_mgr.fetch_blob(':1'))
+        self.assertEqual(6, cache_mgr._arena.size())
+        self.assertRaises(KeyError, cache_mgr.fetch_blob, ':1')
+        self.assertEqual('blob 2', cache_mgr.fetch_blob(':2'))
+        self.assertEqual([':2'], cache_mgr._disk_blobs.keys())
+
+    def test_blobs_compressed(self):
+        blob_1 = 'a' * 600
+        blob_2 = 'b' * 600
+        # There is room for one compressed blob
+        cache_mgr = CacheManager(info={'Blob reference counts':
+            {'2': [':1', ':2']}}, blob_compression_level=6,
+            compressed_blob_cache_bytes=len(zlib.compress(blob_1, 6)) + 1)
+        cache_mgr._sticky_cache_size = 1000
+        cache_mgr._sticky_flushed_size = 0
+        cache_mgr.store_blob(':1', blob_1)
+        cache_mgr.store_blob(':2', blob_2)
+        # One blob is compressed and the other, which doesn't fit in the
+        # rest of the cache, is written to disk
+        self.assertEqual(1, len(cache_mgr._compressed_blobs))
+        self.assertEqual(1, len(cache_mgr._disk_blobs))
+        self.assertTrue(cache_mgr._compressed_memory_bytes <=
+            cache_mgr._compressed_cache_size)
+        self.assertEqual(blob_1, cache_mgr.fetch_blob(':1'))
+        self.assertEqual(blob_2, cache_mgr.fetch_blob(':2'))
+        self.assertEqual(blob_1, cache_mgr.fetch_blob(':1'))
+        self.assertEqual(blob_2, cache_mgr.fetch_blob(':2'))
+        self.assertEqual({}, cache_mgr._compressed_blobs)
+        self.assertEqual({}, cache_mgr._disk_blobs)
+        self.assertEqual(0, cache_mgr._compressed_memory_bytes)
+
+    def test_blob_too_big_to_compress_in_memory(self):
+        blob = 'a' * 600
+        cache_mgr = CacheManager(info={'Blob reference counts':
+            {'2': [':1']}}, blob_compression_level=6,
+            compressed_blob_cache_bytes=len(zlib.compress(blob, 6)) - 1)
+        cache_mgr._sticky_cache_size = 100
+        cache_mgr._sticky_flushed_size = 0
+        cache_mgr.store_blob(':1', blob)
+        self.assertEqual({}, cache_mgr._compressed_blobs)
+        self.assertEqual([':1'], cache_mgr._disk_blobs.keys())
+        self.assertEqual(0, cache_mgr._compressed_memory_bytes)
+        self.assertEqual(blob, cache_mgr.fetch_blob(':1'))
+
+    def test_checkpoint_blobs(self):
+        cache_mgr = CacheManager(info={'Blob reference counts':
+            {'2': [':1']}})
+        cache_mgr._sticky_cache_size = 10
+        cache_mgr._sticky_flushed_size = 0
+        cache_mgr.store_blob(':1', 'blob 1')
+        cache_mgr.store_blob(':2', 'blob 2')
+        added, removed = cache_mgr.checkpoint_blobs()
+        self.assertEqual([(':1', 'blob 1'), (':2', 'blob 2')],
+            sorted(added))
+        self.assertEqual([], removed)
+        cache_mgr.fetch_blob(':2')
+        cache_mgr.store_blob(':3', 'blob 3')
+        added, removed = cache_mgr.checkpoint_blobs()
+        self.assertEqual([(':3', 'blob 3')], list(added))
+        self.assertEqual([':2'], removed)
+        # A blob stored again is saved again
+        cache_mgr.store_blob(':3', 'blob 3 again')
+        added, removed = cache_mgr.checkpoint_blobs()
+        self.assertEqual([(':3', 'blob 3 again')], list(added))
+        self.assertEqual([], removed)
+
+    def test_restore_blobs(self):
+        cache_mgr = CacheManager()
+        cache_mgr.restore_blobs([(':1', 'blob 1')])
+        self.assertEqual('blob 1', cache_mgr.fetch_blob(':1'))
+        added, removed = cache_mgr.checkpoint_blobs()
+        self.assertEqual([], list(added))
+        self.assertEqual([], removed)
+
+    def test_path_index_handed_on(self):
+        cache_mgr = CacheManager()
+        inv = inventory.Inventory(root_id='root-id')
+        index = cache_mgr.take_path_index(None, inv)
+        self.assertEqual(None, index.path2id(''))
+        index = cache_mgr.take_path_index('rev-a', inv)
+        self.assertEqual(0, len(index))
+        self.assertEqual('root-id', index.path2id(''))
+        cache_mgr.keep_path_index('rev-a', index)
+        # Each revision built on rev-a gets its own copy of the index
+        first = cache_mgr.take_path_index('rev-a', inv)
+        second = cache_mgr.take_path_index('rev-a', inv)
+        self.assertIsNot(first, second)
+        self.assertIsNot(index, first)
+        self.assertEqual({'': 'root-id'}, first._ids)
+        first.clear()
+        self.assertEqual({'': 'root-id'}, second._ids)
+
+    def test_path_indexes_bounded(self):
+        cache_mgr = CacheManager()
+        cache_mgr._path_index_count = 2
+        for revid in ['rev-a', 'rev-b', 'rev-c']:
+            cache_mgr.keep_path_index(revid, PathIndex())
+        self.assertEqual(['rev-b', 'rev-c'], cache_mgr._path_indexes.keys())
+
+    def test_path_indexes_bounded_by_size(self):
+        cache_mgr = CacheManager()
+        inv = inventory.Inventory(root_id='root-id')
+        index = PathIndex(inv)
+        index.path2id('')
+        size = index.memory_footprint()
+        cache_mgr._path_index_size = 2 * size
+        for revid in ['rev-a', 'rev-b', 'rev-c']:
+            cache_mgr.keep_path_index(revid, index.copy())
+        self.assertEqual(['rev-b', 'rev-c'], cache_mgr._path_indexes.keys())
+        # An index too big to keep by itself is emptied
+        cache_mgr._path_index_size = size - 1
+        cache_mgr.keep_path_index('rev-d', index)
+        self.assertEqual(['rev-d'], cache_mgr._path_indexes.keys())
+        self.assertEqual(0, len(index))
+
+    def test_dump_stats(self):
+        cache_mgr = CacheManager()
+        cache_mgr.add_mark('1', 'rev-a')
+        lines = []
+        def note(msg, *args):
+            lines.append(msg % args)
+        cache_mgr.dump_stats(note=note)
+        self.assertEqual('    revision-ids:      0.1 K (1 item)', lines[-3])
+        self.assertEqual('    inventories :      0.0 K (0 items)', lines[-2])
+        self.assertEqual(
+            '                : 0 hits, 0 misses, 0 evictions, 0 pinned',
+            lines[-1])
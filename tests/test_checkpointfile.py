@@ -0,0 +1,101 @@
+# Copyright (C) 2010 Canonical Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test saving and loading the checkpoint file."""
+
+from bzrlib import tests
+
+from bzrlib.plugins.fastimport import checkpointfile
+
+
+class TestCheckpointFile(tests.TestCaseInTempDir):
+
+    state = {
+        'revisions': 3,
+        'last_ref': 'refs/heads/master',
+        'last_ids': {'refs/heads/master': ':3', 'refs/heads/other': ':2'},
+        'heads': {':3': set(['refs/heads/master']),
+            ':2': set(['refs/heads/other', 'refs/heads/copy'])},
+        'tags': {u'v1\xe9': 'rev-a'},
+        'blobs': 20,
+        'position': {
+            'source': (1234, 5678),
+            'offset': 100,
+            'lineno': 10,
+            'features': {'done': None, 'date-format': 'raw'},
+            },
+        }
+
+    def test_round_trip(self):
+        checkpointfile.save_checkpoint('checkpoint', self.state)
+        self.assertEqual(self.state,
+            checkpointfile.load_checkpoint('checkpoint'))
+        self.assertPathDoesNotExist('checkpoint.tmp')
+
+    def test_no_last_ref(self):
+        state = dict(self.state, last_ref=None)
+        checkpointfile.save_checkpoint('checkpoint', state)
+        self.assertEqual(state, checkpointfile.load_checkpoint('checkpoint'))
+
+    def test_no_position(self):
+        state = dict(self.state, position=None)
+        checkpointfile.save_checkpoint('checkpoint', state)
+        self.assertEqual(state, checkpointfile.load_checkpoint('checkpoint'))
+
+    def test_missing(self):
+        self.assertEqual(None, checkpointfile.load_checkpoint('checkpoint'))
+
+    def test_corrupt(self):
+        self.build_tree_contents([('checkpoint', 'd6:offset')])
+        self.assertEqual(None, checkpointfile.load_checkpoint('checkpoint'))
+
+    def test_remove(self):
+        checkpointfile.save_checkpoint('checkpoint', self.state)
+        checkpointfile.save_blobs('checkpoint', 0, [(':1', 'abc')], [])
+        checkpointfile.remove_checkpoint('checkpoint')
+        self.assertPathDoesNotExist('checkpoint')
+        self.assertPathDoesNotExist('checkpoint-blobs')
+        checkpointfile.remove_checkpoint('checkpoint')
+
+    def test_blobs_round_trip(self):
+        length = checkpointfile.save_blobs('checkpoint', 0,
+            [(':1', 'abc'), (':2', 'de\nf'), (':3', '')], [])
+        length = checkpointfile.save_blobs('checkpoint', length,
+            [(':4', 'ghi'), (':1', 'abc again')], [':2'])
+        self.assertEqual([(':1', 'abc again'), (':3', ''), (':4', 'ghi')],
+            sorted(checkpointfile.load_blobs('checkpoint', length)))
+
+    def test_blobs_after_checkpoint_discarded(self):
+        length = checkpointfile.save_blobs('checkpoint', 0,
+            [(':1', 'abc')], [])
+        # Written by an import that was interrupted before its checkpoint
+        checkpointfile.save_blobs('checkpoint', length, [(':2', 'def')],
+            [':1'])
+        self.assertEqual([(':1', 'abc')],
+            list(checkpointfile.load_blobs('checkpoint', length)))
+        length = checkpointfile.save_blobs('checkpoint', length,
+            [(':3', 'ghi')], [])
+        self.assertEqual([(':1', 'abc'), (':3', 'ghi')],
+            sorted(checkpointfile.load_blobs('checkpoint', length)))
+
+    def test_blobs_missing_or_short(self):
+        self.assertEqual([], list(checkpointfile.load_blobs('checkpoint', 0)))
+        self.assertEqual(None, checkpointfile.load_blobs('checkpoint', 10))
+        length = checkpointfile.save_blobs('checkpoint', 0,
+            [(':1', 'abc')], [])
+        self.assertEqual(None,
+            checkpointfile.load_blobs('checkpoint', length + 1))
+        self.assertEqual(None,
+            checkpointfile.load_blobs('checkpoint', length - 1))
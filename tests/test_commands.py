@@ -20,7 +20,10 @@ import re
 import tempfile
 import gzip
 
-from bzrlib import tests
+from bzrlib import (
+    osutils,
+    tests,
+    )
 from bzrlib.tests.blackbox import ExternalBase
 
 from bzrlib.plugins.fastimport.cmds import (
@@ -174,6 +177,23 @@ class TestFastExport(ExternalBase):
         data2 = self.run_bzr("fast-export bl")[0]
         self.assertEquals(data1, data2)
 
+    def test_dedupe_blobs(self):
+        tree = self.make_branch_and_tree("br")
+        self.build_tree_contents([('br/a', 'one\n')])
+        tree.add('a')
+        tree.commit('add a')
+        self.build_tree_contents([('br/a', 'two\n')])
+        tree.commit('modify a')
+        self.build_tree_contents([('br/a', 'one\n')])
+        tree.commit('revert a')
+        data = self.run_bzr("fast-export --dedupe-blobs --export-marks=marks br")[0]
+        self.assertEquals(2, data.count("blob\n"))
+        self.assertEquals(2, data.count("M 644 :1 a\n"))
+        self.assertEquals(1, data.count("M 644 :3 a\n"))
+        self.assertNotEqual(-1, data.find("commit refs/heads/master\nmark :5\n"))
+        self.assertFileEqual(":1 %s\n:3 %s\n" % (osutils.sha_string('one\n'),
+            osutils.sha_string('two\n')), 'marks.blobs')
+
 simple_fast_import_stream = """commit refs/heads/master
 mark :1
 committer Jelmer Vernooij <jelmer@samba.org> 1299718135 +0100
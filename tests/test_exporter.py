@@ -15,13 +15,18 @@
 
 """Test the exporter."""
 
+import bz2
 import os
 import tempfile
 import gzip
+from cStringIO import StringIO
 
 from bzrlib import tests
 
+from bzrlib.plugins.fastimport import exporter as _mod_exporter
+from bzrlib.plugins.fastimport import marks_file
 from bzrlib.plugins.fastimport.exporter import (
+    BzrFastExporter,
     _get_output_stream,
     check_ref_format,
     sanitize_ref_name_for_git
@@ -31,6 +36,11 @@ from bzrlib.plugins.fastimport.tests import (
     FastimportFeature,
     )
 
+try:
+    from fastimport import commands
+except ImportError:
+    commands = object()
+
 
 class TestOutputStream(tests.TestCase):
 
@@ -51,6 +61,53 @@ class TestOutputStream(tests.TestCase):
         self.assertEquals("bla", f.read())
         f.close()
 
+    def test_get_source_gz_blocks(self):
+        # blocks are compressed as separate gzip members
+        self.overrideAttr(_mod_exporter, '_COMPRESS_BLOCK_SIZE', 4)
+        fd, filename = tempfile.mkstemp(suffix=".gz")
+        os.close(fd)
+        stream = _get_output_stream(filename)
+        for i in range(100):
+            stream.write("line %d\n" % i)
+        stream.close()
+        f = gzip.GzipFile(filename)
+        self.assertEquals("".join(["line %d\n" % i for i in range(100)]),
+            f.read())
+        f.close()
+
+    def test_get_source_gz_flush(self):
+        # flushing doesn't end the gzip member being gathered
+        fd, filename = tempfile.mkstemp(suffix=".gz")
+        os.close(fd)
+        stream = _get_output_stream(filename)
+        stream.write("bla")
+        stream.flush()
+        stream.write("foo")
+        stream.close()
+        self.assertEquals(_mod_exporter._gzip_member("blafoo"),
+            open(filename, 'rb').read())
+
+    def test_get_source_gz_empty(self):
+        fd, filename = tempfile.mkstemp(suffix=".gz")
+        os.close(fd)
+        _get_output_stream(filename).close()
+        f = gzip.GzipFile(filename)
+        self.assertEquals("", f.read())
+        f.close()
+
+    def test_get_source_bz2(self):
+        # files ending in .bz2 are compressed with bzip2.
+        self.overrideAttr(_mod_exporter, '_COMPRESS_BLOCK_SIZE', 4)
+        fd, filename = tempfile.mkstemp(suffix=".bz2")
+        os.close(fd)
+        stream = _get_output_stream(filename)
+        stream.write("bla")
+        stream.write("foo")
+        stream.close()
+        f = bz2.BZ2File(filename)
+        self.assertEquals("blafoo", f.read())
+        f.close()
+
     def test_get_source_file(self):
         # other files are opened as regular files.
         fd, filename = tempfile.mkstemp()
@@ -63,6 +120,260 @@ class TestOutputStream(tests.TestCase):
         f.close()
 
 
+class TestBzrFastExporter(tests.TestCaseWithTransport):
+
+    _test_needs_features = [FastimportFeature]
+
+    def make_history(self):
+        tree = self.make_branch_and_tree('br')
+        self.build_tree_contents([('br/a', 'a 1\n'), ('br/b', 'b 1\n')])
+        tree.add(['a', 'b'])
+        tree.commit('add a and b')
+        self.build_tree_contents([('br/a', 'a 2\n'), ('br/c', 'c 1\n')])
+        tree.add(['c'])
+        tree.commit('modify a, add c')
+        tree.remove(['b'])
+        self.build_tree_contents([('br/c', 'c 2\n')])
+        tree.commit('remove b, modify c')
+        return tree.branch
+
+    def export(self, branch, **kwargs):
+        outf = StringIO()
+        exporter = BzrFastExporter(branch, outf=outf, ref='refs/heads/master',
+            **kwargs)
+        exporter.run()
+        return outf.getvalue()
+
+    def test_prefetch_matches_unbuffered(self):
+        branch = self.make_history()
+        self.assertEquals(self.export(branch, prefetch_window=0),
+            self.export(branch, prefetch_window=2))
+
+    def test_prefetch_with_ghost(self):
+        tree = self.make_branch_and_tree('br')
+        tree.commit('first')
+        tree.set_parent_ids([tree.last_revision(), 'ghost-rev'],
+            allow_leftmost_as_ghost=True)
+        tree.commit('merge a ghost')
+        self.assertEquals(self.export(tree.branch, prefetch_window=0),
+            self.export(tree.branch))
+
+    def test_incremental(self):
+        tree = self.make_branch_and_tree('br')
+        tree.commit('first')
+        tree.commit('second')
+        self.export(tree.branch, export_marks_file='marks')
+        other = tree.bzrdir.sprout('other').open_workingtree()
+        other.commit('on other')
+        tree.commit('third')
+        tree.merge_from_branch(other.branch)
+        tree.commit('merge other')
+        self.assertEquals(self.export(tree.branch, import_marks_file='marks'),
+            self.export(tree.branch, import_marks_file='marks',
+                incremental=True))
+
+    def test_incremental_up_to_date(self):
+        tree = self.make_branch_and_tree('br')
+        tree.commit('first')
+        self.export(tree.branch, export_marks_file='marks')
+        self.assertEquals('', self.export(tree.branch, plain_format=True,
+            import_marks_file='marks', incremental=True))
+
+    def test_marks_after_dedupe_blobs(self):
+        tree = self.make_branch_and_tree('br')
+        self.build_tree_contents([('br/a', 'a 1\n')])
+        tree.add(['a'])
+        tree.commit('add a')
+        data = self.export(tree.branch, dedupe_blobs=True,
+            export_marks_file='marks')
+        self.assertTrue('blob\nmark :1\n' in data)
+        self.assertTrue('commit refs/heads/master\nmark :2\n' in data)
+        self.build_tree_contents([('br/a', 'a 2\n')])
+        tree.commit('modify a')
+        # The blob marks are not reused without --dedupe-blobs either
+        data = self.export(tree.branch, import_marks_file='marks',
+            export_marks_file='marks2')
+        self.assertTrue('commit refs/heads/master\nmark :3\n' in data)
+        self.assertEquals(open('marks.blobs').read(),
+            open('marks2.blobs').read())
+
+    def test_marks_after_gap(self):
+        tree = self.make_branch_and_tree('br')
+        revid = tree.commit('first')
+        self.build_tree_contents([('marks', ':5 %s\n' % revid)])
+        tree.commit('second')
+        data = self.export(tree.branch, import_marks_file='marks')
+        self.assertTrue('commit refs/heads/master\nmark :6\n' in data)
+
+    def test_binary_marks(self):
+        tree = self.make_branch_and_tree('br')
+        tree.commit('first')
+        self.export(tree.branch, export_marks_file='marks.txt')
+        self.export(tree.branch, export_marks_file='marks.bin',
+            binary_marks=True)
+        tree.commit('second')
+        self.assertEquals(
+            self.export(tree.branch, import_marks_file='marks.txt'),
+            self.export(tree.branch, import_marks_file='marks.bin'))
+
+    def test_binary_marks_not_loaded(self):
+        tree = self.make_branch_and_tree('br')
+        self.build_tree_contents([('br/a', 'a 1\n')])
+        tree.add(['a'])
+        tree.commit('add a')
+        self.export(tree.branch, dedupe_blobs=True, binary_marks=True,
+            export_marks_file='marks')
+        self.build_tree_contents([('br/a', 'a 2\n')])
+        tree.commit('modify a')
+        # The next mark is found without reading every mark in the files
+        def iteritems(self):
+            raise AssertionError('marks file loaded')
+        self.overrideAttr(marks_file.BinaryMarks, 'iteritems', iteritems)
+        data = self.export(tree.branch, dedupe_blobs=True,
+            import_marks_file='marks')
+        self.assertTrue('blob\nmark :3\n' in data)
+        self.assertTrue('commit refs/heads/master\nmark :4\n' in data)
+        self.assertTrue('M 644 :1 a\n' not in data)
+
+    def test_tree_cache(self):
+        branch = self.make_history()
+        exporter = BzrFastExporter(branch, outf=StringIO())
+        exporter.run()
+        # Each commit after the first finds its parent tree in the cache
+        self.assertEquals(2, exporter._tree_cache_hits)
+        self.assertEquals(4, exporter._tree_cache_misses)
+
+    def test_tree_cache_stats(self):
+        branch = self.make_history()
+        exporter = BzrFastExporter(branch, outf=StringIO())
+        notes = []
+        exporter.note = lambda msg, *args: notes.append(msg % args)
+        exporter.run()
+        self.assertTrue(
+            'Revision tree cache: 2 hits, 4 misses' in notes, notes)
+        notes = []
+        exporter = BzrFastExporter(branch, outf=StringIO(),
+            tree_cache_size=0)
+        exporter.note = lambda msg, *args: notes.append(msg % args)
+        exporter.run()
+        self.assertEquals([], [n for n in notes if 'tree cache' in n])
+
+    def test_no_tree_cache(self):
+        branch = self.make_history()
+        self.assertEquals(self.export(branch),
+            self.export(branch, tree_cache_size=0))
+
+    def test_is_empty_dir(self):
+        tree = self.make_branch_and_tree('br')
+        self.build_tree(['br/empty/', 'br/full/', 'br/full/a'])
+        tree.add(['empty', 'full', 'full/a'])
+        revid = tree.commit('add dirs')
+        exporter = BzrFastExporter(tree.branch, outf=StringIO())
+        tree.lock_read()
+        self.addCleanup(tree.unlock)
+        rev_tree = tree.branch.repository.revision_tree(revid)
+        self.assertTrue(exporter.is_empty_dir(rev_tree, 'empty'))
+        self.assertFalse(exporter.is_empty_dir(rev_tree, 'full'))
+        self.assertFalse(exporter.is_empty_dir(rev_tree, 'full/a'))
+
+    def test_jobs_match_single_process(self):
+        branch = self.make_history()
+        self.overrideAttr(_mod_exporter, '_SHARD_SIZE', 2)
+        self.assertEquals(self.export(branch),
+            self.export(branch, jobs=2))
+
+    def make_shard_tmpdir(self):
+        os.mkdir('tmp')
+        self.overrideAttr(tempfile, 'tempdir', os.path.abspath('tmp'))
+        self.overrideAttr(_mod_exporter, '_SHARD_SIZE', 1)
+
+    def test_jobs_bounded_shards(self):
+        tree = self.make_branch_and_tree('br')
+        for i in range(8):
+            tree.commit('commit %d' % i)
+        self.make_shard_tmpdir()
+        self.overrideAttr(_mod_exporter, '_SHARDS_PER_JOB', 1)
+        shard_files = []
+        emit_commit = BzrFastExporter.emit_commit
+        def record_shard_files(exporter, revid, ref):
+            shard_files.append(len(os.listdir('tmp')))
+            return emit_commit(exporter, revid, ref)
+        self.overrideAttr(BzrFastExporter, 'emit_commit', record_shard_files)
+        self.export(tree.branch, jobs=2)
+        # The shard being output and one pending shard per job
+        self.assertEquals(8, len(shard_files))
+        self.assertTrue(max(shard_files) <= 3)
+        self.assertEquals([], os.listdir('tmp'))
+
+    def test_jobs_error_removes_shard_files(self):
+        branch = self.make_history()
+        self.make_shard_tmpdir()
+        emit_commit = BzrFastExporter.emit_commit
+        calls = []
+        def fail_second_commit(exporter, revid, ref):
+            calls.append(revid)
+            if len(calls) == 2:
+                raise RuntimeError('output failed')
+            return emit_commit(exporter, revid, ref)
+        self.overrideAttr(BzrFastExporter, 'emit_commit', fail_second_commit)
+        self.assertRaises(RuntimeError, self.export, branch, jobs=2)
+        self.assertEquals([], os.listdir('tmp'))
+
+    def test_get_changes_matches_changes_from(self):
+        tree = self.make_branch_and_tree('br', format='2a')
+        self.build_tree(['br/a', 'br/b', 'br/d/', 'br/d/e'])
+        tree.add(['a', 'b', 'd', 'd/e'])
+        revid1 = tree.commit('add files')
+        tree.rename_one('d', 'f')
+        tree.remove(['b'])
+        self.build_tree_contents([('br/a', 'new a\n')])
+        revid2 = tree.commit('rename d, remove b, modify a')
+        repo = tree.branch.repository
+        exporter = BzrFastExporter(tree.branch, outf=StringIO())
+        tree.lock_read()
+        self.addCleanup(tree.unlock)
+        tree_old = repo.revision_tree(revid1)
+        tree_new = repo.revision_tree(revid2)
+        self.assertEquals(tree_new.changes_from(tree_old),
+            exporter._get_changes(tree_old, tree_new))
+
+    def make_commit_command(self):
+        file_cmds = [
+            commands.FileModifyCommand('a', 0100644, None, 'a 1\n'),
+            commands.FileDeleteCommand('b'),
+            ]
+        return commands.CommitCommand('refs/heads/master', 1, None,
+            ('Joe', 'joe@example.com', 1234567890, 0), 'msg', None, None,
+            iter(file_cmds))
+
+    def test_print_commit_matches_print_cmd(self):
+        expected = StringIO()
+        exporter = BzrFastExporter(None, outf=expected)
+        exporter.print_cmd(self.make_commit_command())
+        exporter.outf.flush()
+        streamed = StringIO()
+        exporter = BzrFastExporter(None, outf=streamed)
+        exporter.print_commit(self.make_commit_command())
+        exporter.outf.flush()
+        self.assertEquals(expected.getvalue(), streamed.getvalue())
+
+    def test_print_cmd_writes_data_separately(self):
+        for buffer_size in [0, 4, 1024]:
+            outf = StringIO()
+            exporter = BzrFastExporter(None, outf=outf, buffer_size=buffer_size)
+            for cmd in [
+                    commands.BlobCommand('1', 'blob text'),
+                    commands.FileModifyCommand('a', 0100644, None, 'a 1\n'),
+                    commands.FileModifyCommand('b', 0100644, ':1', None),
+                    ]:
+                exporter.print_cmd(cmd)
+            exporter.outf.flush()
+            self.assertEquals(
+                "blob\nmark :1\ndata 9\nblob text\n"
+                "M 644 inline a\ndata 4\na 1\n\n"
+                "M 644 :1 b\n", outf.getvalue())
+
+
 # from dulwich.tests.test_repository:
 class CheckRefFormatTests(tests.TestCase):
     """Tests for the check_ref_format function.
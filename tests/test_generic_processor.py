@@ -18,6 +18,9 @@ import time
 from bzrlib import (
     tests,
     )
+from bzrlib.plugins.fastimport import (
+    checkpointfile,
+    )
 from bzrlib.plugins.fastimport.helpers import (
     kind_to_mode,
     )
@@ -1433,6 +1436,52 @@ class TestImportToPackDeleteRenameThenModify(TestCaseForGenericProcessor):
         self.assertSymlinkTarget(branch, revtree2, new_path, "bbb")
 
 
+class TestImportToPackDeleteInRenamedDir(TestCaseForGenericProcessor):
+    """Test deleting a file and renaming its directory in the same commit."""
+
+    def get_command_iter(self, files_two):
+
+        # Revno 1: create two files in a directory
+        # Revno 2: delete one and rename the directory
+        # Revno 3: add a file where the deleted one would have moved to
+        def command_list():
+            author = ['', 'bugs@a.com', time.time(), time.timezone]
+            committer = ['', 'elmer@a.com', time.time(), time.timezone]
+            def files_one():
+                yield commands.FileModifyCommand('a/x', kind_to_mode('file', False),
+                        None, "xxx")
+                yield commands.FileModifyCommand('a/y', kind_to_mode('file', False),
+                        None, "yyy")
+            yield commands.CommitCommand('head', '1', author,
+                committer, "commit 1", None, [], files_one)
+            yield commands.CommitCommand('head', '2', author,
+                committer, "commit 2", ":1", [], files_two)
+            def files_three():
+                yield commands.FileModifyCommand('b/x', kind_to_mode('file', False),
+                        None, "zzz")
+            yield commands.CommitCommand('head', '3', author,
+                committer, "commit 3", ":2", [], files_three)
+        return command_list
+
+    def assertNewFileId(self, branch):
+        revtree1 = branch.repository.revision_tree(branch.get_rev_id(1))
+        revtree3 = branch.repository.revision_tree(branch.get_rev_id(3))
+        self.assertNotEqual(revtree1.path2id('a/x'), revtree3.path2id('b/x'))
+        self.assertEqual(revtree1.path2id('a/y'), revtree3.path2id('b/y'))
+        self.assertContent(branch, revtree3, 'b/x', "zzz")
+
+    def test_delete_then_rename_dir(self):
+        handler, branch = self.get_handler()
+        def files_two():
+            yield commands.FileDeleteCommand('a/x')
+            yield commands.FileRenameCommand('a', 'b')
+        handler.process(self.get_command_iter(files_two))
+        revtree1, revtree2 = self.assertChanges(branch, 2,
+            expected_removed=[('a/x',)],
+            expected_renamed=[('a', 'b')])
+        self.assertNewFileId(branch)
+
+
 class TestImportToPackRenameTricky(TestCaseForGenericProcessor):
 
     def file_command_iter(self, path1, old_path2, new_path2, kind='file'):
@@ -1517,6 +1566,97 @@ class TestImportToPackRenameTricky(TestCaseForGenericProcessor):
         self.assertSymlinkTarget(branch, revtree2, new_path2, "bbb")
 
 
+class TestImportToPackPruneEmptyDirs(TestCaseForGenericProcessor):
+    """Test the pruning of directories left empty by a commit."""
+
+    def get_command_iter(self, paths, file_cmds):
+
+        # Revno 1: create some files
+        # Revno 2: apply file_cmds
+        def command_list():
+            author = ['', 'bugs@a.com', time.time(), time.timezone]
+            committer = ['', 'elmer@a.com', time.time(), time.timezone]
+            def files_one():
+                for path in paths:
+                    yield commands.FileModifyCommand(path,
+                        kind_to_mode('file', False), None, "aaa")
+            yield commands.CommitCommand('head', '1', author,
+                committer, "commit 1", None, [], files_one)
+            def files_two():
+                return iter(file_cmds)
+            yield commands.CommitCommand('head', '2', author,
+                committer, "commit 2", ":1", [], files_two)
+        return command_list
+
+    def test_rename_last_child_out(self):
+        handler, branch = self.get_handler()
+        handler.process(self.get_command_iter(['a/b/c', 'd'], [
+            commands.FileRenameCommand('a/b/c', 'e'),
+            ]))
+        self.assertChanges(branch, 2,
+            expected_renamed=[('a/b/c', 'e')],
+            expected_removed=[('a',), ('a/b',)])
+
+    def test_rename_one_child_out(self):
+        handler, branch = self.get_handler()
+        handler.process(self.get_command_iter(['a/b', 'a/c'], [
+            commands.FileRenameCommand('a/b', 'd'),
+            ]))
+        self.assertChanges(branch, 2,
+            expected_renamed=[('a/b', 'd')],
+            expected_removed=[])
+
+    def test_delete_under_renamed_parent(self):
+        handler, branch = self.get_handler()
+        handler.process(self.get_command_iter(['a/b/c', 'a/d'], [
+            commands.FileDeleteCommand('a/b/c'),
+            commands.FileRenameCommand('a', 'x'),
+            ]))
+        self.assertChanges(branch, 2,
+            expected_renamed=[('a', 'x')],
+            expected_removed=[('a/b',), ('a/b/c',)])
+
+    def test_prune_renamed_dir(self):
+        handler, branch = self.get_handler()
+        handler.process(self.get_command_iter(['a/b/c', 'd'], [
+            commands.FileRenameCommand('a/b/c', 'e'),
+            commands.FileRenameCommand('a', 'x'),
+            ]))
+        self.assertChanges(branch, 2,
+            expected_renamed=[('a/b/c', 'e')],
+            expected_removed=[('a',), ('a/b',)])
+
+    def test_delete_and_add_in_same_dir(self):
+        handler, branch = self.get_handler()
+        handler.process(self.get_command_iter(['a/b', 'd'], [
+            commands.FileDeleteCommand('a/b'),
+            commands.FileModifyCommand('a/c', kind_to_mode('file', False),
+                None, "bbb"),
+            ]))
+        self.assertChanges(branch, 2,
+            expected_added=[('a/c',)],
+            expected_removed=[('a/b',)])
+
+    def test_delete_and_add_in_new_subdir(self):
+        handler, branch = self.get_handler()
+        handler.process(self.get_command_iter(['a/b', 'd'], [
+            commands.FileDeleteCommand('a/b'),
+            commands.FileModifyCommand('a/c/e', kind_to_mode('file', False),
+                None, "bbb"),
+            ]))
+        self.assertChanges(branch, 2,
+            expected_added=[('a/c',), ('a/c/e',)],
+            expected_removed=[('a/b',)])
+
+    def test_not_pruned_when_disabled(self):
+        handler, branch = self.get_handler()
+        handler.prune_empty_dirs = False
+        handler.process(self.get_command_iter(['a/b', 'd'], [
+            commands.FileDeleteCommand('a/b'),
+            ]))
+        self.assertChanges(branch, 2, expected_removed=[('a/b',)])
+
+
 class TestImportToPackCopy(TestCaseForGenericProcessor):
 
     def file_command_iter(self, src_path, dest_path, kind='file'):
@@ -1990,3 +2130,223 @@ class TestAddNonUtf8InBranch(TestCaseForGenericProcessor):
         rtree_a = branch.repository.revision_tree(rev_a)
         foo_id = rtree_a.path2id(u'foo\ufffd')
         self.assertEqual(rev_a, rtree_a.get_file_revision(foo_id))
+
+
+class TestIdMap(TestCaseForGenericProcessor):
+
+    def commit_command_iter(self, marks, checkpoints=True):
+        def command_list():
+            committer = ['', 'elmer@a.com', time.time(), time.timezone]
+            parents = []
+            for mark in marks:
+                def files():
+                    yield commands.FileModifyCommand('a',
+                        kind_to_mode('file', False), None, "data %s\n" % mark)
+                yield commands.CommitCommand('head', mark, None,
+                    committer, "commit %s" % mark, None, parents, files)
+                parents = [':%s' % mark]
+                if checkpoints:
+                    yield commands.CheckpointCommand()
+        return command_list
+
+    def read_id_map(self, handler):
+        f = open(handler.id_map_path, 'rb')
+        try:
+            return [line.split(' ')[0] for line in f.read().splitlines()]
+        finally:
+            f.close()
+
+    def test_appended_at_checkpoints(self):
+        handler, branch = self.get_handler()
+        handler.process(self.commit_command_iter(['1', '2', '3']))
+        self.assertEqual(['1', '2', '3'], self.read_id_map(handler))
+
+    def test_restart_appends(self):
+        handler, branch = self.get_handler()
+        handler.process(self.commit_command_iter(['1', '2'],
+            checkpoints=False))
+        handler = self.get_handler_for(branch)
+        handler.process(self.commit_command_iter(['1', '2', '3'],
+            checkpoints=False))
+        self.assertEqual(['1', '2', '3'], self.read_id_map(handler))
+        self.assertEqual(3, branch.revno())
+
+    def test_incomplete_entry_rewritten(self):
+        handler, branch = self.get_handler()
+        handler.process(self.commit_command_iter(['1']))
+        f = open(handler.id_map_path, 'ab')
+        try:
+            f.write('2 partial')
+        finally:
+            f.close()
+        handler = self.get_handler_for(branch)
+        handler.process(self.commit_command_iter(['1', '2'],
+            checkpoints=False))
+        self.assertEqual(['1', '2'], sorted(self.read_id_map(handler)))
+
+    def get_handler_for(self, branch):
+        from bzrlib.plugins.fastimport.processors import (
+            generic_processor,
+            )
+        return generic_processor.GenericProcessor(branch.bzrdir)
+
+
+class TestMergedInventories(TestCaseForGenericProcessor):
+
+    def commit_command_iter(self):
+        # A
+        # |\
+        # | B
+        # C |
+        # | |
+        # D |
+        # |/
+        # E     merge B
+        def command_list():
+            committer = ['', 'elmer@a.com', time.time(), time.timezone]
+            for mark, from_, merges in [('1', None, []), ('2', ':1', []),
+                ('3', ':1', []), ('4', ':3', []), ('5', ':4', [':2'])]:
+                def files():
+                    yield commands.FileModifyCommand('a%s' % mark,
+                        kind_to_mode('file', False), None, "data\n")
+                yield commands.CommitCommand('head', mark, None,
+                    committer, "commit %s" % mark, from_, merges, files)
+        return command_list
+
+    def get_handler_with_info(self, info):
+        from bzrlib.plugins.fastimport.processors import (
+            generic_processor,
+            )
+        branch = self.make_branch('.', format=self.branch_format)
+        params = {'inv-cache': 1}
+        if info is not None:
+            params['info'] = info
+        return generic_processor.GenericProcessor(branch.bzrdir, params)
+
+    def test_merged_inventory_kept(self):
+        handler = self.get_handler_with_info([
+            '[Command counts]', 'commit = 5', '[Merges]', ':2 = 1'])
+        handler.process(self.commit_command_iter())
+        # Only A is reconstructed, for C
+        self.assertEqual(1, handler.cache_mgr.inventories.misses)
+        self.assertEqual(0, handler.cache_mgr.inventories.pinned_count())
+
+    def test_merged_inventory_reconstructed(self):
+        handler = self.get_handler_with_info(None)
+        handler.process(self.commit_command_iter())
+        # A is reconstructed for C and B for E
+        self.assertEqual(2, handler.cache_mgr.inventories.misses)
+
+
+class TestResumeFromCheckpoint(TestCaseForGenericProcessor):
+
+    def make_stream(self, marks):
+        lines = []
+        for mark in marks:
+            lines.append('commit refs/heads/master\n'
+                'mark :%s\n'
+                'committer Joe <joe@example.com> 1234567890 +0000\n'
+                'data 8\n'
+                'commit %s\n'
+                'M 644 inline a\n'
+                'data 7\n'
+                'data %s\n\n' % (mark, mark, mark))
+            if mark == '2':
+                lines.append('checkpoint\n\n')
+        self.build_tree_contents([('stream.fi', ''.join(lines))])
+
+    def import_stream(self, branch, fail_at=None):
+        from fastimport import parser
+        from bzrlib.plugins.fastimport.processors import (
+            generic_processor,
+            )
+        handler = generic_processor.GenericProcessor(branch.bzrdir)
+        handler.seen = []
+        f = open('stream.fi', 'rb')
+        try:
+            p = parser.ImportParser(f)
+            def command_iter():
+                for cmd in p.iter_commands():
+                    if cmd.name == 'commit':
+                        handler.seen.append(cmd.id)
+                        if cmd.id == fail_at:
+                            raise AssertionError('interrupted')
+                    yield cmd
+            handler.set_parser(p)
+            if fail_at is None:
+                handler.process(command_iter)
+            else:
+                self.assertRaises(AssertionError, handler.process,
+                    command_iter)
+        finally:
+            f.close()
+        return handler
+
+    def test_resume(self):
+        branch = self.make_branch('.', format=self.branch_format)
+        self.make_stream(['1', '2', '3'])
+        handler = self.import_stream(branch, fail_at=':3')
+        self.assertPathExists(handler.checkpoint_path)
+        handler = self.import_stream(branch)
+        self.assertEqual([':3'], handler.seen)
+        # The parent of commit 3 comes from the restored RefTracker
+        self.assertEqual(3, branch.revno())
+
+    def test_removed_when_finished(self):
+        branch = self.make_branch('.', format=self.branch_format)
+        self.make_stream(['1', '2', '3'])
+        handler = self.import_stream(branch)
+        self.assertPathDoesNotExist(handler.checkpoint_path)
+        self.assertPathDoesNotExist(handler.checkpoint_path + '-blobs')
+
+    def test_restart_when_stream_changed(self):
+        branch = self.make_branch('.', format=self.branch_format)
+        self.make_stream(['1', '2', '3'])
+        handler = self.import_stream(branch, fail_at=':3')
+        # The stream is read from the start but the skipped commits
+        # are not processed again
+        self.make_stream(['1', '2', '3', '4'])
+        handler = self.import_stream(branch)
+        self.assertEqual([':1', ':2', ':3', ':4'], handler.seen)
+        self.assertEqual(4, branch.revno())
+
+    def make_blob_stream(self):
+        self.build_tree_contents([('stream.fi',
+            'blob\nmark :1\ndata 4\nabc\n\n'
+            'commit refs/heads/master\nmark :2\n'
+            'committer Joe <joe@example.com> 1234567890 +0000\n'
+            'data 3\none\nM 644 :1 a\n\n'
+            'blob\nmark :3\ndata 4\ndef\n\n'
+            'blob\nmark :4\ndata 0\n\n'
+            'checkpoint\n\n'
+            'commit refs/heads/master\nmark :5\n'
+            'committer Joe <joe@example.com> 1234567890 +0000\n'
+            'data 3\ntwo\nM 644 :1 b\nM 644 :3 c\nM 644 :4 d\n\n')])
+
+    def test_resume_with_blobs(self):
+        branch = self.make_branch('.', format=self.branch_format)
+        self.make_blob_stream()
+        handler = self.import_stream(branch, fail_at=':5')
+        state = checkpointfile.load_checkpoint(handler.checkpoint_path)
+        self.assertNotEqual(None, state['position'])
+        handler = self.import_stream(branch)
+        # The blobs are restored instead of reading the stream from
+        # the start
+        self.assertEqual([':5'], handler.seen)
+        self.assertEqual(2, branch.revno())
+        tree = branch.repository.revision_tree(branch.last_revision())
+        tree.lock_read()
+        self.addCleanup(tree.unlock)
+        self.assertEqual('abc\n', tree.get_file_text(tree.path2id('b')))
+        self.assertEqual('def\n', tree.get_file_text(tree.path2id('c')))
+        self.assertEqual('', tree.get_file_text(tree.path2id('d')))
+
+    def test_restart_with_blobs_when_stream_changed(self):
+        branch = self.make_branch('.', format=self.branch_format)
+        self.make_blob_stream()
+        handler = self.import_stream(branch, fail_at=':5')
+        self.build_tree_contents([('stream.fi',
+            open('stream.fi').read() + 'progress changed\n\n')])
+        handler = self.import_stream(branch)
+        self.assertEqual([':2', ':5'], handler.seen)
+        self.assertEqual(2, branch.revno())
@@ -0,0 +1,51 @@
+# Copyright (C) 2010 Canonical Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test saving and loading the id-map file."""
+
+from bzrlib import tests
+
+from bzrlib.plugins.fastimport import idmapfile
+
+
+class TestIdMapFile(tests.TestCaseInTempDir):
+
+    def test_missing(self):
+        self.assertEqual(({}, 0), idmapfile.load_id_map('id-map'))
+        self.assertEqual(({}, 0), idmapfile.load_id_map_journal('id-map'))
+
+    def test_save_and_load(self):
+        idmapfile.save_id_map('id-map', {'1': 'rev-a', '2': 'rev-b'})
+        self.assertEqual(({'1': 'rev-a', '2': 'rev-b'}, 2),
+            idmapfile.load_id_map('id-map'))
+        self.failIfExists('id-map.tmp')
+
+    def test_append(self):
+        idmapfile.save_id_map('id-map', {'1': 'rev-a'})
+        idmapfile.append_id_map('id-map', [('2', 'rev-b'), ('1', 'rev-c')])
+        self.assertEqual(({'1': 'rev-c', '2': 'rev-b'}, 2),
+            idmapfile.load_id_map('id-map'))
+        self.assertEqual(({'1': 'rev-c', '2': 'rev-b'}, 3),
+            idmapfile.load_id_map_journal('id-map'))
+
+    def test_incomplete_entry(self):
+        idmapfile.append_id_map('id-map', [('1', 'rev-a')])
+        f = open('id-map', 'ab')
+        try:
+            f.write('2 rev')
+        finally:
+            f.close()
+        self.assertEqual(({'1': 'rev-a'}, None),
+            idmapfile.load_id_map_journal('id-map'))
@@ -0,0 +1,137 @@
+# Copyright (C) 2010 Canonical Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test reading and writing marks files."""
+
+from bzrlib import tests
+
+from bzrlib.plugins.fastimport import marks_file
+
+
+class TestMarksFile(tests.TestCaseInTempDir):
+
+    marks = {'1': 'rev-a', '2': 'rev-c', '10': 'rev-b', '-1': 'ghost'}
+
+    def test_text_round_trip(self):
+        marks_file.export_marks('marks', self.marks)
+        self.assertEqual(self.marks, marks_file.import_marks('marks'))
+        with open('marks') as f:
+            self.assertTrue(f.read().startswith(':'))
+
+    def test_missing_file(self):
+        self.assertEqual(None, marks_file.import_marks('missing'))
+
+    def test_binary_round_trip(self):
+        marks_file.export_marks('marks', self.marks, binary=True)
+        with open('marks', 'rb') as f:
+            self.assertEqual(marks_file.BINARY_MARKS_HEADER, f.readline())
+        marks = marks_file.import_marks('marks')
+        self.assertEqual(4, len(marks))
+        self.assertEqual(self.marks, dict(marks.iteritems()))
+        self.assertEqual('rev-b', marks['10'])
+        self.assertEqual('ghost', marks['-1'])
+        self.assertEqual(None, marks.get('3'))
+        self.assertEqual(None, marks.get('x'))
+        self.assertFalse('3' in marks)
+        self.assertRaises(KeyError, marks.__getitem__, '3')
+
+    def test_binary_by_revision(self):
+        marks_file.export_marks('marks', self.marks, binary=True)
+        marks = marks_file.import_marks('marks', by_revision=True)
+        self.assertEqual('10', marks['rev-b'])
+        self.assertEqual('2', marks.get('rev-c'))
+        self.assertEqual(None, marks.get('rev-d'))
+        self.assertEqual(None, marks.get(''))
+        self.assertEqual(dict((r, m) for m, r in self.marks.items()),
+            dict(marks.items()))
+
+    def test_binary_empty(self):
+        marks_file.export_marks('marks', {}, binary=True)
+        marks = marks_file.import_marks('marks', by_revision=True)
+        self.assertEqual(0, len(marks))
+        self.assertEqual(None, marks.get('rev-a'))
+
+    def test_binary_additions(self):
+        marks_file.export_marks('marks', self.marks, binary=True)
+        marks = marks_file.import_marks('marks')
+        marks['11'] = 'rev-d'
+        marks['1'] = 'rev-e'
+        self.assertEqual(5, len(marks))
+        self.assertEqual('rev-d', marks['11'])
+        self.assertEqual('rev-e', marks['1'])
+        self.assertEqual(sorted(['1', '2', '10', '11', '-1']),
+            sorted(marks.keys()))
+        # Rewriting the file that is mapped keeps the mapping valid
+        marks_file.export_marks('marks', marks, binary=True)
+        self.assertEqual('rev-b', marks['10'])
+        self.assertEqual(dict(marks.items()),
+            dict(marks_file.import_marks('marks').items()))
+
+    def test_export_by_revision(self):
+        marks_file.export_marks('marks',
+            dict((r, m) for m, r in self.marks.items()), by_revision=True)
+        self.assertEqual(self.marks, marks_file.import_marks('marks'))
+
+    def test_binary_by_revision_additions(self):
+        marks_file.export_marks('marks', self.marks, binary=True)
+        marks = marks_file.import_marks('marks', by_revision=True)
+        marks['rev-d'] = 11
+        marks['rev-e'] = 0
+        marks['rev-aa'] = 10
+        marks['rev-c'] = 3
+        # The marks in the mapped file are copied rather than loaded
+        base = marks._base._marks
+        def iteritems():
+            raise AssertionError('marks file loaded')
+        base.iteritems = iteritems
+        marks_file.export_marks('marks', marks, binary=True,
+            by_revision=True)
+        written = marks_file.import_marks('marks')
+        self.assertEqual(7, len(written))
+        self.assertEqual(['-1', '0', '1', '3', '10', '10', '11'],
+            [m for m, r in written.iteritems()])
+        written = marks_file.import_marks('marks', by_revision=True)
+        for revid, mark in [('rev-a', '1'), ('rev-aa', '10'), ('rev-b', '10'),
+            ('rev-c', '3'), ('rev-d', '11'), ('rev-e', '0'), ('ghost', '-1')]:
+            self.assertEqual(mark, written.get(revid))
+        self.assertEqual(None, written.get('rev-f'))
+
+    def test_max_mark(self):
+        self.assertEqual(10, marks_file.max_mark(self.marks))
+        self.assertEqual(10, marks_file.max_mark(
+            dict((r, m) for m, r in self.marks.items()), by_revision=True))
+        self.assertEqual(0, marks_file.max_mark({'abc': 'rev-a'}))
+        marks_file.export_marks('marks', self.marks, binary=True)
+        marks = marks_file.import_marks('marks', by_revision=True)
+        def iteritems():
+            raise AssertionError('marks file loaded')
+        marks._base._marks.iteritems = iteritems
+        self.assertEqual(10, marks_file.max_mark(marks, by_revision=True))
+        marks['rev-d'] = 12
+        self.assertEqual(12, marks_file.max_mark(marks, by_revision=True))
+        marks_file.export_marks('marks', {}, binary=True)
+        self.assertEqual(0, marks_file.max_mark(
+            marks_file.import_marks('marks')))
+
+    def test_convert_text_to_binary(self):
+        marks_file.export_marks('marks', self.marks)
+        marks = marks_file.import_marks('marks')
+        marks_file.export_marks('marks', marks, binary=True)
+        self.assertEqual(self.marks,
+            dict(marks_file.import_marks('marks').items()))
+
+    def test_binary_needs_numeric_marks(self):
+        marks_file.export_marks('marks', {'abc': 'rev-a'}, binary=True)
+        self.assertEqual({'abc': 'rev-a'}, marks_file.import_marks('marks'))
@@ -149,3 +149,54 @@ class Test_TreeShim(tests.TestCase):
         # self.assertEqualDiff(pformat(expected), pformat(changes))
         self.assertEqual(expected, changes)
 
+
+
+class TestRevisionStore2Texts(tests.TestCaseWithTransport):
+
+    _test_needs_features = [FastimportFeature]
+
+    def setUp(self):
+        super(TestRevisionStore2Texts, self).setUp()
+        self.repo = self.make_repository('.', format='2a')
+        self.repo.lock_write()
+        self.addCleanup(self.repo.unlock)
+        self.repo.start_write_group()
+        self.addCleanup(self.abort_write_group)
+        self.store = revision_store.RevisionStore2(self.repo)
+
+    def abort_write_group(self):
+        if self.repo.is_in_write_group():
+            self.repo.abort_write_group()
+
+    def load_texts(self, texts, parents=()):
+        self.store._load_texts_for_file_rev_ids(texts.keys(),
+            lambda file_id: texts[(file_id, 'rev-1')],
+            lambda file_id: parents)
+
+    def test_texts_batched(self):
+        self.load_texts({('a-id', 'rev-1'): 'a\n', ('b-id', 'rev-1'): 'b\n'})
+        self.assertEqual({}, self.repo.texts.get_parent_map(
+            [('a-id', 'rev-1')]))
+        self.store.flush_texts()
+        self.assertEqual({('a-id', 'rev-1'): ()},
+            self.repo.texts.get_parent_map([('a-id', 'rev-1')]))
+        self.assertEqual('b\n', self.repo.texts.get_record_stream(
+            [('b-id', 'rev-1')], 'unordered', True).next().get_bytes_as(
+            'fulltext'))
+
+    def test_flushed_by_size(self):
+        self.store._text_batch_size = 2
+        self.load_texts({('a-id', 'rev-1'): 'a\n'})
+        self.assertEqual({('a-id', 'rev-1'): ()},
+            self.repo.texts.get_parent_map([('a-id', 'rev-1')]))
+
+    def test_flushed_before_reading(self):
+        self.load_texts({('a-id', 'rev-1'): 'a\nb\n'})
+        self.assertEqual(['a\n', 'b\n'],
+            self.store.get_file_lines('rev-1', 'a-id'))
+
+    def test_get_file_bytes(self):
+        self.load_texts({('a-id', 'rev-1'): 'a\nb'})
+        self.assertEqual('a\nb', self.store.get_file_bytes('rev-1', 'a-id'))
+        self.assertRaises(errors.RevisionNotPresent,
+            self.store.get_file_bytes, 'rev-2', 'a-id')